@@ -1,12 +1,18 @@
 
 import tkinter as tk
 from tkinter import messagebox, ttk
-import threading
 import queue
 import pyperclip
-import time
-import json
-import os
+
+from clipboard_watcher import ClipboardWatcher
+from history_model import ClipboardHistory, HistoryRows
+from journal import Journal
+from search_index import SearchIndex
+
+# How often pending journal records are fsynced and, if the journal has grown, compacted (ms)
+JOURNAL_CHECK_INTERVAL = 1000
+# At most this many history search results are listed
+SEARCH_RESULT_LIMIT = 500
 
 class ClipboardApp:
     def __init__(self, root):
@@ -18,6 +24,17 @@ class ClipboardApp:
         self.history_file = "clipboard_history.json"
         self.snippets_file = "snippets.json"
         self.snippets = []
+        # Every change is appended to a journal; the JSON files are periodic snapshots
+        self.history_journal = Journal(self.history_file)
+        self.snippets_journal = Journal(self.snippets_file)
+
+        # --- Data ---
+        # The history model is the source of truth; the Listbox only renders it.
+        # history_rows maps Listbox rows (top first) to history keys and back
+        self.history = ClipboardHistory()
+        self.history_rows = HistoryRows()
+        # Snippets are indexed by their position in self.snippets (the Treeview iid)
+        self.snippet_index = SearchIndex()
 
         # --- Styling ---
         style = ttk.Style()
@@ -62,6 +79,7 @@ class ClipboardApp:
         # --- Bind Events & Start Threads ---
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
         self.start_clipboard_monitor()
+        self.root.after(JOURNAL_CHECK_INTERVAL, self.check_journals)
 
     def setup_history_tab(self):
         # --- GUI Widgets for History ---
@@ -71,6 +89,12 @@ class ClipboardApp:
         ttk.Button(button_frame, text="清除選取項目", command=self.clear_selected_history_item).pack(side=tk.LEFT, padx=5)
         ttk.Button(button_frame, text="清除全部歷史", command=self.clear_history).pack(side=tk.LEFT, padx=5)
 
+        # Results update as you type; an empty box shows the whole history
+        self.history_search_var = tk.StringVar()
+        self.history_search_var.trace_add("write", lambda *args: self.render_history())
+        ttk.Entry(button_frame, textvariable=self.history_search_var, width=25).pack(side=tk.RIGHT, padx=5)
+        ttk.Label(button_frame, text="搜尋:").pack(side=tk.RIGHT)
+
         list_frame = ttk.Frame(self.history_frame)
         list_frame.pack(fill=tk.BOTH, expand=True)
 
@@ -92,6 +116,11 @@ class ClipboardApp:
         ttk.Button(button_frame, text="編輯片段", command=self.edit_snippet_dialog).pack(side=tk.LEFT, padx=5)
         ttk.Button(button_frame, text="刪除片段", command=self.delete_snippet).pack(side=tk.LEFT, padx=5)
 
+        self.snippets_search_var = tk.StringVar()
+        self.snippets_search_var.trace_add("write", lambda *args: self.populate_snippets_treeview())
+        ttk.Entry(button_frame, textvariable=self.snippets_search_var, width=25).pack(side=tk.RIGHT, padx=5)
+        ttk.Label(button_frame, text="搜尋:").pack(side=tk.RIGHT)
+
         tree_frame = ttk.Frame(self.snippets_frame)
         tree_frame.pack(fill=tk.BOTH, expand=True)
 
@@ -111,10 +140,28 @@ class ClipboardApp:
 
     # --- Generic Methods ---
     def on_closing(self):
-        self.save_history()
-        self.save_snippets()
+        self.watcher.stop()
+        # The journal already holds every change; only compact when it has grown large
+        # relative to the data, otherwise closing would rewrite the whole history
+        self.compact_journals()
+        self.history_journal.close()
+        self.snippets_journal.close()
         self.root.destroy()
 
+    def compact_journals(self):
+        if self.history_journal.needs_compaction(len(self.history)):
+            self.save_history()
+        if self.snippets_journal.needs_compaction(len(self.snippets)):
+            self.save_snippets()
+
+    def check_journals(self):
+        try:
+            self.history_journal.sync()
+            self.snippets_journal.sync()
+            self.compact_journals()
+        finally:
+            self.root.after(JOURNAL_CHECK_INTERVAL, self.check_journals)
+
     def clear_status(self):
         self.status_var.set("")
 
@@ -136,15 +183,17 @@ class ClipboardApp:
         help_text.insert(tk.END, "剪貼簿歷史\n", "h2")
         help_text.insert(tk.END, "• 自動記錄：您在電腦上複製的任何文字都會自動出現在此列表中。\n", "p")
         help_text.insert(tk.END, "• 重新複製：雙擊列表中的任一項目，即可將其內容再次複製到剪貼簿。\n", "p")
-        help_text.insert(tk.END, "• 管理記錄：使用按鈕可以刪除選取的項目，或清除所有歷史記錄。\n\n", "p")
+        help_text.insert(tk.END, "• 管理記錄：使用按鈕可以刪除選取的項目，或清除所有歷史記錄。\n", "p")
+        help_text.insert(tk.END, "• 搜尋：在右上方的搜尋框輸入文字，列表會隨輸入即時篩選，常用且較新的項目排在前面。中英文皆可搜尋。\n\n", "p")
 
         help_text.insert(tk.END, "快捷片段 (Snippets)\n", "h2")
         help_text.insert(tk.END, "• 功能：此處用於管理您常用的文字片段，如Email、地址、程式碼塊等。\n", "p")
         help_text.insert(tk.END, "• 新增/編輯/刪除：使用上方的按鈕來管理您的快捷片段。\n", "p")
-        help_text.insert(tk.END, "• 使用片段：雙擊列表中的任一項目，即可將其內容複製到剪貼簿，方便隨處貼上。\n\n", "p")
+        help_text.insert(tk.END, "• 使用片段：雙擊列表中的任一項目，即可將其內容複製到剪貼簿，方便隨處貼上。\n", "p")
+        help_text.insert(tk.END, "• 搜尋：在搜尋框輸入文字，可依關鍵字或內容篩選片段。\n\n", "p")
 
         help_text.insert(tk.END, "通用\n", "h2")
-        help_text.insert(tk.END, "• 自動儲存：所有歷史記錄和快捷片段都會在關閉程式時自動儲存。\n", "p")
+        help_text.insert(tk.END, "• 自動儲存：歷史記錄和快捷片段的每次變更都會立即寫入磁碟，程式意外結束也不會遺失。\n", "p")
 
         help_text.config(state=tk.DISABLED)
 
@@ -156,100 +205,168 @@ class ClipboardApp:
 
     # --- History Methods ---
     def load_history(self):
-        if not os.path.exists(self.history_file): return
+        # Snapshot first, then the changes journaled since it was written
         try:
-            with open(self.history_file, 'r', encoding='utf-8') as f:
-                for item in json.load(f):
-                    self.history_listbox.insert(tk.END, item)
-        except (json.JSONDecodeError, FileNotFoundError):
-            pass
+            data, records = self.history_journal.load()
+        except OSError as e:
+            print(f"Error loading history: {e}")
+            data, records = None, []
+        if isinstance(data, list):
+            self.history.load_list(data)
+        for record in records:
+            self.history.apply(record)
+        self.history.evict()
+        self.render_history()
 
     def save_history(self):
+        # Compaction: write the full history as a new snapshot and empty the journal
         try:
-            with open(self.history_file, 'w', encoding='utf-8') as f:
-                json.dump(self.history_listbox.get(0, tk.END), f, ensure_ascii=False, indent=4)
+            self.history_journal.compact(self.history.to_list())
         except Exception as e:
             print(f"Error saving history: {e}")
 
+    def journal_history(self, op, **fields):
+        try:
+            self.history_journal.append(op, **fields)
+        except OSError as e:
+            print(f"Error writing history journal: {e}")
+
+    def render_history(self):
+        # Full redraw, used after loading and when the search text changes; single copies
+        # update the rows incrementally. The query is not stripped: a trailing space ends
+        # the last word, so it is matched exactly instead of as a prefix
+        query = self.history_search_var.get()
+        if query.strip():
+            keys = self.history.search(query, SEARCH_RESULT_LIMIT)
+        else:
+            keys = self.history.keys()
+        self.history_rows.reset(keys)
+        self.history_listbox.delete(0, tk.END)
+        if keys:
+            self.history_listbox.insert(tk.END, *(self.history.get(key)['text'] for key in keys))
+
     def start_clipboard_monitor(self):
         self.queue = queue.Queue()
-        try:
-            self.last_item = pyperclip.paste()
-        except Exception:
-            self.last_item = ""
-        
-        self.monitor_thread = threading.Thread(target=self.clipboard_monitor, daemon=True)
-        self.monitor_thread.start()
+        # The watcher uses native change notifications where available (falls back to
+        # adaptive polling) and hands new text to the UI thread through the queue
+        self.watcher = ClipboardWatcher(self.queue.put)
+        self.watcher.start()
         self.process_queue()
 
-    def clipboard_monitor(self):
-        while True:
-            try:
-                new_item = pyperclip.paste()
-                if new_item and isinstance(new_item, str) and new_item != self.last_item:
-                    self.last_item = new_item
-                    self.queue.put(new_item)
-            except Exception:
-                pass # Ignore pyperclip errors on certain content
-            time.sleep(0.5)
-
     def process_queue(self):
+        searching = bool(self.history_search_var.get().strip())
+        changed = False
         try:
             while not self.queue.empty():
                 item = self.queue.get_nowait()
-                all_items = self.history_listbox.get(0, tk.END)
-                if item in all_items:
-                    self.history_listbox.delete(all_items.index(item))
+                key, is_new = self.history.add(item)
+                entry = self.history.get(key)
+                if is_new:
+                    self.journal_history("add", entry=entry)
+                else:
+                    self.journal_history("move", key=key, last_seen=entry["last_seen"], hits=entry["hits"])
+                evicted = self.history.evict()
+                changed = True
+                if searching:
+                    continue  # The rows are search results; they are re-queried below
+                row = self.history_rows.row(key)
+                if row is not None:
+                    # Already shown: move its row to the top
+                    self.history_listbox.delete(row)
+                    self.history_rows.pop(row)
                 self.history_listbox.insert(0, item)
+                self.history_rows.push_front(key)
+                # Evicted entries are always the oldest, i.e. the last rows
+                for _key in evicted:
+                    self.history_listbox.delete(tk.END)
+                    self.history_rows.pop_back()
+            if searching and changed:
+                self.render_history()
         finally:
             self.root.after(100, self.process_queue)
 
     def copy_history_selection(self, event):
         selected_indices = self.history_listbox.curselection()
         if not selected_indices: return
-        selected_item = self.history_listbox.get(selected_indices[0])
+        selected_item = self.history.get(self.history_rows.key(selected_indices[0]))['text']
         pyperclip.copy(selected_item)
         self.status_var.set(f"已複製歷史: {selected_item[:60]}...")
         self.root.after(3000, self.clear_status)
 
     def clear_history(self):
         if messagebox.askyesno("確認", "您確定要清除所有歷史記錄嗎？"):
+            self.history.clear()
+            self.history_rows.reset([])
             self.history_listbox.delete(0, tk.END)
-            self.save_history()
+            self.journal_history("clear")
             self.status_var.set("歷史記錄已清除。")
             self.root.after(3000, self.clear_status)
 
     def clear_selected_history_item(self):
         selected_indices = self.history_listbox.curselection()
         if not selected_indices: return
-        self.history_listbox.delete(selected_indices[0])
-        self.save_history()
+        row = selected_indices[0]
+        key = self.history_rows.pop(row)
+        self.history.remove(key)
+        self.history_listbox.delete(row)
+        self.journal_history("delete", key=key)
         self.status_var.set("已清除選取項目。")
         self.root.after(3000, self.clear_status)
 
     # --- Snippet Methods ---
     def load_snippets(self):
-        if not os.path.exists(self.snippets_file):
-            self.snippets = []
-            return
         try:
-            with open(self.snippets_file, 'r', encoding='utf-8') as f:
-                self.snippets = json.load(f)
-            self.populate_snippets_treeview()
-        except (json.JSONDecodeError, FileNotFoundError):
-            self.snippets = []
+            data, records = self.snippets_journal.load()
+        except OSError as e:
+            print(f"Error loading snippets: {e}")
+            data, records = None, []
+        self.snippets = data if isinstance(data, list) else []
+        for record in records:
+            self.apply_snippet_record(record)
+        self.index_snippets()
+        self.populate_snippets_treeview()
 
     def save_snippets(self):
+        # Compaction: write all snippets as a new snapshot and empty the journal
         try:
-            with open(self.snippets_file, 'w', encoding='utf-8') as f:
-                json.dump(self.snippets, f, ensure_ascii=False, indent=4)
+            self.snippets_journal.compact(self.snippets)
         except Exception as e:
             print(f"Error saving snippets: {e}")
 
+    def journal_snippet(self, op, **fields):
+        try:
+            self.snippets_journal.append(op, **fields)
+        except OSError as e:
+            print(f"Error writing snippets journal: {e}")
+
+    def apply_snippet_record(self, record):
+        # Replays one journal record: add (snippet), update (index, snippet) or delete (index)
+        op = record["op"]
+        if op == "add":
+            self.snippets.append(record["snippet"])
+        elif op == "update" and record["index"] < len(self.snippets):
+            self.snippets[record["index"]] = record["snippet"]
+        elif op == "delete" and record["index"] < len(self.snippets):
+            del self.snippets[record["index"]]
+
+    def index_snippet(self, index):
+        snippet = self.snippets[index]
+        # Rank by position so search results keep the list order
+        self.snippet_index.add(index, f"{snippet['keyword']}\n{snippet['content']}", -index)
+
+    def index_snippets(self):
+        # Deleting a snippet shifts the positions after it, so the (small) index is rebuilt
+        self.snippet_index.clear()
+        for i in range(len(self.snippets)):
+            self.index_snippet(i)
+
     def populate_snippets_treeview(self):
         for item in self.snippets_tree.get_children():
             self.snippets_tree.delete(item)
-        for i, snippet in enumerate(self.snippets):
+        query = self.snippets_search_var.get()
+        indices = self.snippet_index.search(query) if query.strip() else range(len(self.snippets))
+        for i in indices:
+            snippet = self.snippets[i]
             self.snippets_tree.insert("", tk.END, iid=i, values=(snippet['keyword'], snippet['content']))
 
     def add_snippet_dialog(self):
@@ -258,7 +375,8 @@ class ClipboardApp:
     def add_snippet_callback(self, snippet):
         if snippet:
             self.snippets.append(snippet)
-            self.save_snippets()
+            self.index_snippet(len(self.snippets) - 1)
+            self.journal_snippet("add", snippet=snippet)
             self.populate_snippets_treeview()
             self.status_var.set(f"已新增片段: {snippet['keyword']}")
             self.root.after(3000, self.clear_status)
@@ -275,7 +393,8 @@ class ClipboardApp:
     def edit_snippet_callback(self, index, snippet):
         if snippet:
             self.snippets[index] = snippet
-            self.save_snippets()
+            self.index_snippet(index)
+            self.journal_snippet("update", index=index, snippet=snippet)
             self.populate_snippets_treeview()
             self.status_var.set(f"已更新片段: {snippet['keyword']}")
             self.root.after(3000, self.clear_status)
@@ -288,7 +407,8 @@ class ClipboardApp:
         if messagebox.askyesno("確認刪除", "您確定要刪除所選的片段嗎？"):
             snippet_index = int(selected_item)
             del self.snippets[snippet_index]
-            self.save_snippets()
+            self.index_snippets()
+            self.journal_snippet("delete", index=snippet_index)
             self.populate_snippets_treeview()
             self.status_var.set("片段已刪除。")
             self.root.after(3000, self.clear_status)
@@ -0,0 +1,312 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+import pyperclip
+
+# How long a backend may block before the watcher re-checks its stop flag (seconds)
+WAIT_TIMEOUT = 0.5
+# Adaptive polling: start at the fast interval after a change, slow down while idle
+POLL_MIN_INTERVAL = 0.25
+POLL_MAX_INTERVAL = 2.0
+POLL_BACKOFF = 1.5
+# Windows: how often the clipboard sequence number is checked (no clipboard access involved)
+SEQUENCE_CHECK_INTERVAL = 0.1
+
+
+class ClipboardBackend:
+    """
+    A source of clipboard change notifications.
+    wait(timeout) blocks until the clipboard may have changed (returns True) or the timeout
+    expires (returns False); read() returns the current clipboard text.
+    """
+    name = "base"
+
+    def wait(self, timeout):
+        raise NotImplementedError
+
+    def read(self):
+        return pyperclip.paste()
+
+    def close(self):
+        pass
+
+
+class PollingBackend(ClipboardBackend):
+    """
+    Fallback that reads the clipboard periodically. The interval grows while nothing is
+    copied and drops back to the minimum as soon as a change is seen. wait() never sleeps
+    longer than its timeout; it returns early without reading when the next poll is not due.
+    """
+    name = "polling"
+
+    def __init__(self, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self._stop = threading.Event()
+        self._last = self._paste()
+        self._next_poll = time.monotonic() + self.interval
+
+    @staticmethod
+    def _paste():
+        try:
+            return pyperclip.paste()
+        except Exception:
+            return None  # Ignore pyperclip errors on certain content
+
+    def wait(self, timeout):
+        if self._stop.wait(min(max(self._next_poll - time.monotonic(), 0), timeout)):
+            return False
+        if time.monotonic() < self._next_poll:
+            return False
+        text = self._paste()
+        if text != self._last:
+            self._last = text
+            self.interval = self.min_interval
+            self._next_poll = time.monotonic() + self.interval
+            return True
+        self.interval = min(self.interval * POLL_BACKOFF, self.max_interval)
+        self._next_poll = time.monotonic() + self.interval
+        return False
+
+    def read(self):
+        return self._last
+
+    def close(self):
+        self._stop.set()
+
+
+class WindowsSequenceBackend(ClipboardBackend):
+    """
+    Windows: watches GetClipboardSequenceNumber(), which changes on every copy.
+    Checking it does not open the clipboard, so the text is only read after a real change.
+    """
+    name = "windows"
+
+    def __init__(self):
+        if sys.platform != "win32":
+            raise OSError("not running on Windows")
+        self._user32 = ctypes.windll.user32
+        self._user32.GetClipboardSequenceNumber.restype = ctypes.c_uint32
+        self._sequence = self._user32.GetClipboardSequenceNumber()
+
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            sequence = self._user32.GetClipboardSequenceNumber()
+            if sequence != self._sequence:
+                self._sequence = sequence
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(SEQUENCE_CHECK_INTERVAL)
+
+
+class X11Backend(ClipboardBackend):
+    """
+    X11: asks the XFixes extension for a SelectionNotify event whenever the CLIPBOARD
+    owner changes, and sleeps in select() on the X connection in between.
+    """
+    name = "x11"
+
+    # XFixesSetSelectionOwnerNotifyMask
+    _OWNER_NOTIFY_MASK = 1
+
+    def __init__(self):
+        if not os.environ.get("DISPLAY"):
+            raise OSError("DISPLAY is not set")
+        x11_path = ctypes.util.find_library("X11")
+        xfixes_path = ctypes.util.find_library("Xfixes")
+        if not x11_path or not xfixes_path:
+            raise OSError("libX11/libXfixes not found")
+        x11 = ctypes.cdll.LoadLibrary(x11_path)
+        xfixes = ctypes.cdll.LoadLibrary(xfixes_path)
+
+        x11.XOpenDisplay.restype = ctypes.c_void_p
+        x11.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        x11.XDefaultRootWindow.restype = ctypes.c_ulong
+        x11.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+        x11.XInternAtom.restype = ctypes.c_ulong
+        x11.XInternAtom.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int]
+        x11.XConnectionNumber.argtypes = [ctypes.c_void_p]
+        x11.XPending.argtypes = [ctypes.c_void_p]
+        x11.XNextEvent.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        x11.XFlush.argtypes = [ctypes.c_void_p]
+        x11.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        xfixes.XFixesQueryExtension.argtypes = [
+            ctypes.c_void_p, ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int)]
+        xfixes.XFixesSelectSelectionInput.argtypes = [
+            ctypes.c_void_p, ctypes.c_ulong, ctypes.c_ulong, ctypes.c_ulong]
+
+        display = x11.XOpenDisplay(None)
+        if not display:
+            raise OSError("cannot open X display")
+        event_base, error_base = ctypes.c_int(), ctypes.c_int()
+        if not xfixes.XFixesQueryExtension(display, ctypes.byref(event_base), ctypes.byref(error_base)):
+            x11.XCloseDisplay(display)
+            raise OSError("XFixes extension not available")
+
+        clipboard = x11.XInternAtom(display, b"CLIPBOARD", 0)
+        xfixes.XFixesSelectSelectionInput(display, x11.XDefaultRootWindow(display), clipboard,
+                                          self._OWNER_NOTIFY_MASK)
+        x11.XFlush(display)
+
+        self._x11 = x11
+        self._display = display
+        # close() may be called from another thread while wait() is in select()
+        self._lock = threading.Lock()
+        self._fd = x11.XConnectionNumber(display)
+        # XEvent is a union padded to 24 longs
+        self._event = ctypes.create_string_buffer(24 * ctypes.sizeof(ctypes.c_long))
+
+    def wait(self, timeout):
+        with self._lock:
+            if not self._display:
+                return False
+            pending = self._x11.XPending(self._display)
+        if not pending:
+            readable, _, _ = select.select([self._fd], [], [], timeout)
+            if not readable:
+                return False
+        changed = False
+        with self._lock:
+            # The only events selected on this connection are clipboard owner changes
+            while self._display and self._x11.XPending(self._display):
+                self._x11.XNextEvent(self._display, self._event)
+                changed = True
+        return changed
+
+    def close(self):
+        with self._lock:
+            if self._display:
+                self._x11.XCloseDisplay(self._display)
+                self._display = None
+
+
+class WaylandBackend(ClipboardBackend):
+    """
+    Wayland: runs `wl-paste --watch` (wl-clipboard, using the data-control protocol), which
+    prints a line every time the clipboard changes.
+    """
+    name = "wayland"
+
+    def __init__(self):
+        if not os.environ.get("WAYLAND_DISPLAY"):
+            raise OSError("WAYLAND_DISPLAY is not set")
+        if not shutil.which("wl-paste"):
+            raise OSError("wl-paste not found (install wl-clipboard)")
+        self._process = subprocess.Popen(
+            ["wl-paste", "--watch", "echo", "changed"],
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self._fd = self._process.stdout.fileno()
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return False
+        if not os.read(self._fd, 4096):
+            raise OSError("wl-paste --watch exited")
+        # Spurious wake-ups (e.g. the report for the current content at start-up) are
+        # harmless: the watcher ignores text it has already seen
+        return True
+
+    def close(self):
+        if self._process.poll() is None:
+            self._process.terminate()
+        self._process.stdout.close()
+
+
+class FakeBackend(ClipboardBackend):
+    """In-memory clipboard for tests: copy() changes the content and wakes the watcher."""
+    name = "fake"
+
+    def __init__(self, text=""):
+        self._text = text
+        self._changed = threading.Event()
+
+    def copy(self, text):
+        self._text = text
+        self._changed.set()
+
+    def wait(self, timeout):
+        if self._changed.wait(timeout):
+            self._changed.clear()
+            return True
+        return False
+
+    def read(self):
+        return self._text
+
+
+# Native backends in order of preference; the first one that can be created is used
+NATIVE_BACKENDS = (WindowsSequenceBackend, WaylandBackend, X11Backend)
+
+
+def create_backend():
+    """Returns the best available backend, falling back to adaptive polling."""
+    for backend_class in NATIVE_BACKENDS:
+        try:
+            return backend_class()
+        except (OSError, AttributeError):
+            continue
+    return PollingBackend()
+
+
+class ClipboardWatcher:
+    """
+    Calls on_change(text) from a background thread whenever new text is copied.
+    If a native backend fails while running, the watcher switches to polling.
+    """
+
+    def __init__(self, on_change, backend=None):
+        self.on_change = on_change
+        self.backend = backend or create_backend()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last = None
+
+    def start(self):
+        self._last = self._read()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        # Wakes a polling wait right away; the thread closes the backend again on exit
+        self.backend.close()
+        if self._thread:
+            self._thread.join(timeout=WAIT_TIMEOUT * 2)
+
+    def _read(self):
+        try:
+            return self.backend.read()
+        except Exception:
+            return None  # Ignore pyperclip errors on certain content
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                try:
+                    changed = self.backend.wait(WAIT_TIMEOUT)
+                except OSError as e:
+                    if self._stop.is_set():
+                        break  # stop() closed the backend under us
+                    print(f"Clipboard backend '{self.backend.name}' failed ({e}), falling back to polling")
+                    self.backend.close()
+                    self.backend = PollingBackend()
+                    continue
+                if not changed:
+                    continue
+                text = self._read()
+                if text and isinstance(text, str) and text != self._last:
+                    self._last = text
+                    self.on_change(text)
+        finally:
+            self.backend.close()
@@ -0,0 +1,212 @@
+import bisect
+import hashlib
+import math
+import time
+from collections import OrderedDict
+
+from search_index import SearchIndex
+
+# History limits: entries beyond the count, or not copied again within the age, are dropped
+HISTORY_MAX_ENTRIES = 50000
+HISTORY_MAX_AGE = 90 * 24 * 60 * 60  # seconds; None keeps entries forever
+# Search ranking: each doubling of an entry's copy count is worth this much recency
+FRECENCY_HALF_LIFE = 7 * 24 * 60 * 60  # seconds
+
+
+def content_key(text):
+    """Stable key for a clip: the SHA-1 of its UTF-8 text."""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def frecency(entry):
+    """
+    Search rank of an entry, combining recency and frequency. Equivalent to hits decaying
+    by half every FRECENCY_HALF_LIFE, but expressed so that it only changes when the entry
+    is copied again, not as time passes.
+    """
+    return entry["last_seen"] + FRECENCY_HALF_LIFE * math.log2(entry["hits"])
+
+
+class ClipboardHistory:
+    """
+    Clipboard history keyed by content hash, kept in recency order (oldest first internally).
+    Each entry is a dict with text, first_seen, last_seen and hits. Adding a clip that is
+    already known moves it to the front and bumps its hit count, so dedupe is O(1).
+    The full-text index is built on the first search and kept up to date from then on.
+    """
+
+    def __init__(self, max_entries=HISTORY_MAX_ENTRIES, max_age=HISTORY_MAX_AGE):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._entries = OrderedDict()
+        self._index = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def keys(self):
+        """Keys from newest to oldest."""
+        return list(reversed(self._entries))
+
+    def entries(self):
+        """(key, entry) pairs from newest to oldest."""
+        return [(key, self._entries[key]) for key in reversed(self._entries)]
+
+    def add(self, text, now=None):
+        """Records a copy of text. Returns (key, is_new)."""
+        now = time.time() if now is None else now
+        key = content_key(text)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = {"text": text, "first_seen": now, "last_seen": now, "hits": 1}
+            if self._index is not None:
+                self._index.add(key, text, frecency(entry))
+            return key, True
+        entry["last_seen"] = now
+        entry["hits"] += 1
+        self._entries.move_to_end(key)
+        if self._index is not None:
+            self._index.set_rank(key, frecency(entry))
+        return key, False
+
+    def restore(self, entry):
+        """Appends a saved entry as the newest one, without counting a new copy. Returns its key."""
+        key = content_key(entry["text"])
+        entry = self._entries[key] = dict(entry)
+        self._entries.move_to_end(key)
+        if self._index is not None:
+            self._index.add(key, entry["text"], frecency(entry))
+        return key
+
+    def remove(self, key):
+        if self._index is not None:
+            self._index.remove(key)
+        return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        self._entries.clear()
+        self._index = None
+
+    def search(self, query, limit=None):
+        """Keys of the entries matching query, best match (by frecency) first."""
+        if self._index is None:
+            self._index = SearchIndex()
+            for key, entry in self._entries.items():
+                self._index.add(key, entry["text"], frecency(entry))
+        return self._index.search(query, limit)
+
+    def evict(self, now=None):
+        """Drops entries over the size limit or older than max_age. Returns the evicted keys, oldest first."""
+        now = time.time() if now is None else now
+        evicted = []
+        while len(self._entries) > self.max_entries:
+            evicted.append(self._entries.popitem(last=False)[0])
+        if self.max_age is not None:
+            cutoff = now - self.max_age
+            # Entries are ordered by last_seen, so only the oldest end needs checking
+            while self._entries:
+                key, entry = next(iter(self._entries.items()))
+                if entry["last_seen"] >= cutoff:
+                    break
+                del self._entries[key]
+                evicted.append(key)
+        if self._index is not None:
+            for key in evicted:
+                self._index.remove(key)
+        return evicted
+
+    def apply(self, record):
+        """Replays one journal record: add (entry), move (key, last_seen, hits), delete (key) or clear."""
+        op = record["op"]
+        if op == "add":
+            self.restore(record["entry"])
+        elif op == "move":
+            entry = self._entries.get(record["key"])
+            if entry is not None:
+                entry["last_seen"] = record["last_seen"]
+                entry["hits"] = record["hits"]
+                self._entries.move_to_end(record["key"])
+                if self._index is not None:
+                    self._index.set_rank(record["key"], frecency(entry))
+        elif op == "delete":
+            self.remove(record["key"])
+        elif op == "clear":
+            self.clear()
+
+    def to_list(self):
+        """Entries from newest to oldest, ready for JSON."""
+        return [dict(entry) for _key, entry in self.entries()]
+
+    def load_list(self, items, now=None):
+        """
+        Replaces the history with a saved list (newest first). Accepts the current
+        entry dicts as well as the old format, a plain list of strings.
+        """
+        now = time.time() if now is None else now
+        self.clear()
+        for item in reversed(items):
+            if isinstance(item, str):
+                item = {"text": item, "first_seen": now, "last_seen": now, "hits": 1}
+            if not item.get("text"):
+                continue
+            self.restore(item)
+        self.evict(now)
+
+
+class HistoryRows:
+    """
+    The keys shown in the history Listbox, top row first.
+    Rows are stored newest-last, each with an increasing sequence number, so finding a
+    key's row is a dict lookup plus a bisect instead of a scan over every row.
+    """
+
+    def __init__(self, keys=()):
+        self.reset(keys)
+
+    def reset(self, keys):
+        """Replaces the rows with keys, top row first."""
+        self._keys = list(reversed(keys))
+        self._seqs = list(range(len(self._keys)))
+        self._seq_of = {key: seq for seq, key in enumerate(self._keys)}
+        self._next_seq = len(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._seq_of
+
+    def key(self, row):
+        return self._keys[len(self._keys) - 1 - row]
+
+    def row(self, key):
+        """Listbox row of key, or None if it is not shown."""
+        seq = self._seq_of.get(key)
+        if seq is None:
+            return None
+        return len(self._keys) - 1 - bisect.bisect_left(self._seqs, seq)
+
+    def push_front(self, key):
+        """Shows key as the new top row."""
+        self._keys.append(key)
+        self._seqs.append(self._next_seq)
+        self._seq_of[key] = self._next_seq
+        self._next_seq += 1
+
+    def pop(self, row):
+        """Removes the given row and returns its key."""
+        index = len(self._keys) - 1 - row
+        key = self._keys.pop(index)
+        del self._seqs[index]
+        del self._seq_of[key]
+        return key
+
+    def pop_back(self):
+        """Removes the bottom row and returns its key."""
+        return self.pop(len(self._keys) - 1)
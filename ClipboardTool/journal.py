@@ -0,0 +1,146 @@
+import json
+import os
+import time
+
+# The journal lives next to its snapshot file, e.g. clipboard_history.json.journal
+JOURNAL_SUFFIX = ".journal"
+# Appended records reach the OS right away; fsync runs once per batch or interval
+JOURNAL_FSYNC_BATCH = 32
+JOURNAL_FSYNC_INTERVAL = 1.0  # seconds
+# Fold the journal into a new snapshot once it holds this many records, or more than this many
+# records per item in the document (mostly superseded records; a rewrite is cheaper than replaying them)
+JOURNAL_COMPACT_RECORDS = 1000
+JOURNAL_COMPACT_RATIO = 2
+SNAPSHOT_VERSION = 1
+
+
+class Journal:
+    """
+    Append-only persistence for one JSON document.
+    Every change is appended to the journal as one JSON line with an increasing sequence
+    number; compact() writes the whole document as a snapshot (tagged with the last sequence
+    number it contains) and empties the journal. load() returns the snapshot plus the records
+    written after it, which the caller replays. A record torn by a crash is dropped.
+    """
+
+    def __init__(self, path, fsync_batch=JOURNAL_FSYNC_BATCH, fsync_interval=JOURNAL_FSYNC_INTERVAL,
+                 compact_records=JOURNAL_COMPACT_RECORDS, compact_ratio=JOURNAL_COMPACT_RATIO):
+        self.path = path
+        self.journal_path = path + JOURNAL_SUFFIX
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self.compact_records = compact_records
+        self.compact_ratio = compact_ratio
+        self.seq = 0
+        self.pending = 0  # records in the journal that are not in the snapshot yet
+        self._file = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def load(self):
+        """Returns (snapshot data or None, records to replay in order)."""
+        data, snapshot_seq = None, 0
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    raw = json.load(f)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                raw = None
+            if isinstance(raw, dict) and raw.get("version") == SNAPSHOT_VERSION:
+                data, snapshot_seq = raw.get("data"), raw.get("seq", 0)
+            else:
+                data = raw  # Files written before the journal existed hold the plain document
+
+        records = []
+        if os.path.exists(self.journal_path):
+            good_size = 0
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("incomplete record")
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    good_size += len(line)
+                    # Records already folded into the snapshot (compaction interrupted
+                    # before the journal was emptied) are skipped
+                    if record["seq"] > snapshot_seq:
+                        records.append(record)
+            if good_size < os.path.getsize(self.journal_path):
+                # Cut off the torn tail so new records are not appended after it
+                with open(self.journal_path, 'r+b') as f:
+                    f.truncate(good_size)
+
+        self.seq = records[-1]["seq"] if records else snapshot_seq
+        self.pending = len(records)
+        return data, records
+
+    def append(self, op, **fields):
+        """Appends one record; it is fsynced with the current batch."""
+        if self._file is None:
+            self._file = open(self.journal_path, 'ab')
+        self.seq += 1
+        record = {"seq": self.seq, "op": op, **fields}
+        self._file.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b"\n")
+        self._file.flush()
+        self.pending += 1
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_batch or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        """Forces appended records to disk."""
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def needs_compaction(self, size=None):
+        """
+        True once the journal holds compact_records records or, given the number of items in
+        the document, more than compact_ratio records per item. Compacting at that point keeps
+        the rewrite cost proportional to the records appended since the last snapshot.
+        """
+        if self.pending >= self.compact_records:
+            return True
+        return size is not None and self.pending > max(size, 1) * self.compact_ratio
+
+    def compact(self, data):
+        """Writes data as the new snapshot and empties the journal."""
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({"version": SNAPSHOT_VERSION, "seq": self.seq, "data": data}, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        _fsync_dir(os.path.dirname(os.path.abspath(self.path)))
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        with open(self.journal_path, 'wb'):
+            pass
+        self.pending = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        self.sync()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _fsync_dir(path):
+    # Makes the snapshot rename durable; directories cannot be opened on Windows
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
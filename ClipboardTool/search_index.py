@@ -0,0 +1,218 @@
+import bisect
+import heapq
+import re
+
+# Scripts written without spaces between words: Hiragana/Katakana, CJK ideographs, Hangul
+_CJK_CHARS = "぀-ヿ㐀-䶿一-鿿가-힯豈-﫿"
+_CJK_RUN = f"[{_CJK_CHARS}]+"
+# Other words: runs of letters/digits that are not CJK
+_TOKEN_RE = re.compile(f"({_CJK_RUN})|([^\\W_{_CJK_CHARS}]+)")
+# With more than limit * this many candidate matches, search() walks the documents in rank
+# order instead of ranking every match
+RANK_WALK_FACTOR = 8
+
+
+def _tokenize(text):
+    """Returns (Latin-style words, CJK terms)."""
+    words = set()
+    cjk_terms = set()
+    for cjk, word in _TOKEN_RE.findall(text):
+        if word:
+            words.add(word.casefold())
+            continue
+        cjk_terms.update(cjk)
+        cjk_terms.update(cjk[i:i + 2] for i in range(len(cjk) - 1))
+    return words, cjk_terms
+
+
+def tokenize(text):
+    """
+    Splits text into index terms. Latin-style words become lowercase terms; CJK runs,
+    which have no spaces, become their characters plus every overlapping bigram, so
+    "剪貼簿" is indexed as 剪, 貼, 簿, 剪貼 and 貼簿.
+    """
+    words, cjk_terms = _tokenize(text)
+    return words | cjk_terms
+
+
+def query_terms(query):
+    """
+    Returns (terms every match must contain, prefix or None). The last Latin word is a
+    prefix when the query does not end in whitespace, so results update as you type.
+    A CJK run of two or more characters is matched through its bigrams only.
+    """
+    terms = []
+    prefix = None
+    matches = list(_TOKEN_RE.finditer(query))
+    for match in matches:
+        cjk, word = match.groups()
+        if word:
+            word = word.casefold()
+            if match is matches[-1] and match.end() == len(query):
+                prefix = word
+            else:
+                terms.append(word)
+        elif len(cjk) == 1:
+            terms.append(cjk)
+        else:
+            terms.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+    return terms, prefix
+
+
+class SearchIndex:
+    """
+    Inverted index from term to the set of document ids containing it, updated one
+    document at a time. Each document has a rank; search() returns the matching ids
+    with the highest rank first.
+    Latin words are also kept in a sorted vocabulary for prefix lookups. New words are
+    sorted in lazily at the next prefix query, and words whose documents are all gone
+    are pruned once they make up half of the vocabulary.
+    Queries matching a large share of the documents (a one-letter prefix, a common word)
+    walk a cached rank-ordered list of all documents and stop at the limit.
+    """
+
+    def __init__(self):
+        self._postings = {}
+        self._doc_terms = {}
+        self._ranks = {}
+        self._vocabulary = []
+        self._in_vocabulary = set()
+        self._unsorted = []
+        self._dead = 0
+        self._by_rank = None
+
+    def __len__(self):
+        return len(self._doc_terms)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._doc_terms
+
+    def add(self, doc_id, text, rank=0):
+        """Indexes (or re-indexes) a document."""
+        if doc_id in self._doc_terms:
+            self.remove(doc_id)
+        words, cjk_terms = _tokenize(text)
+        self._doc_terms[doc_id] = words | cjk_terms
+        self._ranks[doc_id] = rank
+        self._by_rank = None
+        postings = self._postings
+        for term in cjk_terms:
+            docs = postings.get(term)
+            if docs is None:
+                docs = postings[term] = set()
+            docs.add(doc_id)
+        for term in words:
+            docs = postings.get(term)
+            if docs is None:
+                docs = postings[term] = set()
+                self._add_to_vocabulary(term)
+            docs.add(doc_id)
+
+    def set_rank(self, doc_id, rank):
+        if doc_id in self._ranks:
+            self._ranks[doc_id] = rank
+            self._by_rank = None
+
+    def remove(self, doc_id):
+        terms = self._doc_terms.pop(doc_id, None)
+        if terms is None:
+            return False
+        del self._ranks[doc_id]
+        self._by_rank = None
+        for term in terms:
+            docs = self._postings[term]
+            docs.discard(doc_id)
+            if not docs:
+                del self._postings[term]
+                if term in self._in_vocabulary:
+                    self._dead += 1
+        return True
+
+    def clear(self):
+        self.__init__()
+
+    def _add_to_vocabulary(self, word):
+        if word in self._in_vocabulary:
+            self._dead -= 1  # Was dead, has documents again
+        else:
+            self._in_vocabulary.add(word)
+            self._unsorted.append(word)
+
+    def _prefix_terms(self, prefix):
+        if self._dead > len(self._in_vocabulary) // 2:
+            self._in_vocabulary = {term for term in self._in_vocabulary if term in self._postings}
+            self._vocabulary = sorted(self._in_vocabulary)
+            self._unsorted = []
+            self._dead = 0
+        elif self._unsorted:
+            # Timsort merges the new tail into the already sorted list in linear time
+            self._vocabulary.extend(self._unsorted)
+            self._vocabulary.sort()
+            self._unsorted = []
+        start = bisect.bisect_left(self._vocabulary, prefix)
+        end = bisect.bisect_left(self._vocabulary, prefix + "\U0010ffff", start)
+        return [term for term in self._vocabulary[start:end] if term in self._postings]
+
+    def _ranked(self):
+        if self._by_rank is None:
+            # Ranks mostly arrive in increasing order, which Timsort handles in near-linear time
+            self._by_rank = sorted(self._ranks, key=self._ranks.__getitem__, reverse=True)
+        return self._by_rank
+
+    def _walk(self, docs, words, limit):
+        """The best-ranked documents that are in docs (if given) and contain one of words (if given)."""
+        found = []
+        for doc_id in self._ranked():
+            if docs is not None and doc_id not in docs:
+                continue
+            if words is not None and self._doc_terms[doc_id].isdisjoint(words):
+                continue
+            found.append(doc_id)
+            if len(found) == limit:
+                break
+        return found
+
+    def search(self, query, limit=None):
+        """Ids of the documents matching every query term, highest rank first."""
+        terms, prefix = query_terms(query)
+        if not terms and not prefix:
+            return []
+        postings = []
+        for term in terms:
+            docs = self._postings.get(term)
+            if not docs:
+                return []
+            postings.append(docs)
+        postings.sort(key=len)
+        matches = postings[0].intersection(*postings[1:]) if postings else None
+
+        prefixed = words = None
+        if prefix:
+            words = self._prefix_terms(prefix)
+            if not words:
+                return []
+            prefixed = [self._postings[word] for word in words]
+            # Upper bound on the number of documents containing one of the words
+            candidates = sum(map(len, prefixed))
+            if matches is not None:
+                candidates = min(candidates, len(matches))
+        else:
+            candidates = len(matches)
+
+        if limit is not None and candidates > limit * RANK_WALK_FACTOR:
+            return self._walk(matches, set(words) if words else None, limit)
+
+        if prefixed:
+            if matches is None:
+                matches = set().union(*prefixed)
+            elif len(matches) < len(words):
+                # Few exact matches but a short prefix: check each match's words instead
+                words = set(words)
+                matches = {doc_id for doc_id in matches if not self._doc_terms[doc_id].isdisjoint(words)}
+            else:
+                # Narrow each prefix word's documents by the (usually much smaller) exact matches
+                matches = set().union(*(matches.intersection(docs) for docs in prefixed))
+
+        if limit is not None and limit < len(matches):
+            return heapq.nlargest(limit, matches, key=self._ranks.__getitem__)
+        return sorted(matches, key=self._ranks.__getitem__, reverse=True)
@@ -0,0 +1,138 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import core
+from quote_providers import ReplayProvider
+
+# --- 常數設定 ---
+# 要量測的監控清單大小
+BENCHMARK_SIZES = (10, 100, 1000, 10000)
+# 每種大小連續執行的檢查次數 (第一次沒有快取，之後多數價格來自快取)
+BENCHMARK_ROUNDS = 2
+# 模擬每次報價請求的網路延遲 (秒)
+BENCHMARK_LATENCY = 0.05
+# 啟動時匯入各模組的時間上限 (毫秒)；yfinance/pandas 等套件不應在啟動時載入
+IMPORT_BUDGET_MS = 300
+IMPORT_MODULES = ('core', 'gui', 'server')
+LAZY_MODULES = ('yfinance', 'pandas', 'requests')
+
+def synthetic_quotes(count, steps=20, seed=0):
+    """產生 count 支假股票的隨機漫步報價，回傳 {股票代號: [價格, ...]}"""
+    rng = np.random.default_rng(seed)
+    start = rng.uniform(10, 1000, size=count)
+    moves = rng.normal(0, 0.01, size=(count, steps)).cumsum(axis=1)
+    prices = np.round(start[:, None] * np.exp(moves), 2)
+    return {f"{i:05d}.TW": prices[i].tolist() for i in range(count)}
+
+def synthetic_stocks(quotes):
+    """依報價建立監控清單，目標價設在起始價附近，讓一部分規則會觸發"""
+    stocks = []
+    for i, (symbol, series) in enumerate(quotes.items()):
+        condition = '>=' if i % 2 else '<='
+        stocks.append({
+            'symbol': symbol,
+            'name': '',
+            'condition': condition,
+            'target_price': round(series[0] * (1.005 if condition == '>=' else 0.995), 2),
+        })
+    return stocks
+
+def run_benchmark(size, rounds=BENCHMARK_ROUNDS, latency=BENCHMARK_LATENCY, recording=None):
+    """
+    以 size 支股票執行 rounds 次完整檢查 (查價、規則評估、寫入快取/歷史/狀態)
+    recording 為錄製檔路徑時改用錄製的報價 (取前 size 支)，否則使用隨機產生的報價。
+    回傳每次檢查的摘要，並加上 peak_mb (該次檢查的記憶體用量峰值)
+    """
+    if recording:
+        recorded = ReplayProvider(recording)
+        quotes = dict(list(recorded.quotes.items())[:size])
+    else:
+        quotes = synthetic_quotes(size)
+    stocks = synthetic_stocks(quotes)
+    core.set_quote_provider(ReplayProvider(quotes=quotes, latency=latency))
+    dispatcher = core.NotificationDispatcher([])
+
+    results = []
+    for _ in range(rounds):
+        tracemalloc.start()
+        core.run_alert_sweep(stocks, dispatcher)
+        _current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        summary = dict(core.sweep_timer.last_summary)
+        summary['peak_mb'] = peak / (1024 * 1024)
+        results.append(summary)
+        dispatcher.flush(force=True)
+    return results
+
+def print_results(size, results):
+    for round_index, summary in enumerate(results, 1):
+        stages = summary['stages']
+        print(f"{size:>6} {round_index:>3} {summary['duration']:>8.2f} "
+              f"{summary['p50_ms'] or 0:>8.0f} {summary['p95_ms'] or 0:>8.0f} {summary['p99_ms'] or 0:>8.0f} "
+              f"{summary['peak_mb']:>8.1f} "
+              f"{stages.get('fetch', 0):>8.2f} {stages.get('evaluate', 0):>8.3f} {stages.get('persist', 0):>8.2f}")
+
+def check_import_budget(modules=IMPORT_MODULES, budget_ms=IMPORT_BUDGET_MS):
+    """
+    在全新的 Python 行程中匯入各模組，檢查耗時是否在預算內，以及是否誤載入了應延遲載入的套件
+    全部通過時回傳 True
+    """
+    script = (
+        "import sys, time\n"
+        "started = time.perf_counter()\n"
+        "import {module}\n"
+        "elapsed = (time.perf_counter() - started) * 1000\n"
+        f"loaded = [name for name in {LAZY_MODULES!r} if name in sys.modules]\n"
+        "print(elapsed, ','.join(loaded))\n"
+    )
+    here = os.path.dirname(os.path.abspath(__file__))
+    passed = True
+    for module in modules:
+        result = subprocess.run([sys.executable, '-c', script.format(module=module)],
+                                cwd=here, capture_output=True, text=True)
+        if result.returncode != 0:
+            print(f"{module}: 匯入失敗\n{result.stderr.strip()}")
+            passed = False
+            continue
+        fields = result.stdout.strip().splitlines()[-1].split(' ')
+        elapsed, loaded = float(fields[0]), (fields[1] if len(fields) > 1 else '')
+        ok = elapsed <= budget_ms and not loaded
+        passed = passed and ok
+        note = f"，啟動時載入了 {loaded}" if loaded else ""
+        print(f"{module}: {elapsed:.0f} 毫秒 (上限 {budget_ms} 毫秒){note} -> {'通過' if ok else '未通過'}")
+    return passed
+
+def main(args):
+    if '--imports' in args:
+        sys.exit(0 if check_import_budget() else 1)
+
+    sizes = [int(arg) for arg in args if arg.isdigit()] or list(BENCHMARK_SIZES)
+    recording = args[args.index('--recording') + 1] if '--recording' in args[:-1] else None
+    if recording:
+        recording = os.path.abspath(recording)
+
+    print(f"{'股票數':>6} {'次':>3} {'總秒數':>8} {'p50ms':>8} {'p95ms':>8} {'p99ms':>8} "
+          f"{'峰值MB':>8} {'fetch':>8} {'evaluate':>8} {'persist':>8}")
+    # 在暫存資料夾中執行，不影響真實的快取、歷史與警示狀態
+    original_dir = os.getcwd()
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as workdir:
+            os.chdir(workdir)
+            # 每種大小都從全新的快取、歷史、斷路器、重試額度與隔離名單開始
+            core.reset_shared_state()
+            try:
+                print_results(size, run_benchmark(size, recording=recording))
+            finally:
+                core.reset_shared_state()
+                os.chdir(original_dir)
+
+if __name__ == '__main__':
+    started = time.perf_counter()
+    main(sys.argv[1:])
+    print(f"完成，共花費 {time.perf_counter() - started:.1f} 秒。")
@@ -1,11 +1,83 @@
 import sys
 import json
-import requests
-import yfinance as yf
-# from plyer import notification # 我們之後會啟用這個
+import math
+import time
+import sqlite3
+import threading
+import bisect
+import os
+import pickle
+import random
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from datetime import datetime, date, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+
+from history_store import PriceHistoryStore
+from quote_providers import make_provider
 
 # --- 常數設定 ---
 STOCKS_FILE = 'stocks.json'
+# 批次查詢時，每次向 yfinance 請求的股票數量上限
+BATCH_SIZE = 50
+# 單一次網路請求的逾時秒數
+REQUEST_TIMEOUT = 10
+# 報價來源 (yfinance / twse / replay)，可用環境變數 STOCKWATCHER_PROVIDER 指定，
+# 例如在沒有網路的環境以 replay 重播錄製好的報價
+QUOTE_PROVIDER = os.environ.get('STOCKWATCHER_PROVIDER', 'yfinance')
+# 並行查詢時的背景執行緒數量及每個工作的期限 (秒)；
+# 每個工作分派的股票數量為 min(BATCH_SIZE, 股票數 / MAX_WORKERS)，見 worker_chunk_size
+MAX_WORKERS = 8
+WORKER_DEADLINE = 30
+# 報價快取：磁碟檔案、各類資料的有效秒數，以及最多保留的筆數
+CACHE_FILE = 'quote_cache.db'
+CACHE_TTL = {
+    'price': 60,                 # 最新股價
+    'name': 7 * 24 * 60 * 60,    # 公司名稱 (longName)
+}
+CACHE_MAX_ENTRIES = 5000
+# 定時檢查：交易時間內的檢查間隔 (秒)，以及台股交易時間 (台北時間)
+CHECK_INTERVAL = 5 * 60
+TAIPEI_TZ = timezone(timedelta(hours=8))
+MARKET_OPEN = (9, 0)
+MARKET_CLOSE = (13, 30)
+# 台股清單 JSON 檔與預先建立好索引的二進位快取檔
+STOCK_LIST_FILE = 'tw_stock_list.json'
+STOCK_INDEX_FILE = 'tw_stock_list.pkl'
+STOCK_INDEX_VERSION = 1
+# 休市日清單檔案，內容為 ["2026-01-01", ...] 格式的日期列表
+MARKET_HOLIDAYS_FILE = 'market_holidays.json'
+# 監控清單變更後延遲多久才寫入檔案 (秒)，期間內的多次變更會合併成一次寫入
+WATCHLIST_SAVE_DELAY = 1.0
+# 警示：已觸發狀態的儲存檔，以及價位條件重新啟用前價格需回檔的百分比
+ALERT_STATE_FILE = 'alert_state.json'
+ALERT_HYSTERESIS_PCT = 0.5
+# 漲跌幅與均線條件需要的日 K 線，每個交易日下載一次；依最長的均線天數 (交易日) 決定下載期間
+DAILY_BARS_PERIODS = ((15, '1mo'), (45, '3mo'), (100, '6mo'), (200, '1y'))
+DAILY_BARS_MAX_PERIOD = '2y'
+# 通知：合併發送的間隔 (秒)、每分鐘最多發送的批次數，以及保留在記憶體中的通知數量
+NOTIFY_FLUSH_INTERVAL = 2
+NOTIFY_MAX_PER_MINUTE = 6
+ALERT_HISTORY_SIZE = 200
+# 通知管道：桌面通知 (需安裝 plyer)、寫入檔案 (每行一筆 JSON)、Webhook 網址 (None 表示不使用)
+NOTIFY_DESKTOP = True
+NOTIFY_LOG_FILE = 'alerts.log'
+NOTIFY_WEBHOOK_URL = None
+# 連線保護：連續失敗幾次後暫停對該主機的請求，以及暫停多久 (秒) 後再試探一次
+BREAKER_FAILURE_THRESHOLD = 3
+BREAKER_RESET_TIMEOUT = 60
+# 失敗重試的等待時間 (秒)：第 n 次重試最多等待 BACKOFF_BASE * 2^n 秒，上限 BACKOFF_MAX
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8
+# 重試額度：每次請求累積 RETRY_BUDGET_RATIO 次重試額度，最多累積 RETRY_BUDGET_MAX 次
+RETRY_BUDGET_RATIO = 0.2
+RETRY_BUDGET_MAX = 10
+# 隔離名單：報價來源正常回應、但連續 QUARANTINE_STRIKES 次查不到價格的股票 (例如已下市)，
+# 在 QUARANTINE_DURATION 秒內不再查詢
+QUARANTINE_FILE = 'quarantine.json'
+QUARANTINE_STRIKES = 3
+QUARANTINE_DURATION = 24 * 60 * 60
 
 # --- 資料處理函式 ---
 def load_stocks():
@@ -17,45 +89,847 @@ def load_stocks():
         # 如果檔案不存在或格式錯誤，回傳空清單
         return []
 
-def save_stocks(stocks):
-    """將股票清單存回 stocks.json"""
-    with open(STOCKS_FILE, 'w', encoding='utf-8') as f:
+def save_stocks(stocks, path=None):
+    """將股票清單存回 stocks.json (先寫暫存檔再取代，避免寫到一半時檔案損毀)"""
+    path = path or STOCKS_FILE
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
         json.dump(stocks, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, path)
+
+class Watchlist:
+    """
+    記憶體中的監控清單，以股票代號為鍵，並維持清單順序
+    - 查詢、新增、修改與上下移動都不需要重新讀檔
+    - 變更後延遲 save_delay 秒在背景執行緒寫檔，期間內的多次變更只寫一次
+    - reload_if_changed() 可偵測 stocks.json 是否被其他程式 (例如 CLI) 修改過
+    """
+    def __init__(self, path=None, save_delay=WATCHLIST_SAVE_DELAY):
+        self.path = path or STOCKS_FILE
+        self.save_delay = save_delay
+        self._lock = threading.RLock()
+        self._timer = None
+        self._dirty = False
+        self._file_stamp = None
+        self._load()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return None
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                stocks = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            # 如果檔案不存在或格式錯誤，視為空清單
+            stocks = []
+        with self._lock:
+            self._by_symbol = {stock['symbol']: stock for stock in stocks}
+            self._order = list(self._by_symbol)
+            self._positions = {symbol: i for i, symbol in enumerate(self._order)}
+            self._file_stamp = self._stat()
+
+    def __len__(self):
+        return len(self._order)
+
+    def __contains__(self, symbol):
+        return symbol in self._by_symbol
+
+    def get(self, symbol):
+        """取得指定股票的資料 (副本)，不存在時回傳 None"""
+        with self._lock:
+            stock = self._by_symbol.get(symbol)
+            return dict(stock) if stock else None
+
+    def stocks(self):
+        """依清單順序回傳所有股票資料的副本"""
+        with self._lock:
+            return [dict(self._by_symbol[symbol]) for symbol in self._order]
+
+    def add(self, stock):
+        """新增一支股票到清單最後，代號已存在時回傳 False"""
+        with self._lock:
+            if stock['symbol'] in self._by_symbol:
+                return False
+            self._by_symbol[stock['symbol']] = dict(stock)
+            self._positions[stock['symbol']] = len(self._order)
+            self._order.append(stock['symbol'])
+            self._changed()
+            return True
+
+    def update(self, symbol, /, **fields):
+        """
+        修改指定股票的欄位；若修改了 symbol，會保留在清單中的原位置
+        值為 None 的欄位會從股票資料中移除 (例如清除持股)
+        股票不存在或新代號已被其他股票使用時回傳 False
+        """
+        with self._lock:
+            stock = self._by_symbol.get(symbol)
+            if stock is None:
+                return False
+            new_symbol = fields.get('symbol', symbol)
+            if new_symbol != symbol:
+                if new_symbol in self._by_symbol:
+                    return False
+                position = self._positions.pop(symbol)
+                del self._by_symbol[symbol]
+                self._order[position] = new_symbol
+                self._positions[new_symbol] = position
+                self._by_symbol[new_symbol] = stock
+            for key, value in fields.items():
+                if value is None:
+                    stock.pop(key, None)
+                else:
+                    stock[key] = value
+            self._changed()
+            return True
+
+    def remove(self, symbols):
+        """刪除多支股票，回傳實際刪除的數量"""
+        with self._lock:
+            removed = [symbol for symbol in set(symbols) if symbol in self._by_symbol]
+            if not removed:
+                return 0
+            for symbol in removed:
+                del self._by_symbol[symbol]
+            self._order = [symbol for symbol in self._order if symbol in self._by_symbol]
+            self._positions = {symbol: i for i, symbol in enumerate(self._order)}
+            self._changed()
+            return len(removed)
+
+    def symbols_in_category(self, category):
+        """回傳屬於指定分類的股票代號"""
+        with self._lock:
+            return [symbol for symbol in self._order
+                    if self._by_symbol[symbol].get('category', '未分類') == category]
+
+    def move(self, symbol, direction):
+        """將股票與前 (direction=-1) 或後 (direction=1) 一支股票交換位置，無法移動時回傳 False"""
+        with self._lock:
+            position = self._positions.get(symbol)
+            if position is None:
+                return False
+            new_position = position + direction
+            if not (0 <= new_position < len(self._order)):
+                return False
+            other = self._order[new_position]
+            self._order[position], self._order[new_position] = other, symbol
+            self._positions[symbol], self._positions[other] = new_position, position
+            self._changed()
+            return True
+
+    def _changed(self):
+        self._dirty = True
+        if self._timer:
+            self._timer.cancel()
+        self._timer = threading.Timer(self.save_delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def flush(self):
+        """立即把尚未寫入的變更存檔"""
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty:
+                return
+            stocks = [self._by_symbol[symbol] for symbol in self._order]
+            try:
+                save_stocks(stocks, self.path)
+            except OSError as e:
+                print(f"錯誤：儲存監控清單時發生錯誤: {e}")
+                return
+            self._dirty = False
+            self._file_stamp = self._stat()
+
+    def reload_if_changed(self):
+        """
+        若 stocks.json 在上次讀寫後被其他程式修改，重新載入並回傳 True
+        尚有未寫入的變更時，以記憶體中的內容為準，不會重新載入
+        """
+        with self._lock:
+            if self._dirty or self._stat() == self._file_stamp:
+                return False
+            self._load()
+            return True
+
+# --- 報價快取 ---
+class QuoteCache:
+    """
+    股價與公司資訊的快取，記憶體中以 LRU 方式保存，並同步寫入 sqlite 檔案，
+    讓 GUI 與 CLI 在重新啟動後仍可共用尚未過期的資料。
+    - path: sqlite 檔案路徑，傳入 None 則只使用記憶體
+    - ttl: {資料類型: 有效秒數}，未指定的類型使用 CACHE_TTL
+    - max_entries: 最多保留的筆數，超過時淘汰最久未使用的資料
+    """
+    def __init__(self, path=CACHE_FILE, ttl=None, max_entries=CACHE_MAX_ENTRIES):
+        self.ttl = dict(CACHE_TTL)
+        if ttl:
+            self.ttl.update(ttl)
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (類型, 代號) -> (值, 抓取時間)
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            try:
+                self._db = sqlite3.connect(path, timeout=5, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS quotes ("
+                    " kind TEXT, symbol TEXT, value TEXT, fetched_at REAL, accessed_at REAL,"
+                    " PRIMARY KEY (kind, symbol))"
+                )
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(f"警告：無法開啟快取檔案 {path}: {e}，將只使用記憶體快取。")
+                self._db = None
+
+    def close(self):
+        """關閉 sqlite 檔案，之後只使用記憶體快取"""
+        with self._lock:
+            if self._db:
+                self._db.close()
+                self._db = None
+
+    def _is_fresh(self, kind, fetched_at, now):
+        return now - fetched_at <= self.ttl.get(kind, 0)
+
+    def get_many(self, kind, symbols):
+        """取得多筆尚未過期的快取資料，回傳 {代號: 值}，只包含命中的代號"""
+        now = time.time()
+        hits = {}
+        with self._lock:
+            misses = []
+            for symbol in symbols:
+                entry = self._entries.get((kind, symbol))
+                if entry and self._is_fresh(kind, entry[1], now):
+                    self._entries.move_to_end((kind, symbol))
+                    hits[symbol] = entry[0]
+                else:
+                    misses.append(symbol)
+
+            if self._db and misses:
+                try:
+                    for symbol in misses:
+                        row = self._db.execute(
+                            "SELECT value, fetched_at FROM quotes WHERE kind = ? AND symbol = ?",
+                            (kind, symbol),
+                        ).fetchone()
+                        if row and self._is_fresh(kind, row[1], now):
+                            value = json.loads(row[0])
+                            self._remember(kind, symbol, value, row[1])
+                            hits[symbol] = value
+                    if hits:
+                        self._db.executemany(
+                            "UPDATE quotes SET accessed_at = ? WHERE kind = ? AND symbol = ?",
+                            [(now, kind, symbol) for symbol in hits],
+                        )
+                        self._db.commit()
+                except (sqlite3.Error, ValueError) as e:
+                    print(f"警告：讀取快取時發生錯誤: {e}")
+        return hits
+
+    def get(self, kind, symbol):
+        """取得單筆快取資料，不存在或已過期時回傳 None"""
+        return self.get_many(kind, [symbol]).get(symbol)
+
+    def set_many(self, kind, values):
+        """寫入多筆資料，values 為 {代號: 值}，值為 None 的項目不會快取"""
+        now = time.time()
+        values = {symbol: value for symbol, value in values.items() if value is not None}
+        if not values:
+            return
+        with self._lock:
+            for symbol, value in values.items():
+                self._remember(kind, symbol, value, now)
+            if self._db:
+                try:
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO quotes VALUES (?, ?, ?, ?, ?)",
+                        [(kind, symbol, json.dumps(value, ensure_ascii=False), now, now)
+                         for symbol, value in values.items()],
+                    )
+                    # 磁碟上同樣只保留最近使用的 max_entries 筆
+                    self._db.execute(
+                        "DELETE FROM quotes WHERE rowid NOT IN ("
+                        " SELECT rowid FROM quotes ORDER BY accessed_at DESC LIMIT ?)",
+                        (self.max_entries,),
+                    )
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    print(f"警告：寫入快取時發生錯誤: {e}")
+
+    def set(self, kind, symbol, value):
+        """寫入單筆資料"""
+        self.set_many(kind, {symbol: value})
+
+    def invalidate(self, symbols, kinds=None):
+        """移除指定股票的快取資料；kinds 為 None 時移除所有類型"""
+        kinds = list(self.ttl) if kinds is None else list(kinds)
+        keys = [(kind, symbol) for kind in kinds for symbol in symbols]
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+            if self._db:
+                try:
+                    self._db.executemany("DELETE FROM quotes WHERE kind = ? AND symbol = ?", keys)
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    print(f"警告：清除快取時發生錯誤: {e}")
+
+    def _remember(self, kind, symbol, value, fetched_at):
+        self._entries[(kind, symbol)] = (value, fetched_at)
+        self._entries.move_to_end((kind, symbol))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+_quote_cache = None
+
+def get_quote_cache():
+    """取得 (必要時建立) 共用的報價快取"""
+    global _quote_cache
+    if _quote_cache is None:
+        _quote_cache = QuoteCache()
+    return _quote_cache
+
+# --- 股價歷史紀錄 ---
+_history_store = None
+
+def get_history_store():
+    """取得 (必要時建立) 共用的股價歷史資料庫"""
+    global _history_store
+    if _history_store is None:
+        _history_store = PriceHistoryStore()
+    return _history_store
+
+def record_quotes(prices, timestamp=None):
+    """將查到的報價 {股票代號: 價格} 寫入歷史資料庫，寫入失敗只會印出警告"""
+    try:
+        get_history_store().append_quotes(prices, timestamp)
+    except OSError as e:
+        print(f"警告：寫入股價歷史紀錄時發生錯誤: {e}")
+
+# --- 報價來源 ---
+_quote_provider = None
+
+def get_quote_provider():
+    """取得 (必要時依 QUOTE_PROVIDER 建立) 目前使用的報價來源"""
+    global _quote_provider
+    if _quote_provider is None:
+        _quote_provider = make_provider(QUOTE_PROVIDER)
+    return _quote_provider
+
+def set_quote_provider(provider):
+    """更換報價來源，例如測試時改用 ReplayProvider"""
+    global _quote_provider
+    _quote_provider = provider
+
+_bars_provider = None
+
+def get_bars_provider():
+    """日 K 線的來源：目前的報價來源支援時直接使用，否則改用 yfinance"""
+    global _bars_provider
+    provider = get_quote_provider()
+    if provider.supports_bars:
+        return provider
+    if _bars_provider is None:
+        _bars_provider = make_provider('yfinance')
+    return _bars_provider
+
+# --- 連線保護 ---
+class CircuitBreaker:
+    """
+    斷路器：連續失敗 failure_threshold 次後進入「斷開」狀態，reset_timeout 秒內的請求直接拒絕；
+    時間到後進入「半開」狀態，只放行一次試探請求，成功就恢復正常，失敗則再斷開一段時間。
+    """
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """是否可以發出請求"""
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                # 只讓一個請求試探，其他請求在結果出來前仍然拒絕
+                self.state = 'half_open'
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_MAX):
+    """第 attempt 次 (從 0 起算) 重試前的等待秒數：指數成長並加上隨機抖動，避免大家同時重試"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+class RetryBudget:
+    """
+    重試額度：每次請求累積 ratio 次重試額度，重試時扣除一次
+    上游整體故障時，重試次數最多只會是請求數的一定比例，不會倍增流量。
+    """
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, max_tokens=RETRY_BUDGET_MAX):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        """扣除一次重試額度，額度不足時回傳 False"""
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+class SymbolQuarantine:
+    """
+    查不到價格的股票隔離名單 (例如已下市或代號錯誤)
+    只記錄正常回應中沒有價格的股票；上游故障時報價來源會拋出例外，不會記到這裡。
+    連續失敗 strikes 次後隔離 duration 秒，期間不再查詢。名單會存到 path，重新啟動後仍然有效。
+    """
+    def __init__(self, path=QUARANTINE_FILE, strikes=QUARANTINE_STRIKES, duration=QUARANTINE_DURATION):
+        self.path = path
+        self.strikes = strikes
+        self.duration = duration
+        self._failures = defaultdict(int)
+        self._until = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self._until = {symbol: float(until) for symbol, until in json.load(f).items()}
+        except (FileNotFoundError, json.JSONDecodeError, AttributeError, TypeError, ValueError):
+            self._until = {}
+
+    def _save(self):
+        if not self.path:
+            return
+        try:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._until, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"警告：無法儲存隔離名單: {e}")
+
+    def is_quarantined(self, symbol, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            until = self._until.get(symbol)
+            return until is not None and until > now
+
+    def record(self, prices):
+        """依一批請求的結果 {股票代號: 價格} 更新失敗次數，回傳這次新隔離的股票"""
+        now = time.time()
+        newly = []
+        with self._lock:
+            for symbol, price in prices.items():
+                if price is not None:
+                    self._failures.pop(symbol, None)
+                    continue
+                self._failures[symbol] += 1
+                if self._failures[symbol] >= self.strikes:
+                    del self._failures[symbol]
+                    self._until[symbol] = now + self.duration
+                    newly.append(symbol)
+            if newly:
+                # 順便清掉已到期的項目
+                self._until = {symbol: until for symbol, until in self._until.items() if until > now}
+                self._save()
+        return newly
+
+    def symbols(self):
+        """回傳目前被隔離的股票代號"""
+        now = time.time()
+        with self._lock:
+            return sorted(symbol for symbol, until in self._until.items() if until > now)
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+_retry_budget = RetryBudget()
+_quarantine = None
+
+def get_circuit_breaker(host):
+    """取得 (必要時建立) 指定主機的斷路器"""
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker()
+        return _breakers[host]
+
+def get_symbol_quarantine():
+    """取得 (必要時建立) 共用的隔離名單"""
+    global _quarantine
+    if _quarantine is None:
+        _quarantine = SymbolQuarantine()
+    return _quarantine
+
+def resilience_stats():
+    """回傳各主機斷路器的狀態、剩餘重試額度與被隔離的股票"""
+    with _breakers_lock:
+        breakers = {host: breaker.state for host, breaker in _breakers.items()}
+    return {
+        'breakers': breakers,
+        'retry_tokens': round(_retry_budget.tokens, 1),
+        'quarantined': get_symbol_quarantine().symbols(),
+    }
+
+def _guarded_request(host, request, action):
+    """
+    透過 host 的斷路器與共用的重試額度執行 request()，回傳其結果
+    request() 拋出例外視為該主機故障，在重試額度內等待一段時間後重試；
+    斷路器斷開或重試額度用完時回傳 None
+    """
+    breaker = get_circuit_breaker(host)
+    _retry_budget.deposit()
+    attempt = 0
+    while breaker.allow():
+        try:
+            result = request()
+        except Exception as e:
+            print(f"錯誤：向 {host} {action}時發生錯誤: {e}")
+        else:
+            breaker.record_success()
+            return result
+        breaker.record_failure()
+        if not _retry_budget.withdraw():
+            break
+        time.sleep(backoff_delay(attempt))
+        attempt += 1
+    return None
+
+def fetch_quotes(symbols, timeout=REQUEST_TIMEOUT):
+    """
+    透過目前的報價來源查詢一批股票，回傳 {股票代號: 價格}
+    - 被隔離的股票不查詢，價格為 None
+    - 該主機的斷路器斷開時不發出請求，整批價格為 None
+    - 請求失敗 (報價來源拋出例外) 時，在重試額度內等待一段時間後重試
+    - 正常回應但沒有價格的股票不重試，也不算主機故障，只記入隔離名單的失敗次數
+    """
+    quarantine = get_symbol_quarantine()
+    prices = {symbol: None for symbol in symbols}
+    wanted = [symbol for symbol in symbols if not quarantine.is_quarantined(symbol)]
+    if not wanted:
+        return prices
+
+    provider = get_quote_provider()
+    fetched = _guarded_request(provider.host, lambda: provider.fetch_many(wanted, timeout), "批次查詢股價")
+    if fetched is None:
+        if get_circuit_breaker(provider.host).state != 'closed':
+            print(f"警告：{provider.host} 暫時無法連線，{len(wanted)} 支股票這次略過查詢。")
+        return prices
+    prices.update(fetched)
+    newly = quarantine.record({symbol: fetched.get(symbol) for symbol in wanted})
+    if newly:
+        print(f"警告：{', '.join(newly)} 連續多次查無價格，暫停查詢 {QUARANTINE_DURATION // 3600} 小時。")
+    return prices
+
+# --- 效能統計 ---
+class SweepTimer:
+    """
+    記錄每次檢查 (sweep) 的耗時，開銷很小，所以一直開著
+    - stage(name): 累計 fetch (查價)、evaluate (規則評估)、persist (寫入快取/歷史/狀態) 等階段的耗時；
+      並行查價時為各執行緒耗時的總和，可能大於整體耗時
+    - add_latency(seconds, count): 記錄 count 支股票從開始查詢到取得價格所花的時間
+    begin() 開始一次檢查，end() 結束並產生摘要，last_summary 保留上一次的摘要。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = defaultdict(float)
+        self._latencies = []
+        self._started = None
+        self.last_summary = None
+
+    def begin(self):
+        with self._lock:
+            self._stages = defaultdict(float)
+            self._latencies = []
+            self._started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._stages[name] += elapsed
+
+    def add_latency(self, seconds, count=1):
+        with self._lock:
+            self._latencies.extend([seconds] * count)
+
+    def end(self, symbols):
+        """結束這次檢查，回傳並保留摘要 (見 summary)"""
+        with self._lock:
+            duration = time.perf_counter() - self._started if self._started else 0.0
+            latencies = np.array(self._latencies) * 1000
+            self.last_summary = {
+                'symbols': symbols,
+                'duration': duration,
+                'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                'p95_ms': float(np.percentile(latencies, 95)) if len(latencies) else None,
+                'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+                'stages': dict(self._stages),
+                'finished': time.time(),
+            }
+            self._started = None
+            return self.last_summary
+
+sweep_timer = SweepTimer()
+
+def format_sweep_summary(summary):
+    """將檢查摘要整理成 '上次檢查: N 支股票，X 秒 (p95 Y 毫秒)' 的文字"""
+    text = f"上次檢查: {summary['symbols']} 支股票，{summary['duration']:.1f} 秒"
+    if summary['p95_ms'] is not None:
+        text += f" (p95 {summary['p95_ms']:.0f} 毫秒)"
+    return text
 
 # --- 核心功能函式 ---
-def get_stock_price(stock_symbol):
+def get_stock_price(stock_symbol, timeout=REQUEST_TIMEOUT):
     """
-    使用 yfinance API 抓取指定股號的最新股價
+    向報價來源抓取指定股號的最新股價
     - stock_symbol: 股票代號，例如 '2330.TW'
+    - timeout: 網路請求的逾時秒數
     """
+    cleaned_symbol = stock_symbol.strip().strip('/')
     try:
-        cleaned_symbol = stock_symbol.strip().strip('/')
-        print(f"正在查詢 {cleaned_symbol} 的股價...")
-        ticker = yf.Ticker(cleaned_symbol)
-        
-        # yfinance 提供多種獲取價格的方式，我們嘗試幾種以增加成功率
-        
-        # 方法一：獲取最近一天的歷史資料，取收盤價
-        hist = ticker.history(period="1d")
-        if not hist.empty:
-            latest_price = hist['Close'].iloc[-1]
-            return round(latest_price, 2)
-            
-        # 方法二：如果 history 為空，嘗試從 info 字典中獲取 'regularMarketPrice'
-        info = ticker.info
-        if 'regularMarketPrice' in info and info['regularMarketPrice'] is not None:
-            return round(info['regularMarketPrice'], 2)
-
-        # 方法三：作為最終備案，嘗試 'preMarket' 或 'postMarket' 價格
-        if 'preMarket' in info and info['preMarket'] is not None:
-             return round(info['preMarket'], 2)
-
-        print(f"警告：無法為 {cleaned_symbol} 找到任何有效的價格資料。")
+        return get_quote_provider().fetch_one(cleaned_symbol, timeout)
+    except Exception as e:
+        print(f"錯誤：抓取 {cleaned_symbol} 股價時發生錯誤: {e}")
         return None
 
+def get_stock_prices(symbols, batch_size=BATCH_SIZE, timeout=REQUEST_TIMEOUT, use_cache=True):
+    """
+    批次抓取多支股票的最新股價，回傳 {股票代號: 價格} 的字典
+    - symbols: 股票代號清單，例如 ['2330.TW', '2454.TW']
+    - batch_size: 每次批次請求的股票數量
+    - timeout: 每次網路請求的逾時秒數
+    - use_cache: 是否先使用報價快取中尚未過期的價格
+    每一批以 fetch_quotes 查詢 (含斷路器、重試與隔離名單)，查詢失敗的股票其價格為 None。
+    """
+    # 原始代號 -> 清理後代號，重複的代號只查詢一次
+    cleaned = {}
+    for symbol in symbols:
+        cleaned[symbol] = symbol.strip().strip('/')
+    unique_symbols = list(dict.fromkeys(cleaned.values()))
+
+    prices = {}
+    if use_cache:
+        prices = get_quote_cache().get_many('price', unique_symbols)
+        unique_symbols = [symbol for symbol in unique_symbols if symbol not in prices]
+
+    for start in range(0, len(unique_symbols), batch_size):
+        chunk = unique_symbols[start:start + batch_size]
+        with sweep_timer.stage('fetch'):
+            prices.update(fetch_quotes(chunk, timeout))
+
+        fetched = {symbol: prices.get(symbol) for symbol in chunk}
+        with sweep_timer.stage('persist'):
+            if use_cache:
+                get_quote_cache().set_many('price', fetched)
+            record_quotes(fetched)
+
+    return {symbol: prices.get(c) for symbol, c in cleaned.items()}
+
+def get_stock_name(symbol, default=None, use_cache=True):
+    """
+    取得股票的公司全名 (報價來源提供的名稱，如 yfinance 的 longName)，優先使用快取
+    - symbol: 股票代號
+    - default: 查詢失敗時回傳的名稱
+    """
+    cache = get_quote_cache()
+    if use_cache:
+        name = cache.get('name', symbol)
+        if name is not None:
+            return name
+    try:
+        name = get_quote_provider().metadata(symbol, REQUEST_TIMEOUT).get('name')
     except Exception as e:
-        print(f"錯誤：使用 yfinance 抓取 {cleaned_symbol} 股價時發生錯誤: {e}")
-        return None
+        print(f"錯誤：查詢 {symbol} 的公司資訊時發生錯誤: {e}")
+        return default
+    if not name:
+        return default
+    cache.set('name', symbol, name)
+    return name
+
+def fetch_daily_bars(symbols, period="1mo", timeout=REQUEST_TIMEOUT, now=None):
+    """
+    下載多支股票的日 K 線並存入歷史資料庫，回傳 {股票代號: 新寫入的筆數}
+    - period: yfinance 的資料期間，例如 '1mo'、'1y'
+    下載經過該主機的斷路器與重試額度 (見 fetch_quotes)。只有實際下載到 K 線的股票會列在
+    結果中 (已存在的日期不重複寫入，筆數可能為 0)，下載失敗或查無資料的股票不列入。
+    尚未收盤的當日 K 線不寫入：寫入後的 K 線不會再被更新，盤中的收盤價會一直留在資料庫裡。
+    """
+    session = last_completed_session(now, load_market_holidays())
+    until = datetime(session.year, session.month, session.day, tzinfo=TAIPEI_TZ) + timedelta(days=1)
+    provider = get_bars_provider()
+    symbols = list(dict.fromkeys(symbol.strip().strip('/') for symbol in symbols))
+    written = {}
+    store = get_history_store()
+    for start in range(0, len(symbols), BATCH_SIZE):
+        chunk = symbols[start:start + BATCH_SIZE]
+        bars = _guarded_request(provider.host, lambda: provider.fetch_bars(chunk, period, timeout), "下載日 K 線")
+        for symbol, frame in (bars or {}).items():
+            try:
+                written[symbol] = store.append_bars(symbol, frame, until=until.timestamp())
+            except OSError as e:
+                print(f"警告：寫入 {symbol} 的日 K 線時發生錯誤: {e}")
+    return written
+
+# 已下載過但仍沒有最近交易日 K 線的股票 (例如暫停交易) -> 該交易日，同一天內不再重試
+_daily_bars_checked = {}
+_daily_bars_lock = threading.Lock()
+
+def _daily_bars_period(window):
+    """回傳足以計算 window 日均線的 yfinance 資料期間"""
+    for max_window, period in DAILY_BARS_PERIODS:
+        if window <= max_window:
+            return period
+    return DAILY_BARS_MAX_PERIOD
+
+def ensure_daily_bars(stocks, now=None):
+    """
+    為有漲跌幅或均線條件的股票下載日 K 線，每個交易日只下載一次
+    歷史資料庫中已有最近一個已收盤交易日 K 線的股票不再下載，因此重新啟動程式也不會重複下載。
+    在建立 AlertRuleEngine 之前呼叫，refresh_context 才讀得到前一日收盤價與均線。
+    下載失敗的股票下次檢查會再試一次。
+    """
+    now = time.time() if now is None else now
+    session = last_completed_session(now, load_market_holidays())
+    session_start = datetime(session.year, session.month, session.day, tzinfo=TAIPEI_TZ).timestamp()
+    windows = {}
+    for stock in stocks:
+        for rule in stock_rules(stock):
+            condition = rule.get('condition')
+            if condition in ('pct_up', 'pct_down'):
+                window = 1
+            elif condition in ('above_ma', 'below_ma'):
+                try:
+                    window = int(float(rule.get('value')))
+                except (TypeError, ValueError, OverflowError):
+                    continue
+            else:
+                continue
+            windows[stock['symbol']] = max(windows.get(stock['symbol'], 0), window)
+
+    # 持有鎖直到下載完成，同時進行的檢查不會重複下載
+    store = get_history_store()
+    with _daily_bars_lock:
+        by_period = defaultdict(list)
+        for symbol, window in windows.items():
+            if _daily_bars_checked.get(symbol) == session:
+                continue
+            last = store.last_bar_time(symbol)
+            if last is None or last < session_start:
+                by_period[_daily_bars_period(window)].append(symbol)
+        for period, symbols in by_period.items():
+            for symbol in fetch_daily_bars(symbols, period=period, now=now):
+                _daily_bars_checked[symbol] = session
+
+def reset_shared_state():
+    """
+    清除模組層級的共用狀態：報價快取、歷史資料庫、斷路器、重試額度、隔離名單與日 K 線下載紀錄，
+    下次使用時會在目前的工作目錄重新建立；供效能量測讓每種條件都從相同的初始狀態開始
+    """
+    global _quote_cache, _history_store, _quarantine, _retry_budget
+    if _quote_cache is not None:
+        _quote_cache.close()
+    _quote_cache = None
+    _history_store = None
+    _quarantine = None
+    _retry_budget = RetryBudget()
+    with _breakers_lock:
+        _breakers.clear()
+    with _daily_bars_lock:
+        _daily_bars_checked.clear()
+
+def worker_chunk_size(count, max_workers=MAX_WORKERS, batch_size=BATCH_SIZE):
+    """
+    每個查詢工作分派的股票數量：股票少時平均分給各執行緒，
+    股票多時以 batch_size 為上限，不會比單執行緒批次查詢發出更多請求
+    """
+    return max(1, min(batch_size, math.ceil(count / max_workers)))
+
+def iter_price_batches(symbols, max_workers=MAX_WORKERS, deadline=WORKER_DEADLINE, chunk_size=None):
+    """
+    並行抓取多支股票的股價，每完成一個查詢工作就立即產出該批的 {股票代號: 價格}
+    - symbols: 股票代號清單
+    - max_workers: 同時執行查詢的執行緒數量上限
+    - deadline: 每個查詢工作的期限 (秒)，從工作開始執行時起算
+    - chunk_size: 每個查詢工作負責的股票數量 (以 get_stock_prices 批次查詢)，
+      預設依股票數量決定 (見 worker_chunk_size)
+    超過期限仍未完成的工作會被放棄，其股票以價格 None 產出；
+    呼叫端提早停止迭代時，尚未開始的工作會一併取消。
+    """
+    unique_symbols = list(dict.fromkeys(symbols))
+    chunk_size = chunk_size or worker_chunk_size(len(unique_symbols), max_workers)
+    chunks = [unique_symbols[i:i + chunk_size] for i in range(0, len(unique_symbols), chunk_size)]
+    started = {}
+
+    def fetch(index):
+        started[index] = time.monotonic()
+        prices = get_stock_prices(chunks[index])
+        sweep_timer.add_latency(time.monotonic() - started[index], len(chunks[index]))
+        return prices
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {executor.submit(fetch, i): i for i in range(len(chunks))}
+    pending = set(futures)
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = futures[future]
+                try:
+                    prices = future.result()
+                except Exception as e:
+                    print(f"錯誤：查詢 {', '.join(chunks[index])} 時發生錯誤: {e}")
+                    prices = {}
+                yield {symbol: prices.get(symbol) for symbol in chunks[index]}
+
+            # 放棄執行超過期限的工作，不再等待其結果
+            now = time.monotonic()
+            for future in list(pending):
+                index = futures[future]
+                if index in started and now - started[index] > deadline:
+                    pending.discard(future)
+                    print(f"警告：查詢 {', '.join(chunks[index])} 超過 {deadline} 秒，已放棄。")
+                    yield {symbol: None for symbol in chunks[index]}
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def iter_stock_prices(symbols, **options):
+    """與 iter_price_batches 相同，但逐支產出 (股票代號, 價格)"""
+    for batch in iter_price_batches(symbols, **options):
+        yield from batch.items()
 
 def check_prices():
     """檢查所有追蹤股票的價格並在達標時發出通知"""
@@ -65,23 +939,907 @@ def check_prices():
         print("您的追蹤清單是空的，請先使用 'add' 指令新增股票。")
         return
 
+    # 先建立規則引擎，才能以上一次檢查時的價格判斷是否突破
+    ensure_daily_bars(stocks)
+    engine = AlertRuleEngine(stocks, get_history_store(), state_file=ALERT_STATE_FILE)
+    prices = get_stock_prices(engine.symbols)
     for stock in stocks:
-        price = get_stock_price(stock['symbol'])
-        
+        price = prices.get(stock['symbol'])
         if price is not None:
-            target_price = stock['target_price']
-            print(f"  -> {stock['symbol']} 目前價格: {price}, 目標價: {target_price}")
-            if price >= target_price:
-                print("\n" + "="*40)
-                print(f"🎉 **達標通知** 🎉")
-                print(f"  股票 {stock['symbol']} 已達到目標價!")
-                print(f"  目前價格: {price} >= 目標價: {target_price}")
-                print("="*40 + "\n")
-                # 在未來，我們可以在這裡觸發桌面通知
-                # notification.notify(...)
+            rules = "、".join(describe_rule(rule) for rule in stock_rules(stock))
+            print(f"  -> {stock['symbol']} 目前價格: {price}, 條件: {rules}")
+
+    # 已通知過且尚未解除的規則不會再次通知
+    dispatcher = NotificationDispatcher(default_sinks(lambda message, tag: print(message)))
+    for stock, rule, price in engine.evaluate(prices):
+        dispatcher.notify(make_alert(stock, rule, price))
+    engine.save_state()
+    dispatcher.flush(force=True)
     
     print("檢查完畢。")
 
+# --- 警示規則 ---
+# 支援的條件類型與顯示名稱；value 的意義依條件而定 (價格、百分比或均線天數)
+CONDITION_LABELS = {
+    '>=': '目標賣價',
+    '<=': '目標買價',
+    'cross_up': '向上突破',
+    'cross_down': '向下跌破',
+    'pct_up': '漲幅%',
+    'pct_down': '跌幅%',
+    'above_ma': '站上N日均線',
+    'below_ma': '跌破N日均線',
+    'band': '超出區間',
+}
+_CONDITION_CODES = {condition: code for code, condition in enumerate(CONDITION_LABELS)}
+_RULE_FORMATS = {
+    '>=': '>= {value}',
+    '<=': '<= {value}',
+    'cross_up': '向上突破 {value}',
+    'cross_down': '向下跌破 {value}',
+    'pct_up': '漲幅 ≥ {value}%',
+    'pct_down': '跌幅 ≥ {value}%',
+    'above_ma': '站上 {value:.0f} 日均線',
+    'below_ma': '跌破 {value:.0f} 日均線',
+    'band': '超出 {value} ~ {high}',
+}
+
+def stock_rules(stock):
+    """
+    取得一支股票的所有警示規則
+    主規則來自 condition/target_price (band 的上緣為 band_high)，
+    另外可在 'rules' 欄位加入更多規則，例如 {"condition": "pct_down", "value": 5}
+    """
+    rules = []
+    if 'target_price' in stock:
+        rule = {'condition': stock.get('condition', '>='), 'value': stock['target_price']}
+        if rule['condition'] == 'band':
+            rule['high'] = stock.get('band_high')
+        rules.append(rule)
+    extra = stock.get('rules')
+    if isinstance(extra, list):
+        rules.extend(rule for rule in extra if isinstance(rule, dict))
+    elif extra is not None:
+        print(f"警告：{stock['symbol']} 的 rules 欄位不是陣列，已略過。")
+    return rules
+
+def describe_rule(rule):
+    """將規則轉成簡短的文字說明，例如 '>= 1460'、'漲幅 ≥ 5%'"""
+    condition = rule['condition']
+    if condition not in _RULE_FORMATS:
+        return f"{condition} {rule.get('value')}"
+    return _RULE_FORMATS[condition].format(value=rule.get('value'), high=rule.get('high'))
+
+def rule_key(stock, rule):
+    """規則的識別字串，用於記錄哪些規則已經通知過"""
+    return f"{stock['symbol']}|{rule['condition']}|{rule.get('value')}|{rule.get('high')}"
+
+def _previous_close(bars, before):
+    """取得指定時間之前最後一根日 K 線的收盤價"""
+    position = np.searchsorted(bars['ts'], before, side='left')
+    return float(bars['close'][position - 1]) if position else np.nan
+
+class AlertRuleEngine:
+    """
+    將監控清單中所有股票的警示規則編譯成 NumPy 陣列，每次收到新報價時一次算完所有規則
+    - 價位條件 (>=, <=) 只要符合就觸發；突破條件 (cross_up/cross_down) 只在由下往上/
+      由上往下穿越目標價的那一次觸發
+    - 漲跌幅條件以前一個交易日收盤價為基準；均線條件以最近 N 根日 K 線收盤價平均為基準，
+      兩者都從歷史資料庫讀取，沒有資料時不會觸發
+    - 規則觸發後會記住「已通知」狀態，直到條件解除才重新啟用；價位條件還需價格回檔超過
+      hysteresis_pct 百分比，避免價格在目標價附近來回時重複通知
+    - state_file: 儲存已通知狀態的檔案，讓 CLI 與 GUI 的多次檢查共用 (None 表示不儲存)
+    """
+    def __init__(self, stocks, history=None, state_file=None, hysteresis_pct=ALERT_HYSTERESIS_PCT):
+        self.stocks = list(stocks)
+        self.history = history
+        self.state_file = state_file
+        self.hysteresis_pct = hysteresis_pct
+        self.symbols = list(dict.fromkeys(stock['symbol'] for stock in self.stocks))
+        self._positions = {symbol: i for i, symbol in enumerate(self.symbols)}
+
+        self.rules = []
+        owners, codes, values, highs = [], [], [], []
+        for stock in self.stocks:
+            for rule in stock_rules(stock):
+                if rule.get('condition') not in _CONDITION_CODES:
+                    print(f"警告：{stock['symbol']} 有不支援的條件 '{rule.get('condition')}'，已略過。")
+                    continue
+                try:
+                    value = float(rule.get('value', np.nan))
+                    high = rule.get('high')
+                    high = np.nan if high is None else float(high)
+                except (TypeError, ValueError):
+                    value = np.nan
+                # 均線條件的數值是天數，至少要 1 天
+                if not np.isfinite(value) or (rule['condition'] in ('above_ma', 'below_ma') and value < 1):
+                    print(f"警告：{stock['symbol']} 的規則 {rule['condition']} {rule.get('value')} 數值格式錯誤，已略過。")
+                    continue
+                self.rules.append((stock, rule))
+                owners.append(self._positions[stock['symbol']])
+                codes.append(_CONDITION_CODES[rule['condition']])
+                values.append(value)
+                highs.append(high)
+        self._owner = np.array(owners, dtype=np.intp)
+        self._code = np.array(codes, dtype=np.intp)
+        self._value = np.array(values, dtype=float)
+        self._high = np.array(highs, dtype=float)
+        # 每支股票的規則編號，只收到部分股票的報價時只計算這些規則
+        order = np.argsort(self._owner, kind='stable')
+        bounds = np.searchsorted(self._owner[order], np.arange(len(self.symbols) + 1))
+        self._symbol_rules = [order[bounds[i]:bounds[i + 1]] for i in range(len(self.symbols))]
+
+        self._previous = np.full(len(self.symbols), np.nan)
+        self._reference = np.full(len(self.symbols), np.nan)
+        self._moving_average = np.full(len(self.rules), np.nan)
+        self._keys = [rule_key(stock, rule) for stock, rule in self.rules]
+        self._fired = np.zeros(len(self.rules), dtype=bool)
+        self.load_state()
+        self.refresh_context()
+
+    def load_state(self):
+        """從 state_file 載入已通知的規則"""
+        if not self.state_file:
+            return
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                fired = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        self._fired = np.array([key in fired for key in self._keys], dtype=bool)
+
+    def save_state(self):
+        """將已通知的規則寫入 state_file (先寫暫存檔再取代)"""
+        if not self.state_file:
+            return
+        fired = {key: True for key, is_fired in zip(self._keys, self._fired) if is_fired}
+        try:
+            tmp_path = self.state_file + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(fired, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.state_file)
+        except OSError as e:
+            print(f"警告：無法儲存警示狀態: {e}")
+
+    def refresh_context(self, now=None):
+        """從歷史資料庫重新載入上次報價、前一日收盤價與均線 (每天或 K 線更新後呼叫一次即可)"""
+        if self.history is None:
+            return
+        current = datetime.fromtimestamp(time.time() if now is None else now, TAIPEI_TZ)
+        today_start = datetime(current.year, current.month, current.day, tzinfo=TAIPEI_TZ).timestamp()
+        # 每支股票只讀取最後幾根 K 線：最長的均線天數，再加上今天的 K 線 (收盤後才會寫入)
+        ma_codes = (_CONDITION_CODES['above_ma'], _CONDITION_CODES['below_ma'])
+        is_ma = np.isin(self._code, ma_codes)
+        needed = np.ones(len(self.symbols), dtype=np.intp)
+        np.maximum.at(needed, self._owner[is_ma], self._value[is_ma].astype(np.intp))
+        bars_by_symbol = {}
+        for i, symbol in enumerate(self.symbols):
+            if np.isnan(self._previous[i]):
+                ticks = self.history.ticks(symbol, last=1)
+                if len(ticks):
+                    self._previous[i] = ticks['price'][-1]
+            bars = self.history.bars(symbol, last=needed[i] + 1)
+            bars_by_symbol[symbol] = bars
+            self._reference[i] = _previous_close(bars, today_start) if len(bars) else np.nan
+            if np.isnan(self._reference[i]):
+                # 沒有日 K 線時改用今天以前最後一筆報價 (與 get_previous_closes 相同)
+                ticks = self.history.ticks(symbol, end=today_start, last=1)
+                if len(ticks) and ticks['ts'][-1] < today_start:
+                    self._reference[i] = ticks['price'][-1]
+
+        for i, (stock, rule) in enumerate(self.rules):
+            if not is_ma[i]:
+                continue
+            window = int(self._value[i])
+            closes = bars_by_symbol[stock['symbol']]['close']
+            self._moving_average[i] = closes[-window:].mean() if window > 0 and len(closes) >= window else np.nan
+
+    def evaluate(self, prices):
+        """
+        以最新報價評估所有規則，回傳這次新觸發 (先前尚未通知) 的 [(股票, 規則, 價格), ...]
+        - prices: {股票代號: 價格}，可以只包含部分股票 (例如串流查詢時陸續到達的結果)，
+          此時只計算這些股票的規則
+        """
+        latest = np.full(len(self.symbols), np.nan)
+        present = []
+        for symbol, price in prices.items():
+            position = self._positions.get(symbol)
+            if position is not None and price is not None:
+                latest[position] = price
+                present.append(position)
+        if not len(self.rules) or not present:
+            self._update_previous(latest)
+            return []
+
+        # 只取有新報價的股票的規則
+        rules = np.concatenate([self._symbol_rules[position] for position in present])
+        owner = self._owner[rules]
+        price = latest[owner]
+        previous = self._previous[owner]
+        reference = self._reference[owner]
+        value, code = self._value[rules], self._code[rules]
+        high, moving_average = self._high[rules], self._moving_average[rules]
+        codes = _CONDITION_CODES
+        with np.errstate(invalid='ignore', divide='ignore'):
+            change_pct = (price - reference) / reference * 100
+            conditions = [
+                (code == codes['>=']) & (price >= value),
+                (code == codes['<=']) & (price <= value),
+                (code == codes['cross_up']) & (previous < value) & (price >= value),
+                (code == codes['cross_down']) & (previous > value) & (price <= value),
+                (code == codes['pct_up']) & (change_pct >= value),
+                (code == codes['pct_down']) & (-change_pct >= value),
+                (code == codes['above_ma']) & (price >= moving_average),
+                (code == codes['below_ma']) & (price <= moving_average),
+                (code == codes['band']) & ((price < value) | (price > high)),
+            ]
+            triggered = np.logical_or.reduce(conditions)
+
+            # 解除已通知狀態：價位條件需回檔超過遲滯範圍，其餘條件只要不再成立即可
+            margin = value * self.hysteresis_pct / 100
+            rearm = np.where(
+                code == codes['>='], price < value - margin,
+                np.where(code == codes['<='], price > value + margin, ~triggered),
+            )
+        fired = self._fired[rules]
+        new_alerts = triggered & ~fired
+        self._fired[rules] = (fired | triggered) & ~rearm
+        self._update_previous(latest)
+
+        return [
+            (self.rules[rules[i]][0], self.rules[rules[i]][1], float(price[i]))
+            for i in np.flatnonzero(new_alerts)
+        ]
+
+    def _update_previous(self, latest):
+        has_price = ~np.isnan(latest)
+        self._previous[has_price] = latest[has_price]
+
+# --- 通知 ---
+def make_alert(stock, rule, price):
+    """將觸發的規則整理成通知內容"""
+    return {
+        'symbol': stock['symbol'],
+        'name': stock.get('name', ''),
+        'rule': describe_rule(rule),
+        'price': price,
+        'time': time.time(),
+    }
+
+class LogSink:
+    """將通知寫到日誌；write(message, tag) 可以是 GUI 的 log 方法"""
+    def __init__(self, write):
+        self.write = write
+
+    def send(self, alerts):
+        self.write("=" * 40, None)
+        for alert in alerts:
+            message = (f"🎉 **達標通知** 🎉\n股票 {alert['symbol']} ({alert['name']})\n"
+                       f"已達到目標! (目前: {alert['price']}，條件: {alert['rule']})")
+            self.write(message, "target_met")
+        self.write("=" * 40, None)
+
+class DesktopSink:
+    """以 plyer 發送桌面通知，一批通知只跳出一則；未安裝 plyer 時自動停用"""
+    def __init__(self):
+        self.enabled = True
+
+    def send(self, alerts):
+        if not self.enabled:
+            return
+        try:
+            from plyer import notification
+        except ImportError:
+            print("警告：未安裝 plyer，已停用桌面通知。")
+            self.enabled = False
+            return
+        lines = [f"{a['symbol']} {a['name']}: {a['price']} ({a['rule']})" for a in alerts[:3]]
+        if len(alerts) > 3:
+            lines.append(f"...另有 {len(alerts) - 3} 則")
+        notification.notify(title=f"股票達標通知 ({len(alerts)} 則)", message="\n".join(lines), timeout=10)
+
+class FileSink:
+    """將通知以每行一筆 JSON 的格式附加到檔案，也可當作 Webhook 的本地替身"""
+    def __init__(self, path=NOTIFY_LOG_FILE):
+        self.path = path
+
+    def send(self, alerts):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for alert in alerts:
+                f.write(json.dumps(alert, ensure_ascii=False) + "\n")
+
+class WebhookSink:
+    """將一批通知以 JSON 陣列 POST 到指定網址"""
+    def __init__(self, url, timeout=REQUEST_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, alerts):
+        import requests
+        requests.post(self.url, json=alerts, timeout=self.timeout).raise_for_status()
+
+def default_sinks(write):
+    """依設定建立通知管道；write(message, tag) 為日誌輸出函式"""
+    sinks = [LogSink(write)]
+    if NOTIFY_DESKTOP:
+        sinks.append(DesktopSink())
+    if NOTIFY_LOG_FILE:
+        sinks.append(FileSink(NOTIFY_LOG_FILE))
+    if NOTIFY_WEBHOOK_URL:
+        sinks.append(WebhookSink(NOTIFY_WEBHOOK_URL))
+    return sinks
+
+class NotificationDispatcher:
+    """
+    收集通知後定時合併成一批發送到各個管道，並限制每分鐘發送的批次數
+    超過限制時通知會留到下一次發送，所以行情劇烈波動時也不會洗版或卡住畫面。
+    - sinks: 具有 send(alerts) 方法的通知管道
+    - flush_interval: 背景執行緒合併發送的間隔 (秒)
+    - max_per_minute: 每分鐘最多發送的批次數
+    """
+    def __init__(self, sinks, flush_interval=NOTIFY_FLUSH_INTERVAL, max_per_minute=NOTIFY_MAX_PER_MINUTE):
+        self.sinks = list(sinks)
+        self.flush_interval = flush_interval
+        self.max_per_minute = max_per_minute
+        self.history = deque(maxlen=ALERT_HISTORY_SIZE)
+        self._pending = []
+        self._sent_times = deque()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def notify(self, alert):
+        """加入一則通知，實際發送由 flush() 進行"""
+        with self._lock:
+            self._pending.append(alert)
+            self.history.append(alert)
+
+    def recent(self):
+        """回傳最近的通知 (新的在前)；在鎖內複製，其他執行緒可同時呼叫 notify()"""
+        with self._lock:
+            return list(reversed(self.history))
+
+    def start(self):
+        """啟動背景執行緒定時發送"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止背景執行緒，並把剩下的通知送出"""
+        self._stop.set()
+        self.flush(force=True)
+
+    def flush(self, force=False):
+        """
+        將目前累積的通知合併成一批送出；超過每分鐘上限時保留到下次 (force=True 時一律送出)
+        回傳送出的通知數量
+        """
+        now = time.time()
+        with self._lock:
+            if not self._pending:
+                return 0
+            while self._sent_times and now - self._sent_times[0] > 60:
+                self._sent_times.popleft()
+            if not force and len(self._sent_times) >= self.max_per_minute:
+                return 0
+            batch, self._pending = self._pending, []
+            self._sent_times.append(now)
+
+        for sink in self.sinks:
+            try:
+                sink.send(batch)
+            except Exception as e:
+                print(f"錯誤：透過 {type(sink).__name__} 發送通知時發生錯誤: {e}")
+        return len(batch)
+
+    def _loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+def run_alert_sweep(stocks, dispatcher, on_price=None):
+    """
+    並行查詢監控清單中所有股票的股價，每完成一批就一次評估該批的警示規則並交給 dispatcher 通知
+    - on_price: 每收到一支股票的價格時呼叫 on_price(股票, 價格)，可用於即時顯示
+    已通知過且尚未解除的規則不會再次通知。回傳 {股票代號: 價格}
+    各階段的耗時記錄在 sweep_timer，結束後可從 sweep_timer.last_summary 取得摘要。
+    """
+    sweep_timer.begin()
+    with sweep_timer.stage('fetch'):
+        ensure_daily_bars(stocks)
+    # 先建立規則引擎，才能以上一次檢查時的價格判斷是否突破
+    engine = AlertRuleEngine(stocks, get_history_store(), state_file=ALERT_STATE_FILE)
+    stocks_by_symbol = {stock['symbol']: stock for stock in stocks}
+    prices = {}
+    # 每完成一批查詢就立即處理，不必等待最慢的一批；規則引擎每批只計算一次
+    for batch in iter_price_batches(engine.symbols):
+        prices.update(batch)
+        batch = {symbol: price for symbol, price in batch.items() if price is not None}
+        if not batch:
+            continue
+        if on_price:
+            for symbol, price in batch.items():
+                on_price(stocks_by_symbol[symbol], price)
+        with sweep_timer.stage('evaluate'):
+            triggered = engine.evaluate(batch)
+        for stock, rule, alert_price in triggered:
+            dispatcher.notify(make_alert(stock, rule, alert_price))
+    with sweep_timer.stage('persist'):
+        engine.save_state()
+    sweep_timer.end(len(prices))
+    return prices
+
+# --- 持股與損益 ---
+def stock_position(stock):
+    """
+    回傳股票的持股 (股數, 總成本)，沒有持股時回傳 (0.0, 0.0)
+    持股可用 shares (股數) 與 cost_basis (每股平均成本) 表示，或以 lots 列出每次買進的
+    [{"shares": 股數, "price": 成交價, "date": "2026-01-02"}, ...]；兩者都有時以 lots 為準。
+    """
+    lots = stock.get('lots')
+    if lots:
+        shares = sum(float(lot['shares']) for lot in lots)
+        cost = sum(float(lot['shares']) * float(lot['price']) for lot in lots)
+        return shares, cost
+    shares = float(stock.get('shares') or 0)
+    return shares, shares * float(stock.get('cost_basis') or 0)
+
+def get_previous_closes(symbols, now=None):
+    """
+    從歷史資料庫取得各股票前一個交易日的收盤價，回傳 {股票代號: 價格}
+    沒有日 K 線時改用今天以前最後一筆報價，都沒有時不列入。
+    """
+    current = datetime.fromtimestamp(time.time() if now is None else now, TAIPEI_TZ)
+    today_start = datetime(current.year, current.month, current.day, tzinfo=TAIPEI_TZ).timestamp()
+    store = get_history_store()
+    closes = {}
+    for symbol in symbols:
+        close = np.nan
+        # end 包含端點，多取一根以略過時間正好是今天零時的當日 K 線
+        bars = store.bars(symbol, end=today_start, last=2)
+        if len(bars):
+            close = _previous_close(bars, today_start)
+        else:
+            ticks = store.ticks(symbol, end=today_start, last=1)
+            if len(ticks):
+                close = float(ticks['price'][-1])
+        if not np.isnan(close):
+            closes[symbol] = close
+    return closes
+
+def _amount(value):
+    """將 NumPy 數值轉換為四捨五入到小數兩位的 float，NaN 轉為 None"""
+    return None if np.isnan(value) else round(float(value), 2)
+
+def summarize_portfolio(stocks, prices, previous_closes=None):
+    """
+    以 NumPy 一次算出每支持股與每個分類的市值、未實現損益與今日損益
+    - stocks: 監控清單 (只有持股數大於 0 的股票會列入)
+    - prices: {股票代號: 最新價格}
+    - previous_closes: {股票代號: 前一交易日收盤價}，用來計算今日損益
+    回傳 {'stocks': {代號: 明細}, 'categories': {分類: 小計}, 'total': 總計}；
+    每項包含 cost (成本)、market_value (市值)、unrealized_pnl (未實現損益)、
+    unrealized_pct (報酬率 %)、day_change (今日損益)，缺少價格的股票其數值為 None，也不計入小計；
+    小計另有 priced (有價格的股票數)。
+    """
+    previous_closes = previous_closes or {}
+    held = []
+    for stock in stocks:
+        shares, cost = stock_position(stock)
+        if shares > 0:
+            held.append((stock, shares, cost))
+
+    categories = list(dict.fromkeys(stock.get('category', '未分類') for stock, _shares, _cost in held))
+    category_codes = {category: i for i, category in enumerate(categories)}
+    code = np.array([category_codes[stock.get('category', '未分類')] for stock, _s, _c in held], dtype=np.intp)
+    shares = np.array([s for _stock, s, _cost in held], dtype=float)
+    cost = np.array([c for _stock, _s, c in held], dtype=float)
+    price = np.array([np.nan if prices.get(stock['symbol']) is None else prices[stock['symbol']]
+                      for stock, _s, _c in held], dtype=float)
+    previous = np.array([previous_closes.get(stock['symbol'], np.nan) for stock, _s, _c in held], dtype=float)
+
+    market_value = shares * price
+    pnl = market_value - cost
+    day_change = shares * (price - previous)
+    # 沒有成本 (例如只填股數) 的持股沒有報酬率，與小計相同回傳 None
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pct = np.where(cost > 0, pnl / cost * 100, np.nan)
+
+    # 各分類的小計只加總有價格的股票；今日損益只加總有前一日收盤價的股票
+    priced = ~np.isnan(price)
+    has_change = ~np.isnan(day_change)
+    def subtotal(values, mask):
+        return np.bincount(code, weights=np.where(mask, values, 0.0), minlength=len(categories))
+    cat_cost = subtotal(cost, np.ones(len(held), dtype=bool))
+    cat_priced_cost = subtotal(cost, priced)
+    cat_value = subtotal(market_value, priced)
+    cat_change = subtotal(day_change, has_change)
+    cat_priced = np.bincount(code, weights=priced.astype(float), minlength=len(categories))
+    cat_changed = np.bincount(code, weights=has_change.astype(float), minlength=len(categories))
+
+    def entry(cost_value, value, priced_cost, change, priced_count, changed_count):
+        if not priced_count:
+            value = np.nan
+        if not changed_count:
+            change = np.nan
+        gain = value - priced_cost
+        return {
+            'cost': _amount(cost_value),
+            'market_value': _amount(value),
+            'unrealized_pnl': _amount(gain),
+            'unrealized_pct': _amount(gain / priced_cost * 100) if priced_cost > 0 else None,
+            'day_change': _amount(change),
+            'priced': int(priced_count),
+        }
+
+    summary = {'stocks': {}, 'categories': {}}
+    for i, (stock, _shares, _cost) in enumerate(held):
+        summary['stocks'][stock['symbol']] = {
+            'shares': float(shares[i]),
+            'cost': _amount(cost[i]),
+            'market_value': _amount(market_value[i]),
+            'unrealized_pnl': _amount(pnl[i]),
+            'unrealized_pct': _amount(pct[i]),
+            'day_change': _amount(day_change[i]),
+        }
+    for i, category in enumerate(categories):
+        summary['categories'][category] = entry(cat_cost[i], cat_value[i], cat_priced_cost[i],
+                                                cat_change[i], cat_priced[i], cat_changed[i])
+    summary['total'] = entry(cat_cost.sum(), cat_value.sum(), cat_priced_cost.sum(),
+                             cat_change.sum(), cat_priced.sum(), cat_changed.sum())
+    return summary
+
+# --- 股票代號/名稱索引 ---
+class StockIndex:
+    """
+    台股清單 (tw_stock_list.json) 的查詢索引，載入時建立一次
+    - 代號、純數字代號與名稱的雜湊表，供精確查詢
+    - 排序過的鍵值表，供前綴查詢 (如 "233"、"台積")
+    - 名稱的單字/雙字 n-gram 索引，供中文名稱的部分比對與模糊查詢
+    """
+    def __init__(self, stocks):
+        self.stocks = list(stocks)
+        self._build_exact_maps()
+        grams = defaultdict(list)
+        keys = []
+        for position, stock in enumerate(self.stocks):
+            symbol = stock['symbol'].upper()
+            name = stock.get('name', '')
+            if name:
+                keys.append((name.upper(), position))
+            keys.append((symbol, position))
+            for gram in self._ngrams(name.upper()):
+                grams[gram].append(position)
+        # n-gram -> 股票位置的 tuple (依位置排序)，可直接存進二進位快取檔
+        self._grams = {gram: tuple(positions) for gram, positions in grams.items()}
+        keys.sort()
+        self._prefix_keys = [key for key, _position in keys]
+        self._prefix_positions = [position for _key, position in keys]
+
+    def _build_exact_maps(self):
+        # 代號/名稱 -> 股票在 self.stocks 中的位置
+        self._by_symbol = {}
+        self._by_code = {}
+        self._by_name = {}
+        for position, stock in enumerate(self.stocks):
+            symbol = stock['symbol'].upper()
+            self._by_symbol.setdefault(symbol, position)
+            self._by_code.setdefault(symbol.split('.')[0], position)
+            if stock.get('name'):
+                self._by_name.setdefault(stock['name'], position)
+
+    def __getstate__(self):
+        # 存成二進位快取時只保留較花時間建立的前綴表與 n-gram 索引，
+        # 精確查詢用的雜湊表在載入時重建即可
+        return {
+            'stocks': self.stocks,
+            'prefix_keys': self._prefix_keys,
+            'prefix_positions': self._prefix_positions,
+            'grams': self._grams,
+        }
+
+    def __setstate__(self, state):
+        self.stocks = state['stocks']
+        self._prefix_keys = state['prefix_keys']
+        self._prefix_positions = state['prefix_positions']
+        self._grams = state['grams']
+        self._build_exact_maps()
+
+    def __len__(self):
+        return len(self.stocks)
+
+    @staticmethod
+    def _ngrams(text):
+        """回傳字串中所有的單字與相鄰雙字"""
+        grams = set(text)
+        grams.update(text[i:i + 2] for i in range(len(text) - 1))
+        grams.discard(' ')
+        return grams
+
+    def find(self, query):
+        """
+        精確查詢：依完整代號 (2330.TW)、純數字代號 (2330) 或完整名稱 (台積電) 找出股票
+        也接受自動完成選項的格式 ("2330.TW 台積電")，找不到時回傳 None
+        """
+        position = self._find_position(query)
+        return None if position is None else self.stocks[position]
+
+    def _find_position(self, query):
+        """與 find 相同，但回傳股票在 self.stocks 中的位置"""
+        query = query.strip()
+        if not query:
+            return None
+        upper = query.upper()
+        for table, key in ((self._by_symbol, upper), (self._by_code, upper), (self._by_name, query)):
+            position = table.get(key)
+            if position is not None:
+                return position
+        if ' ' in query:
+            return self._find_position(query.split()[0])
+        return None
+
+    def search(self, query, limit=10):
+        """
+        部分查詢，回傳最多 limit 筆依相關度排序的股票：
+        精確符合 > 代號/名稱前綴符合 > 名稱包含查詢字串 > 名稱字元相似
+        含數字的英數查詢 (如 "0050"、"2330.TW") 視為代號，只做精確與前綴比對；
+        其他英數查詢不做字元相似比對，以免只因共用幾個字元就列出無關的股票。
+        """
+        query = query.strip().upper()
+        if not query:
+            return []
+        ranked = []
+        seen = set()
+
+        def add(position):
+            if position not in seen and len(ranked) < limit:
+                seen.add(position)
+                ranked.append(self.stocks[position])
+
+        exact = self._find_position(query)
+        if exact is not None:
+            add(exact)
+
+        start = bisect.bisect_left(self._prefix_keys, query)
+        for i in range(start, len(self._prefix_keys)):
+            if len(ranked) >= limit or not self._prefix_keys[i].startswith(query):
+                break
+            add(self._prefix_positions[i])
+
+        if query.isascii() and any(char.isdigit() for char in query):
+            return ranked
+
+        grams = self._ngrams(query)
+        if len(ranked) < limit and grams:
+            # 名稱中包含查詢字串：先取所有 n-gram 的交集，再逐一確認
+            postings = [self._grams.get(gram, ()) for gram in grams]
+            candidates = set(min(postings, key=len)).intersection(*postings)
+            for position in sorted(candidates):
+                if query in self.stocks[position].get('name', '').upper():
+                    add(position)
+
+        if len(ranked) < limit and grams and not query.isascii():
+            # 模糊比對：依共同 n-gram 數量排序，至少要有一半相同
+            scores = defaultdict(int)
+            for gram in grams:
+                for position in self._grams.get(gram, ()):
+                    scores[position] += 1
+            threshold = len(grams) / 2
+            for position, score in sorted(scores.items(), key=lambda item: (-item[1], item[0])):
+                if score < threshold:
+                    break
+                add(position)
+
+        return ranked
+
+def save_stock_index(index, path=STOCK_INDEX_FILE):
+    """將建立好的 StockIndex 存成二進位快取檔 (先寫暫存檔再取代，避免寫到一半)"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump({'version': STOCK_INDEX_VERSION, 'index': index}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+def _load_cached_stock_index(path, source_path):
+    """讀取二進位快取檔；檔案不存在、版本不符或比 JSON 舊時回傳 None"""
+    try:
+        if os.path.exists(source_path) and os.path.getmtime(path) < os.path.getmtime(source_path):
+            return None
+        with open(path, 'rb') as f:
+            payload = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"警告：無法讀取 {path}: {e}，改為載入 JSON。")
+        return None
+    if not isinstance(payload, dict) or payload.get('version') != STOCK_INDEX_VERSION:
+        return None
+    return payload.get('index')
+
+def load_stock_index(path=STOCK_LIST_FILE, cache_path=STOCK_INDEX_FILE):
+    """
+    載入台股清單並建立 StockIndex
+    優先使用預先建立好的二進位快取檔，沒有或已過期時才解析 JSON，並順便重建快取檔。
+    兩者都不存在時會拋出 FileNotFoundError。
+    """
+    index = _load_cached_stock_index(cache_path, path) if cache_path else None
+    if index is not None:
+        return index
+    with open(path, 'r', encoding='utf-8') as f:
+        index = StockIndex(json.load(f))
+    if cache_path:
+        try:
+            save_stock_index(index, cache_path)
+        except OSError as e:
+            print(f"警告：無法寫入 {cache_path}: {e}")
+    return index
+
+# --- 定時排程 ---
+def load_market_holidays():
+    """從 market_holidays.json 載入休市日，回傳 date 的集合"""
+    try:
+        with open(MARKET_HOLIDAYS_FILE, 'r', encoding='utf-8') as f:
+            return {date.fromisoformat(day) for day in json.load(f)}
+    except FileNotFoundError:
+        return set()
+    except (json.JSONDecodeError, TypeError, ValueError) as e:
+        print(f"警告：無法解析 {MARKET_HOLIDAYS_FILE}: {e}，將不排除休市日。")
+        return set()
+
+def _market_session(day):
+    """回傳指定日期的開盤與收盤時間 (台北時間)"""
+    open_time = datetime(day.year, day.month, day.day, *MARKET_OPEN, tzinfo=TAIPEI_TZ)
+    close_time = datetime(day.year, day.month, day.day, *MARKET_CLOSE, tzinfo=TAIPEI_TZ)
+    return open_time, close_time
+
+def is_trading_day(day, holidays=()):
+    """判斷指定日期是否為交易日 (週一至週五且非休市日)"""
+    return day.weekday() < 5 and day not in holidays
+
+def is_market_open(now=None, holidays=()):
+    """
+    判斷台股目前是否在交易時間內
+    - now: 時間戳記 (秒)，預設為現在
+    - holidays: 休市日 (date) 的集合
+    """
+    current = datetime.fromtimestamp(time.time() if now is None else now, TAIPEI_TZ)
+    if not is_trading_day(current.date(), holidays):
+        return False
+    open_time, close_time = _market_session(current.date())
+    return open_time <= current < close_time
+
+def next_market_open(now=None, holidays=()):
+    """回傳下一次開盤的時間戳記 (秒)"""
+    current = datetime.fromtimestamp(time.time() if now is None else now, TAIPEI_TZ)
+    day = current.date()
+    # 連假最長也不會超過一個月，找不到時就當作明天開盤
+    for _ in range(31):
+        if is_trading_day(day, holidays):
+            open_time, _close = _market_session(day)
+            if open_time > current:
+                return open_time.timestamp()
+        day += timedelta(days=1)
+    return (current + timedelta(days=1)).timestamp()
+
+def last_completed_session(now=None, holidays=()):
+    """回傳最近一個已收盤的交易日 (date)"""
+    current = datetime.fromtimestamp(time.time() if now is None else now, TAIPEI_TZ)
+    day = current.date()
+    for _ in range(31):
+        if is_trading_day(day, holidays) and _market_session(day)[1] <= current:
+            return day
+        day -= timedelta(days=1)
+    return current.date() - timedelta(days=1)
+
+class PriceCheckScheduler:
+    """
+    在背景執行緒中定時執行價格檢查
+    - job: 每次檢查要呼叫的函式 (不帶參數)
+    - interval: 交易時間內的檢查間隔 (秒)
+    - closed_interval: 休市時的檢查間隔 (秒)，None 表示休市時暫停，等到下次開盤
+    - holidays: 休市日集合，預設從 market_holidays.json 載入
+    同一時間只會有一次檢查在執行；檢查進行中再次觸發會被合併，不會另開執行緒。
+    """
+    def __init__(self, job, interval=CHECK_INTERVAL, closed_interval=None, holidays=None):
+        self.job = job
+        self.interval = interval
+        self.closed_interval = closed_interval
+        self.holidays = load_market_holidays() if holidays is None else holidays
+
+        self.next_run = None
+        self.last_started = None
+        self.last_duration = None
+        self.run_count = 0
+        self.coalesced_count = 0
+
+        self._running = False
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, run_immediately=True):
+        """啟動排程；run_immediately 為 True 時會先立即檢查一次"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        now = time.time()
+        with self._lock:
+            self.next_run = now if run_immediately else self._compute_next_run(now)
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止排程 (正在執行的檢查會跑完)"""
+        self._stop.set()
+        self._wake.set()
+
+    def run_now(self):
+        """
+        立即觸發一次檢查
+        回傳 False 表示目前已有檢查在執行，這次觸發已被合併
+        """
+        with self._lock:
+            if self._running:
+                self.coalesced_count += 1
+                return False
+            self.next_run = time.time()
+        self._wake.set()
+        return True
+
+    @property
+    def is_running(self):
+        return self._running
+
+    def stats(self):
+        """回傳排程狀態：下次檢查時間、上次開始時間與耗時、執行與合併次數"""
+        return {
+            'next_run': self.next_run,
+            'last_started': self.last_started,
+            'last_duration': self.last_duration,
+            'run_count': self.run_count,
+            'coalesced_count': self.coalesced_count,
+            'running': self._running,
+            'market_open': is_market_open(holidays=self.holidays),
+        }
+
+    def _compute_next_run(self, now):
+        if is_market_open(now, self.holidays):
+            return now + self.interval
+        if self.closed_interval is not None:
+            return now + self.closed_interval
+        return max(next_market_open(now, self.holidays), now + self.interval)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            # 先清除喚醒旗標再讀取 next_run：之後才呼叫的 run_now() 會讓 wait 立即返回
+            self._wake.clear()
+            with self._lock:
+                delay = self.next_run - time.time()
+            if delay > 0:
+                # 等待到下次檢查時間，或被 run_now()/stop() 提早喚醒後重新計算
+                self._wake.wait(delay)
+                continue
+            self._run_once()
+
+    def _run_once(self):
+        with self._lock:
+            self._running = True
+        self.last_started = time.time()
+        try:
+            self.job()
+        except Exception as e:
+            print(f"錯誤：定時檢查時發生錯誤: {e}")
+        finally:
+            finished = time.time()
+            self.last_duration = finished - self.last_started
+            self.run_count += 1
+            # 與 _running 一起更新 next_run：檢查結束後才呼叫的 run_now() 不會被覆蓋
+            with self._lock:
+                self._running = False
+                self.next_run = self._compute_next_run(finished)
+
 # --- 使用者介面函式 ---
 def add_stock():
     """引導使用者新增一支持股到追蹤清單"""
@@ -94,15 +1852,13 @@ def add_stock():
         print("錯誤：目標價必須是數字。")
         return
 
-    stocks = load_stocks()
+    watchlist = Watchlist()
+    new_stock = {'symbol': symbol, 'name': '', 'target_price': target_price} # name 暫時留空
     # 檢查是否已存在
-    if any(s['symbol'] == symbol for s in stocks):
+    if not watchlist.add(new_stock):
         print(f"錯誤：{symbol} 已經在您的追蹤清單中了。")
         return
-        
-    new_stock = {'symbol': symbol, 'name': '', 'target_price': target_price} # name 暫時留空
-    stocks.append(new_stock)
-    save_stocks(stocks)
+    watchlist.flush()
     print(f"成功新增 {symbol} 到追蹤清單，目標價為 {target_price}。")
 
 def list_stocks():
@@ -117,6 +1873,82 @@ def list_stocks():
         print(f"  - 股票代號: {stock['symbol']}, 目標價: {stock['target_price']}")
     print("--------------------------\n")
 
+def set_position():
+    """設定持股: python main.py position <股票代號> <股數> <每股平均成本>，股數為 0 表示清除持股"""
+    if len(sys.argv) < 5:
+        print("用法: python main.py position <股票代號> <股數> <每股平均成本>")
+        return
+    symbol = sys.argv[2]
+    try:
+        shares = float(sys.argv[3])
+        cost_basis = float(sys.argv[4])
+    except ValueError:
+        print("錯誤：股數與成本必須是數字。")
+        return
+    watchlist = Watchlist()
+    if shares > 0:
+        updated = watchlist.update(symbol, shares=shares, cost_basis=cost_basis)
+    else:
+        updated = watchlist.update(symbol, shares=None, cost_basis=None, lots=None)
+    if not updated:
+        print(f"錯誤：{symbol} 不在您的追蹤清單中。")
+        return
+    watchlist.flush()
+    print(f"已更新 {symbol} 的持股: {shares:g} 股，平均成本 {cost_basis:g}。")
+
+def show_portfolio():
+    """列出持股的市值與損益 (依分類小計)"""
+    stocks = [stock for stock in load_stocks() if stock_position(stock)[0] > 0]
+    if not stocks:
+        print("尚未設定任何持股，請先使用 'position' 指令。")
+        return
+    symbols = [stock['symbol'] for stock in stocks]
+    summary = summarize_portfolio(stocks, get_stock_prices(symbols), get_previous_closes(symbols))
+
+    def fmt(value, sign=False):
+        if value is None:
+            return "N/A"
+        return f"{value:+,.0f}" if sign else f"{value:,.0f}"
+
+    print("\n--- 持股損益 ---")
+    for category, subtotal in summary['categories'].items():
+        print(f"[{category}] 市值 {fmt(subtotal['market_value'])}，未實現損益 {fmt(subtotal['unrealized_pnl'], True)}，"
+              f"今日 {fmt(subtotal['day_change'], True)}")
+        for stock in stocks:
+            if stock.get('category', '未分類') != category:
+                continue
+            item = summary['stocks'][stock['symbol']]
+            pct = "" if item['unrealized_pct'] is None else f" ({item['unrealized_pct']:+.2f}%)"
+            print(f"  - {stock['symbol']}: {item['shares']:g} 股，市值 {fmt(item['market_value'])}，"
+                  f"未實現損益 {fmt(item['unrealized_pnl'], True)}{pct}，今日 {fmt(item['day_change'], True)}")
+    total = summary['total']
+    print(f"合計: 成本 {fmt(total['cost'])}，市值 {fmt(total['market_value'])}，"
+          f"未實現損益 {fmt(total['unrealized_pnl'], True)}，今日 {fmt(total['day_change'], True)}")
+    print("----------------\n")
+
+def watch_prices():
+    """在前景持續定時檢查股價，直到按下 Ctrl+C"""
+    scheduler = PriceCheckScheduler(check_prices)
+    scheduler.start()
+    print(f"已啟動定時檢查，交易時間內每 {CHECK_INTERVAL // 60} 分鐘檢查一次 (按 Ctrl+C 結束)。")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        scheduler.stop()
+        print("已停止定時檢查。")
+
+def show_history(symbol, limit=20):
+    """列出指定股票最近的報價紀錄"""
+    ticks = get_history_store().ticks(symbol)
+    if not len(ticks):
+        print(f"{symbol} 目前沒有任何報價紀錄。")
+        return
+    print(f"\n--- {symbol} 最近 {min(limit, len(ticks))} 筆報價 (共 {len(ticks)} 筆) ---")
+    for ts, price in ticks[-limit:]:
+        print(f"  {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))}  {price}")
+    print("--------------------------\n")
+
 def print_usage():
     """印出使用說明"""
     print("\n--- 股票價格監控小助理 ---")
@@ -124,6 +1956,11 @@ def print_usage():
     print("  python main.py add      - 新增一支持股到追蹤清單")
     print("  python main.py list     - 顯示目前追蹤的所有持股")
     print("  python main.py run      - 執行一次價格檢查")
+    print("  python main.py watch    - 在交易時間內定時檢查價格")
+    print("  python main.py history <股票代號> - 顯示該股票最近的報價紀錄")
+    print("  python main.py serve [埠號] - 以背景服務執行，並提供本機 HTTP API")
+    print("  python main.py position <股票代號> <股數> <成本> - 設定持股 (股數 0 表示清除)")
+    print("  python main.py portfolio - 顯示持股市值與損益")
     print("--------------------------\n")
 
 # --- 主程式進入點 ---
@@ -138,6 +1975,17 @@ if __name__ == '__main__':
             list_stocks()
         elif command == 'run':
             check_prices()
+        elif command == 'watch':
+            watch_prices()
+        elif command == 'history' and len(sys.argv) >= 3:
+            show_history(sys.argv[2])
+        elif command == 'position':
+            set_position()
+        elif command == 'portfolio':
+            show_portfolio()
+        elif command == 'serve':
+            import server
+            server.serve(int(sys.argv[2]) if len(sys.argv) >= 3 else server.SERVE_PORT)
         else:
             print(f"錯誤：未知的指令 '{command}'")
             print_usage()
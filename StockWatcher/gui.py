@@ -1,28 +1,72 @@
 import tkinter as tk
-from tkinter import ttk, messagebox, simpledialog, font
+from tkinter import ttk, messagebox, simpledialog, filedialog, font
 import json
+import queue
 import threading
-from collections import defaultdict
-import yfinance as yf
+import time
+from collections import defaultdict, deque
+
+import numpy as np
 
 # 從 core.py 匯入我們的核心邏輯函式
 import core
+from history_store import downsample_lttb, downsample_minmax
 
 # --- 全域變數和輔助函式 ---
-TW_STOCK_LIST = []
+TW_STOCK_INDEX = core.StockIndex([])
+# 日誌：UI 執行緒每隔多久 (毫秒) 批次寫入一次、畫面上最多保留的行數，
+# 超出的舊日誌會移到 LOG_FILE；記憶體中另外保留最近 LOG_EVENT_HISTORY 筆結構化紀錄供匯出
+LOG_FLUSH_INTERVAL_MS = 100
+LOG_MAX_LINES = 1000
+LOG_FILE = 'stockwatcher.log'
+LOG_EVENT_HISTORY = 5000
+# 走勢圖：高度 (像素)、顯示最近幾天的報價紀錄 (沒有報價紀錄時改用日 K 線)
+CHART_HEIGHT = 180
+CHART_WINDOW_DAYS = 365
+# 清單中的迷你走勢圖：顯示的點數、每支股票保留的最近報價數量，以及由低到高的字元
+SPARKLINE_POINTS = 12
+SPARKLINE_HISTORY = 500
+SPARKLINE_CHARS = "▁▂▃▄▅▆▇█"
 
 def load_tw_stock_list(logger):
-    """載入台股字典檔案"""
-    global TW_STOCK_LIST
+    """載入台股字典檔案，並建立查詢索引"""
+    global TW_STOCK_INDEX
     try:
-        with open('tw_stock_list.json', 'r', encoding='utf-8') as f:
-            TW_STOCK_LIST = json.load(f)
-        logger(f"成功載入 {len(TW_STOCK_LIST)} 筆股票資料。" )
+        TW_STOCK_INDEX = core.load_stock_index()
+        logger(f"成功載入 {len(TW_STOCK_INDEX)} 筆股票資料。" )
     except FileNotFoundError:
         logger("錯誤：找不到 'tw_stock_list.json'。請先執行 'update_stock_list.py'。" )
     except Exception as e:
         logger(f"載入股票資料時發生錯誤: {e}")
 
+# 對話視窗中可選的條件 (區間條件需要上下兩個價格，請直接編輯 stocks.json)
+CONDITION_CHOICES = [f"{condition} ({label})" for condition, label in core.CONDITION_LABELS.items() if condition != 'band']
+
+def condition_choice(condition):
+    """將條件代碼轉成下拉選單中的顯示文字，例如 '>= (目標賣價)'"""
+    return f"{condition} ({core.CONDITION_LABELS.get(condition, condition)})"
+
+def sparkline(values, points=SPARKLINE_POINTS):
+    """將一串價格轉換成 '▁▃▅█' 形式的迷你走勢圖文字"""
+    if len(values) < 2:
+        return ""
+    values = np.asarray(values, dtype=float)
+    _ts, sampled = downsample_lttb(np.arange(len(values), dtype=float), values, points)
+    low, high = sampled.min(), sampled.max()
+    if high == low:
+        return SPARKLINE_CHARS[len(SPARKLINE_CHARS) // 2] * len(sampled)
+    levels = ((sampled - low) / (high - low) * (len(SPARKLINE_CHARS) - 1)).round().astype(int)
+    return "".join(SPARKLINE_CHARS[level] for level in levels)
+
+def attach_autocomplete(combobox, limit=10):
+    """輸入時即時以台股索引查詢，將候選股票填入下拉選單"""
+    def on_key_release(event):
+        if event.keysym in ('Up', 'Down', 'Return', 'Escape', 'Tab'):
+            return
+        matches = TW_STOCK_INDEX.search(combobox.get(), limit)
+        combobox['values'] = [f"{stock['symbol']} {stock['name']}" for stock in matches]
+    combobox.bind('<KeyRelease>', on_key_release)
+
 class StockWatcherApp:
     def __init__(self, root):
         self.root = root
@@ -54,45 +98,92 @@ class StockWatcherApp:
         button_frame.pack(fill=tk.X)
         self.create_buttons(button_frame)
 
+        self.status_var = tk.StringVar()
+        ttk.Label(right_frame, textvariable=self.status_var, anchor=tk.W).pack(fill=tk.X, pady=(5, 0))
+
+        chart_frame = ttk.LabelFrame(right_frame, text="走勢圖")
+        chart_frame.pack(fill=tk.X, pady=(5, 0))
+        self.chart = ChartPanel(chart_frame)
+        self.tree.bind('<<TreeviewSelect>>', self.on_tree_select)
+
         log_frame = ttk.LabelFrame(right_frame, text="日誌")
         log_frame.pack(fill=tk.BOTH, expand=True, pady=(5, 0))
         self.log_text = self.create_log_text(log_frame)
         self.log_text.tag_configure("target_met", foreground="blue", font=('Microsoft JhengHei UI', 13, "bold"))
+        self.log_queue = queue.Queue()
+        self.price_queue = queue.Queue()
+        self.log_events = deque(maxlen=LOG_EVENT_HISTORY)
+        self.drain_ui_queues()
 
         self.log("歡迎使用！正在載入股票資料...")
-        load_tw_stock_list(self.log)
+        self.watchlist = core.Watchlist()
+        self.prices = {}
+        # 每支股票最近的報價，用來畫清單中的迷你走勢圖
+        self.recent_prices = {}
+        # 持股損益 (core.summarize_portfolio 的結果) 與計算今日損益用的前一日收盤價
+        self.portfolio = core.summarize_portfolio([], {})
+        self.previous_closes = {}
+        self.previous_closes_day = None
+        # 每支股票目前顯示在 Treeview 中的欄位內容，用來判斷哪些列需要更新
+        self.row_values = {}
+        self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
+        # 台股清單只有新增/編輯股票時才需要，在背景載入讓視窗先顯示出來
+        threading.Thread(target=load_tw_stock_list, args=(self.log,), daemon=True).start()
         self.refresh_stock_list()
-        self.run_price_check_threaded()
+        self.dispatcher = core.NotificationDispatcher(core.default_sinks(self.log))
+        self.dispatcher.start()
+        self.scheduler = core.PriceCheckScheduler(self.run_price_check)
+        # 等視窗畫出來之後才開始排程；第一次檢查會在背景執行緒載入 yfinance/pandas
+        self.root.after(100, self.scheduler.start)
+        self.update_status()
+
+    def on_closing(self):
+        self.scheduler.stop()
+        self.dispatcher.stop()
+        self.watchlist.flush()
+        self.root.destroy()
 
     def create_treeview(self, parent):
-        columns = ("symbol", "name", "condition", "target_price")
+        columns = ("symbol", "name", "condition", "target_price", "price", "trend",
+                   "market_value", "pnl", "day_change")
         tree = ttk.Treeview(parent, columns=columns, show="headings")
         tree.heading("symbol", text="股票代號")
         tree.heading("name", text="公司名稱")
         tree.heading("condition", text="條件")
         tree.heading("target_price", text="目標價")
+        tree.heading("price", text="目前價格")
+        tree.heading("trend", text="今日走勢")
+        tree.heading("market_value", text="市值")
+        tree.heading("pnl", text="未實現損益")
+        tree.heading("day_change", text="今日損益")
         tree.column("symbol", width=100, anchor=tk.W)
         tree.column("name", width=180, anchor=tk.W)
-        tree.column("condition", width=50, anchor=tk.CENTER)
+        tree.column("condition", width=130, anchor=tk.CENTER)
         tree.column("target_price", width=80, anchor=tk.E)
+        tree.column("price", width=80, anchor=tk.E)
+        tree.column("trend", width=130, anchor=tk.W)
+        tree.column("market_value", width=90, anchor=tk.E)
+        tree.column("pnl", width=120, anchor=tk.E)
+        tree.column("day_change", width=80, anchor=tk.E)
         tree.pack(fill=tk.BOTH, expand=True)
         return tree
 
     def create_buttons(self, parent):
         # Configure column weights to give more space to the 'Edit' button
-        for i in range(7):
+        for i in range(8):
             if i == 2:  # Column for '編輯股票/分類'
                 parent.columnconfigure(i, weight=2)
             else:
                 parent.columnconfigure(i, weight=1)
 
-        ttk.Button(parent, text="刷新列表", command=self.refresh_stock_list).grid(row=0, column=0, sticky="ew", padx=2)
+        ttk.Button(parent, text="刷新列表", command=self.reload_stock_list).grid(row=0, column=0, sticky="ew", padx=2)
         ttk.Button(parent, text="新增股票", command=self.add_stock_window).grid(row=0, column=1, sticky="ew", padx=2)
         ttk.Button(parent, text="編輯股票/分類", command=self.edit_stock).grid(row=0, column=2, sticky="ew", padx=2)
         ttk.Button(parent, text="刪除選取", command=self.remove_selected_stock).grid(row=0, column=3, sticky="ew", padx=2)
         ttk.Button(parent, text="執行檢查", command=self.run_price_check_threaded).grid(row=0, column=4, sticky="ew", padx=2)
         ttk.Button(parent, text="清除日誌", command=self.clear_log).grid(row=0, column=5, sticky="ew", padx=2)
-        ttk.Button(parent, text="說明", command=self.show_help).grid(row=0, column=6, sticky="ew", padx=2) # Add Help button
+        ttk.Button(parent, text="匯出日誌", command=self.export_log).grid(row=0, column=6, sticky="ew", padx=2)
+        ttk.Button(parent, text="說明", command=self.show_help).grid(row=0, column=7, sticky="ew", padx=2) # Add Help button
 
     def show_help(self):
         help_window = tk.Toplevel(self.root)
@@ -104,11 +195,12 @@ class StockWatcherApp:
             "股票價格監控小助理使用說明:\n\n"
             "1. 刷新列表: 手動從 stocks.json 檔案重新載入並顯示監控清單。\n\n"
             "2. 新增股票: 點擊「新增股票」，輸入股號(如 2330.TW)或公司名稱，\n   設定條件與目標價後新增。\n\n"
-            "3. 編輯/刪除: 在列表中選取一檔股票，點擊「編輯」或「刪除」按鈕。\n   刪除分類會一併刪除其下所有股票。\n\n"
+            "3. 編輯/刪除: 在列表中選取一檔股票，點擊「編輯」或「刪除」按鈕。\n   刪除分類會一併刪除其下所有股票。編輯時可填入持股數與平均成本，\n   清單會顯示市值與損益，分類列為該分類的小計。\n\n"
             "4. 排序: 選取一檔股票，點擊「上移」或「下移」來調整其在列表中的順序。\n\n"
-            "5. 執行檢查: 手動觸發一次價格檢查。程式預設會在背景定時檢查。\n\n"
-            "6. 日誌: 顯示程式的操作記錄、股價檢查結果和達標通知。\n\n"
-            "7. 資料保存: 所有監控清單的變更都會自動儲存。"
+            f"5. 執行檢查: 手動觸發一次價格檢查。程式會在交易時間內每 {core.CHECK_INTERVAL // 60} 分鐘\n   於背景自動檢查，休市時暫停。\n\n"
+            "6. 日誌: 顯示程式的操作記錄、股價檢查結果和達標通知。畫面只保留最近的記錄，\n   較舊的會存到 stockwatcher.log；「匯出日誌」可將記錄存成 JSON 檔。\n\n"
+            "7. 走勢圖: 在列表中選取一檔股票，右側會畫出其歷史報價走勢；「今日走勢」欄\n   顯示當天的迷你走勢圖。\n\n"
+            "8. 資料保存: 所有監控清單的變更都會自動儲存。"
         )
         
         msg_font = ('Microsoft JhengHei UI', 12)
@@ -129,41 +221,255 @@ class StockWatcherApp:
         return log_text
 
     def log(self, message, tag=None):
-        self.root.after(0, self._log_thread_safe, message, tag)
+        # 任何執行緒都可以呼叫，訊息先放進佇列，由 UI 執行緒定時批次寫入
+        self.log_queue.put({'time': time.time(), 'message': message, 'tag': tag})
 
-    def _log_thread_safe(self, message, tag=None):
+    def drain_ui_queues(self):
+        """UI 執行緒定時把佇列中的日誌與最新股價一次寫到畫面上"""
+        try:
+            records = []
+            while True:
+                try:
+                    records.append(self.log_queue.get_nowait())
+                except queue.Empty:
+                    break
+            if records:
+                self.log_events.extend(records)
+                self.write_log_records(records)
+
+            prices_changed = False
+            while True:
+                try:
+                    symbol, price = self.price_queue.get_nowait()
+                except queue.Empty:
+                    break
+                self.update_price_cell(symbol, price)
+                prices_changed = True
+            if prices_changed:
+                # 一批報價只重新計算一次損益
+                self.refresh_portfolio_cells()
+        finally:
+            self.root.after(LOG_FLUSH_INTERVAL_MS, self.drain_ui_queues)
+
+    def write_log_records(self, records):
+        # 一次 insert 寫入整批訊息 (Text.insert 可接受多組 文字, 標籤)
+        chunks = []
+        for record in records:
+            chunks.extend((record['message'] + "\n", record['tag'] or ()))
         self.log_text.config(state="normal")
-        if tag:
-            self.log_text.insert(tk.END, message + "\n", tag)
-        else:
-            self.log_text.insert(tk.END, message + "\n")
+        self.log_text.insert(tk.END, *chunks)
+
+        # 只保留最後 LOG_MAX_LINES 行，較舊的移到日誌檔
+        line_count = int(self.log_text.index('end-1c').split('.')[0])
+        excess = line_count - LOG_MAX_LINES
+        if excess > 0:
+            old_text = self.log_text.get('1.0', f'{excess + 1}.0')
+            self.log_text.delete('1.0', f'{excess + 1}.0')
+            try:
+                with open(LOG_FILE, 'a', encoding='utf-8') as f:
+                    f.write(old_text)
+            except OSError as e:
+                print(f"無法寫入日誌檔 {LOG_FILE}: {e}")
+
         self.log_text.see(tk.END)
         self.log_text.config(state="disabled")
+
+    def export_log(self):
+        path = filedialog.asksaveasfilename(
+            title="匯出日誌", defaultextension=".jsonl",
+            filetypes=[("JSON Lines", "*.jsonl"), ("所有檔案", "*.*")],
+        )
+        if not path:
+            return
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                for record in self.log_events:
+                    event = dict(record, time=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record['time'])))
+                    f.write(json.dumps(event, ensure_ascii=False) + "\n")
+        except OSError as e:
+            messagebox.showerror("錯誤", f"匯出日誌時發生錯誤: {e}")
+            return
+        self.log(f"已匯出 {len(self.log_events)} 筆日誌到 {path}。")
     
     def clear_log(self):
         self.log_text.config(state="normal")
         self.log_text.delete(1.0, tk.END)
         self.log_text.config(state="disabled")
 
+    def reload_stock_list(self):
+        # 「刷新列表」按鈕：若 stocks.json 被其他程式修改過，先重新載入
+        if self.watchlist.reload_if_changed():
+            self.log("偵測到 stocks.json 已被修改，已重新載入。")
+        self.refresh_stock_list()
+        self.log("刷新完畢。" )
+
     def refresh_stock_list(self):
-        self.log("正在刷新股票清單...")
-        for item in self.tree.get_children():
-            self.tree.delete(item)
-        
-        stocks = core.load_stocks()
-        
+        """
+        依監控清單更新 Treeview，只新增、刪除、移動或修改有變動的列
+        股票列的 item ID 就是股票代號，分類列為 "category:<分類名稱>"，
+        所以選取狀態與捲動位置在更新後都會保留。
+        """
+        stocks = self.watchlist.stocks()
+        self.update_portfolio(stocks)
         grouped_stocks = defaultdict(list)
         for stock in stocks:
             category = stock.get('category', '未分類')
             grouped_stocks[category].append(stock)
 
+        # 先刪除已不在清單中的股票，避免後面的列因為位置偏移而被逐一移動
+        desired_stocks = {stock['symbol'] for stock_list in grouped_stocks.values() for stock in stock_list}
+        for category_id in self.tree.get_children():
+            for symbol in self.tree.get_children(category_id):
+                if symbol not in desired_stocks:
+                    self.tree.delete(symbol)
+                    self.row_values.pop(symbol, None)
+
+        desired_categories = []
         for category, stock_list in sorted(grouped_stocks.items()):
-            category_id = self.tree.insert("", tk.END, text=category, open=True, values=(category, "", "", ""))
-            for stock in stock_list:
-                condition = stock.get('condition', '>=' )
-                self.tree.insert(category_id, tk.END, values=(stock['symbol'], stock.get('name', 'N/A'), condition, stock['target_price']))
-        
-        self.log("刷新完畢。" )
+            category_id = f"category:{category}"
+            desired_categories.append(category_id)
+            category_values = self.category_row_values(category)
+            if not self.tree.exists(category_id):
+                self.tree.insert("", tk.END, iid=category_id, text=category, open=True, values=category_values)
+                self.row_values[category_id] = category_values
+            else:
+                self.set_row_values(category_id, category_values)
+
+            children = list(self.tree.get_children(category_id))
+            for index, stock in enumerate(stock_list):
+                symbol = stock['symbol']
+                values = self.stock_row_values(stock)
+                if not self.tree.exists(symbol):
+                    self.tree.insert(category_id, index, iid=symbol, values=values)
+                    self.row_values[symbol] = values
+                    children.insert(index, symbol)
+                    continue
+                if index >= len(children) or children[index] != symbol:
+                    self.tree.move(symbol, category_id, index)
+                    if symbol in children:
+                        children.remove(symbol)
+                    children.insert(index, symbol)
+                self.set_row_values(symbol, values)
+
+        # 股票都已搬到新的分類後，才刪除空掉的分類並調整分類順序
+        for category_id in self.tree.get_children():
+            if category_id not in desired_categories:
+                self.tree.delete(category_id)
+                self.row_values.pop(category_id, None)
+        for index, category_id in enumerate(desired_categories):
+            if self.tree.index(category_id) != index:
+                self.tree.move(category_id, "", index)
+
+    def stock_row_values(self, stock):
+        """Treeview 中一支股票的欄位內容 (全部轉成字串，以便與 row_values 比對)"""
+        price = self.prices.get(stock['symbol'])
+        return (
+            stock['symbol'],
+            stock.get('name', 'N/A'),
+            condition_choice(stock.get('condition', '>=')),
+            str(stock['target_price']),
+            "" if price is None else str(price),
+            sparkline(self.recent_prices.get(stock['symbol'], ())),
+        ) + self.portfolio_cells(self.portfolio['stocks'].get(stock['symbol']))
+
+    def category_row_values(self, category):
+        """分類列的欄位內容：名稱與持股損益小計"""
+        return (category, "", "", "", "", "") + self.portfolio_cells(self.portfolio['categories'].get(category))
+
+    @staticmethod
+    def portfolio_cells(item):
+        """將持股損益轉換成 市值、未實現損益、今日損益 三個欄位的文字"""
+        if not item or item['market_value'] is None:
+            return ("", "", "")
+        pnl = f"{item['unrealized_pnl']:+,.0f}"
+        if item['unrealized_pct'] is not None:
+            pnl += f" ({item['unrealized_pct']:+.1f}%)"
+        day_change = "" if item['day_change'] is None else f"{item['day_change']:+,.0f}"
+        return (f"{item['market_value']:,.0f}", pnl, day_change)
+
+    def set_row_values(self, iid, values):
+        """內容有變動時才更新 Treeview 中的一列"""
+        if self.row_values.get(iid) != values:
+            self.tree.item(iid, values=values)
+            self.row_values[iid] = values
+
+    def update_portfolio(self, stocks):
+        """以目前的報價重新計算持股損益"""
+        held = [stock['symbol'] for stock in stocks if core.stock_position(stock)[0] > 0]
+        today = time.strftime('%Y-%m-%d')
+        if today != self.previous_closes_day:
+            self.previous_closes = {}
+            self.previous_closes_day = today
+        missing = [symbol for symbol in held if symbol not in self.previous_closes]
+        if missing:
+            try:
+                self.previous_closes.update(core.get_previous_closes(missing))
+            except OSError as e:
+                self.log(f"讀取前一日收盤價時發生錯誤: {e}")
+            # 查不到的股票也記下來，今天不再重複讀取
+            for symbol in missing:
+                self.previous_closes.setdefault(symbol, None)
+        previous = {symbol: close for symbol, close in self.previous_closes.items() if close is not None}
+        self.portfolio = core.summarize_portfolio(stocks, self.prices, previous)
+
+    def refresh_portfolio_cells(self):
+        """報價更新後，只更新持股與分類小計的損益欄位"""
+        stocks = self.watchlist.stocks()
+        self.update_portfolio(stocks)
+        for stock in stocks:
+            symbol = stock['symbol']
+            if symbol in self.portfolio['stocks'] and self.tree.exists(symbol):
+                self.set_row_values(symbol, self.stock_row_values(stock))
+        for category in self.portfolio['categories']:
+            category_id = f"category:{category}"
+            if self.tree.exists(category_id):
+                self.set_row_values(category_id, self.category_row_values(category))
+
+    def update_price_cell(self, symbol, price):
+        """在 UI 執行緒中直接更新一列的目前價格與迷你走勢圖，不重建整個列表"""
+        self.prices[symbol] = price
+        if symbol not in self.recent_prices:
+            # 第一次收到報價時，從歷史資料庫載入今天稍早的報價
+            self.recent_prices[symbol] = deque(self.load_today_prices(symbol), maxlen=SPARKLINE_HISTORY)
+        recent = self.recent_prices[symbol]
+        if not recent or recent[-1] != price:
+            recent.append(price)
+        self.chart.append(symbol, time.time(), price)
+        if self.tree.exists(symbol):
+            trend = sparkline(recent)
+            self.tree.set(symbol, "price", price)
+            self.tree.set(symbol, "trend", trend)
+            values = self.row_values[symbol]
+            self.row_values[symbol] = values[:4] + (str(price), trend) + values[6:]
+
+    def load_today_prices(self, symbol):
+        today = time.localtime()
+        today_start = time.mktime((today.tm_year, today.tm_mon, today.tm_mday, 0, 0, 0, 0, 0, -1))
+        try:
+            return core.get_history_store().ticks(symbol, start=today_start)['price'].tolist()
+        except OSError:
+            return []
+
+    def on_tree_select(self, event=None):
+        selected = self.tree.selection()
+        if len(selected) != 1 or not self.tree.parent(selected[0]):
+            return
+        symbol = selected[0]
+        if symbol == self.chart.symbol:
+            return
+        store = core.get_history_store()
+        start = time.time() - CHART_WINDOW_DAYS * 24 * 60 * 60
+        try:
+            ticks = store.ticks(symbol, start=start)
+            if len(ticks) >= 2:
+                ts, values = ticks['ts'], ticks['price']
+            else:
+                bars = store.bars(symbol, start=start)
+                ts, values = bars['ts'], bars['close']
+        except OSError as e:
+            self.log(f"讀取 {symbol} 的歷史資料時發生錯誤: {e}")
+            return
+        self.chart.show(symbol, ts, values)
 
     def add_stock_window(self):
         dialog = AddStockDialog(self.root, "新增股票")
@@ -178,7 +484,6 @@ class StockWatcherApp:
                 messagebox.showerror("錯誤", f"新增股票時發生錯誤: {e}")
 
     def find_and_add_stock(self, query, target_price, condition, category):
-        found_stock = None
         query = query.strip()
 
         if not query:
@@ -188,38 +493,21 @@ class StockWatcherApp:
         if not category:
             category = "未分類"
 
-        if '.' in query:
-            for stock in TW_STOCK_LIST:
-                if stock['symbol'].upper() == query.upper():
-                    found_stock = stock
-                    break
-        else:
-            for stock in TW_STOCK_LIST:
-                if stock['name'] == query:
-                    found_stock = stock
-                    break
-        
+        found_stock = TW_STOCK_INDEX.find(query)
         if not found_stock:
             messagebox.showwarning("找不到", f"找不到符合 '{query}' 的股票代號或名稱。" )
             return
 
-        try:
-            self.log(f"正在驗證股票資訊: {found_stock['symbol']}...")
-            ticker = yf.Ticker(found_stock['symbol'])
-            info = ticker.info
-            long_name = info.get('longName', found_stock['name'])
-        except Exception as e:
-            self.log(f"驗證 {found_stock['symbol']} 失敗: {e}。將使用本地資料。" )
+        self.log(f"正在驗證股票資訊: {found_stock['symbol']}...")
+        long_name = core.get_stock_name(found_stock['symbol'])
+        if long_name is None:
+            self.log(f"驗證 {found_stock['symbol']} 失敗。將使用本地資料。" )
             long_name = found_stock['name']
 
-        stocks = core.load_stocks()
-        if any(s['symbol'] == found_stock['symbol'] for s in stocks):
+        new_stock = {'symbol': found_stock['symbol'], 'name': long_name, 'target_price': target_price, 'condition': condition, 'category': category}
+        if not self.watchlist.add(new_stock):
             messagebox.showwarning("已存在", f"{long_name} ({found_stock['symbol']}) 已經在您的監控清單中。" )
             return
-
-        new_stock = {'symbol': found_stock['symbol'], 'name': long_name, 'target_price': target_price, 'condition': condition, 'category': category}
-        stocks.append(new_stock)
-        core.save_stocks(stocks)
         
         messagebox.showinfo("成功", f"已成功新增 {long_name} 到監控清單。" )
         self.refresh_stock_list()
@@ -239,15 +527,8 @@ class StockWatcherApp:
             messagebox.showwarning("提示", "不能編輯分類本身，請選擇一支持股。")
             return
 
-        original_symbol = self.tree.item(selected_item, "values")[0]
-        stocks = core.load_stocks()
-        
-        stock_to_edit = None
-        for s in stocks:
-            if s['symbol'] == original_symbol:
-                stock_to_edit = s
-                break
-        
+        original_symbol = selected_item
+        stock_to_edit = self.watchlist.get(original_symbol)
         if not stock_to_edit:
             messagebox.showerror("錯誤", "在資料庫中找不到所選的股票。")
             return
@@ -255,7 +536,7 @@ class StockWatcherApp:
         dialog = EditStockDialog(self.root, "編輯股票/分類", initial_data=stock_to_edit)
 
         if dialog.result:
-            new_query, new_target_price_str, new_condition, new_category = dialog.result
+            new_query, new_target_price_str, new_condition, new_category, shares_str, cost_str = dialog.result
             
             try:
                 new_target_price = float(new_target_price_str)
@@ -263,56 +544,49 @@ class StockWatcherApp:
                 messagebox.showerror("錯誤", "目標價必須是有效的數字。")
                 return
 
+            position = {}
+            if shares_str is not None:
+                try:
+                    shares = float(shares_str) if shares_str.strip() else 0.0
+                    cost_basis = float(cost_str) if cost_str.strip() else 0.0
+                except ValueError:
+                    messagebox.showerror("錯誤", "持股數與成本必須是有效的數字。")
+                    return
+                position = {'shares': shares, 'cost_basis': cost_basis} if shares > 0 else {'shares': None, 'cost_basis': None, 'lots': None}
+
             if not new_category.strip():
                 new_category = "未分類"
             else:
                 new_category = new_category.strip()
 
             # 檢查股票代號/名稱是否有變更
-            if new_query.strip().upper() == original_symbol.upper() or new_query.strip() == stock_to_edit.get('name'):
+            # 自動完成的選項格式為 "代號 名稱"，只比對代號部分
+            query_symbol = new_query.strip().split(' ')[0]
+            if query_symbol.upper() == original_symbol.upper() or new_query.strip() == stock_to_edit.get('name'):
                 # 股票本身沒變，只更新其他資訊
-                stock_to_edit['target_price'] = new_target_price
-                stock_to_edit['condition'] = new_condition
-                stock_to_edit['category'] = new_category
-                core.save_stocks(stocks)
+                self.watchlist.update(original_symbol, target_price=new_target_price,
+                                      condition=new_condition, category=new_category, **position)
                 self.log(f"已更新 {original_symbol} 的資訊。")
                 self.refresh_stock_list()
             else:
                 # 股票代號/名稱變了，需要重新查找和驗證
                 self.log(f"正在查找新的股票資訊: {new_query}...")
                 
-                found_stock_info = None
-                _query = new_query.strip()
-                if '.' in _query:
-                    for stock in TW_STOCK_LIST:
-                        if stock['symbol'].upper() == _query.upper():
-                            found_stock_info = stock
-                            break
-                else:
-                    for stock in TW_STOCK_LIST:
-                        if stock['name'] == _query:
-                            found_stock_info = stock
-                            break
-                
+                found_stock_info = TW_STOCK_INDEX.find(new_query)
                 if not found_stock_info:
                     messagebox.showwarning("找不到", f"找不到符合 '{new_query}' 的股票代號或名稱。")
                     return
 
                 new_symbol = found_stock_info['symbol']
                 
-                # 檢查新股號是否已存在於列表中 (排除自己)
-                if any(s['symbol'] == new_symbol and s['symbol'] != original_symbol for s in stocks):
+                # 更新股票資訊 (新股號已存在於列表中時會失敗)
+                updated = self.watchlist.update(original_symbol, symbol=new_symbol, name=found_stock_info['name'],
+                                                target_price=new_target_price, condition=new_condition,
+                                                category=new_category, **position)
+                if not updated:
                     messagebox.showwarning("已存在", f"{found_stock_info['name']} ({new_symbol}) 已經在您的監控清單中。")
                     return
                 
-                # 更新股票資訊
-                stock_to_edit['symbol'] = new_symbol
-                stock_to_edit['name'] = found_stock_info['name']
-                stock_to_edit['target_price'] = new_target_price
-                stock_to_edit['condition'] = new_condition
-                stock_to_edit['category'] = new_category
-                
-                core.save_stocks(stocks)
                 self.log(f"已將 {original_symbol} 更改為 {new_symbol}。")
                 self.refresh_stock_list()
 
@@ -325,22 +599,17 @@ class StockWatcherApp:
         if not messagebox.askyesno("確認", "您確定要刪除選取的項目嗎？\n(如果選取的是分類，將會刪除該分類下的所有股票)"):
             return
 
-        stocks = core.load_stocks()
         symbols_to_delete = set()
 
         for item_id in selected_items:
             if not self.tree.parent(item_id):
                 category_name = self.tree.item(item_id, "text")
-                for stock in stocks:
-                    if stock.get('category', '未分類') == category_name:
-                        symbols_to_delete.add(stock['symbol'])
+                symbols_to_delete.update(self.watchlist.symbols_in_category(category_name))
             else:
-                symbols_to_delete.add(self.tree.item(item_id, "values")[0])
-        
-        new_stocks = [s for s in stocks if s['symbol'] not in symbols_to_delete]
+                symbols_to_delete.add(item_id)
         
-        core.save_stocks(new_stocks)
-        self.log(f"已刪除 {len(stocks) - len(new_stocks)} 筆資料。" )
+        removed = self.watchlist.remove(symbols_to_delete)
+        self.log(f"已刪除 {removed} 筆資料。" )
         self.refresh_stock_list()
 
     def move_stock(self, direction):
@@ -358,36 +627,17 @@ class StockWatcherApp:
             messagebox.showwarning("提示", "只能對股票進行排序，不能移動分類。" )
             return
 
-        current_symbol = self.tree.item(selected_item, "values")[0]
-        stocks = core.load_stocks()
-        
-        current_index = -1
-        for i, stock in enumerate(stocks):
-            if stock['symbol'] == current_symbol:
-                current_index = i
-                break
-        
-        if current_index == -1:
+        current_symbol = selected_item
+        if current_symbol not in self.watchlist:
             self.log("錯誤：在資料中找不到選取的股票。" )
             return
 
-        new_index = current_index + direction
-
-        if not (0 <= new_index < len(stocks)):
+        if not self.watchlist.move(current_symbol, direction):
             return 
 
-        stocks[current_index], stocks[new_index] = stocks[new_index], stocks[current_index]
-        
-        core.save_stocks(stocks)
+        # 列表只移動這一列，選取狀態會保留
         self.refresh_stock_list()
-        
-        for category_id in self.tree.get_children():
-            for item_id in self.tree.get_children(category_id):
-                if self.tree.item(item_id, "values")[0] == current_symbol:
-                    self.tree.selection_set(item_id)
-                    self.tree.focus(item_id)
-                    self.tree.see(item_id)
-                    return
+        self.tree.see(current_symbol)
 
     def move_stock_up(self):
         self.move_stock(-1)
@@ -396,37 +646,121 @@ class StockWatcherApp:
         self.move_stock(1)
 
     def run_price_check_threaded(self):
-        self.log("開始執行價格檢查 (背景執行)...")
-        thread = threading.Thread(target=self.run_price_check)
-        thread.daemon = True
-        thread.start()
+        if not self.scheduler.run_now():
+            self.log("價格檢查正在進行中，本次請求已合併。")
+
+    def update_status(self):
+        if self.watchlist.reload_if_changed():
+            self.log("偵測到 stocks.json 已被修改，已重新載入。")
+            self.refresh_stock_list()
+        stats = self.scheduler.stats()
+        parts = ["檢查中..." if stats['running'] else ("交易時間" if stats['market_open'] else "休市中")]
+        if stats['next_run'] and not stats['running']:
+            parts.append(f"下次檢查: {time.strftime('%m/%d %H:%M:%S', time.localtime(stats['next_run']))}")
+        if core.sweep_timer.last_summary:
+            parts.append(core.format_sweep_summary(core.sweep_timer.last_summary))
+        elif stats['last_duration'] is not None:
+            parts.append(f"上次耗時: {stats['last_duration']:.1f} 秒")
+        self.status_var.set("  |  ".join(parts))
+        self.root.after(1000, self.update_status)
 
     def run_price_check(self):
-        stocks = core.load_stocks()
+        self.log("開始執行價格檢查 (背景執行)...")
+        stocks = self.watchlist.stocks()
         if not stocks:
             self.log("您的追蹤清單是空的。" )
             return
 
-        for stock in stocks:
-            price = core.get_stock_price(stock['symbol'])
-            if price is not None:
-                target_price = stock['target_price']
-                condition = stock.get('condition', '>=' )
-                self.log(f"  -> {stock['symbol']} 目前:{price}, 條件: {condition} {target_price}")
-                
-                is_target_met = False
-                if condition == '>=' and price >= target_price:
-                    is_target_met = True
-                elif condition == '<=' and price <= target_price:
-                    is_target_met = True
-                
-                if is_target_met:
-                    notification_message = f"🎉 **達標通知** 🎉\n股票 {stock['symbol']} ({stock.get('name', '')})\n已達到目標! (目前: {price} {condition} 目標: {target_price})"
-                    self.log("="*40)
-                    self.log(notification_message, tag="target_met")
-                    self.log("="*40)
+        def on_price(stock, price):
+            self.price_queue.put((stock['symbol'], price))
+            rules = "、".join(core.describe_rule(rule) for rule in core.stock_rules(stock))
+            self.log(f"  -> {stock['symbol']} 目前:{price}, 條件: {rules}")
+
+        core.run_alert_sweep(stocks, self.dispatcher, on_price)
         self.log("檢查完畢。" )
 
+class ChartPanel:
+    """
+    選取股票的走勢圖
+    資料點多於圖寬時先以 min-max 降低取樣 (每個像素最多兩點) 再畫成一條折線；
+    收到新報價時，只要還在目前的座標範圍內就直接把點接到折線後面，不重畫整張圖。
+    """
+    PADDING = 30
+
+    def __init__(self, parent, height=CHART_HEIGHT):
+        self.canvas = tk.Canvas(parent, height=height, background="white", highlightthickness=0)
+        self.canvas.pack(fill=tk.X, expand=True)
+        self.canvas.bind('<Configure>', lambda event: self.redraw())
+        self.symbol = None
+        self.ts = np.empty(0)
+        self.values = np.empty(0)
+        self._line = None
+        self._last_label = None
+        self._bounds = None  # (最早時間, 最晚時間, 最低價, 最高價)
+
+    def show(self, symbol, ts, values):
+        self.symbol = symbol
+        self.ts = np.asarray(ts, dtype=float)
+        self.values = np.asarray(values, dtype=float)
+        self.redraw()
+
+    def append(self, symbol, timestamp, price):
+        """加入一筆新報價；不是目前顯示的股票時忽略"""
+        if symbol != self.symbol or (len(self.ts) and timestamp <= self.ts[-1]):
+            return
+        self.ts = np.append(self.ts, timestamp)
+        self.values = np.append(self.values, price)
+        if self._line is None or self._bounds is None:
+            self.redraw()
+            return
+        ts_low, ts_high, low, high = self._bounds
+        if not (timestamp <= ts_high and low <= price <= high):
+            # 超出目前的座標範圍，重新計算座標並重畫
+            self.redraw()
+            return
+        x, y = self._to_canvas(timestamp, price)
+        self.canvas.coords(self._line, *self.canvas.coords(self._line), x, y)
+        self.canvas.itemconfigure(self._last_label, text=f"{price:g}")
+
+    def _to_canvas(self, timestamp, price):
+        ts_low, ts_high, low, high = self._bounds
+        width = max(self.canvas.winfo_width(), 1) - 2 * self.PADDING
+        height = max(self.canvas.winfo_height(), 1) - 2 * self.PADDING
+        x = self.PADDING + (timestamp - ts_low) / (ts_high - ts_low) * width
+        y = self.PADDING + (high - price) / (high - low) * height
+        return x, y
+
+    def redraw(self):
+        canvas = self.canvas
+        canvas.delete("all")
+        self._line = self._last_label = self._bounds = None
+        if self.symbol is None:
+            return
+        canvas.create_text(self.PADDING, 5, text=self.symbol, anchor=tk.NW)
+        if len(self.ts) < 2:
+            canvas.create_text(canvas.winfo_width() // 2, canvas.winfo_height() // 2, text="尚無足夠的歷史資料")
+            return
+
+        width = max(canvas.winfo_width() - 2 * self.PADDING, 1)
+        ts, values = downsample_minmax(self.ts, self.values, width)
+        low, high = float(values.min()), float(values.max())
+        margin = (high - low) * 0.05 or max(abs(high) * 0.01, 0.01)
+        span = ts[-1] - ts[0]
+        # 右側與上下保留一些空間，新報價落在範圍內時可以直接接在折線後面
+        self._bounds = (ts[0], ts[-1] + span * 0.05, low - margin, high + margin)
+
+        coords = []
+        for timestamp, price in zip(ts, values):
+            coords.extend(self._to_canvas(timestamp, price))
+        self._line = canvas.create_line(*coords, fill="steelblue", width=1.5)
+
+        right = canvas.winfo_width() - self.PADDING
+        canvas.create_text(right, 5, text=f"高 {high:g} / 低 {low:g}", anchor=tk.NE)
+        canvas.create_text(self.PADDING, canvas.winfo_height() - 5, anchor=tk.SW,
+                           text=time.strftime('%Y/%m/%d', time.localtime(ts[0])))
+        self._last_label = canvas.create_text(right, canvas.winfo_height() - 5, anchor=tk.SE,
+                                              text=f"{values[-1]:g}")
+
 class EditStockDialog(simpledialog.Dialog):
     """編輯股票的對話視窗"""
     def __init__(self, parent, title, initial_data):
@@ -435,7 +769,8 @@ class EditStockDialog(simpledialog.Dialog):
 
     def body(self, master):
         ttk.Label(master, text="股號 (可改) 或公司名稱:").grid(row=0, columnspan=2, sticky=tk.W)
-        self.entry_query = ttk.Entry(master, width=40)
+        self.entry_query = ttk.Combobox(master, width=38)
+        attach_autocomplete(self.entry_query)
         self.entry_query.grid(row=1, columnspan=2, sticky=tk.W+tk.E, pady=5)
         self.entry_query.insert(0, self.initial_data.get('symbol', ''))
 
@@ -446,19 +781,31 @@ class EditStockDialog(simpledialog.Dialog):
 
         ttk.Label(master, text="條件:").grid(row=4, column=0, sticky=tk.W)
         self.condition_var = tk.StringVar()
-        current_condition_map = {
-            '>=': '>= (目標賣價)',
-            '<=': '<= (目標買價)'
-        }
-        self.condition_var.set(current_condition_map.get(self.initial_data.get('condition'), '>= (目標賣價)'))
-        self.combo_condition = ttk.Combobox(master, textvariable=self.condition_var, values=['>= (目標賣價)', '<= (目標買價)'], state='readonly')
+        self.condition_var.set(condition_choice(self.initial_data.get('condition', '>=')))
+        self.combo_condition = ttk.Combobox(master, textvariable=self.condition_var, values=CONDITION_CHOICES, state='readonly')
         self.combo_condition.grid(row=5, column=0, sticky=tk.W, padx=(0, 5))
 
-        ttk.Label(master, text="目標價:").grid(row=4, column=1, sticky=tk.W)
+        ttk.Label(master, text="目標價/數值:").grid(row=4, column=1, sticky=tk.W)
         self.entry_price = ttk.Entry(master, width=15)
         self.entry_price.grid(row=5, column=1, sticky=tk.W)
         self.entry_price.insert(0, self.initial_data.get('target_price', ''))
-        
+
+        # 持股 (可空白)；以 lots 記錄分批買進的股票只能直接編輯 stocks.json
+        self.entry_shares = self.entry_cost = None
+        if self.initial_data.get('lots'):
+            shares, _cost = core.stock_position(self.initial_data)
+            ttk.Label(master, text=f"持股: {shares:g} 股 (依 lots 計算)").grid(row=6, columnspan=2, sticky=tk.W, pady=(5, 0))
+        else:
+            ttk.Label(master, text="持股數 (可空白):").grid(row=6, column=0, sticky=tk.W, pady=(5, 0))
+            ttk.Label(master, text="每股平均成本:").grid(row=6, column=1, sticky=tk.W, pady=(5, 0))
+            self.entry_shares = ttk.Entry(master, width=15)
+            self.entry_shares.grid(row=7, column=0, sticky=tk.W)
+            self.entry_cost = ttk.Entry(master, width=15)
+            self.entry_cost.grid(row=7, column=1, sticky=tk.W)
+            if self.initial_data.get('shares'):
+                self.entry_shares.insert(0, f"{self.initial_data['shares']:g}")
+                self.entry_cost.insert(0, f"{self.initial_data.get('cost_basis') or 0:g}")
+
         return self.entry_query
 
     def apply(self):
@@ -466,9 +813,12 @@ class EditStockDialog(simpledialog.Dialog):
         price = self.entry_price.get()
         condition = self.condition_var.get().split(' ')[0]
         category = self.entry_category.get()
-        
+        # None 表示不修改持股
+        shares = self.entry_shares.get() if self.entry_shares else None
+        cost = self.entry_cost.get() if self.entry_cost else None
+
         if query and price and condition:
-            self.result = (query, price, condition, category)
+            self.result = (query, price, condition, category, shares, cost)
         else:
             self.result = None
 
@@ -477,7 +827,8 @@ class AddStockDialog(simpledialog.Dialog):
     """新增股票的對話視窗"""
     def body(self, master):
         ttk.Label(master, text="輸入股號 (如 2330.TW) 或公司名稱 (如 台積電):" ).grid(row=0, columnspan=2, sticky=tk.W)
-        self.entry_query = ttk.Entry(master, width=40)
+        self.entry_query = ttk.Combobox(master, width=38)
+        attach_autocomplete(self.entry_query)
         self.entry_query.grid(row=1, columnspan=2, sticky=tk.W+tk.E, pady=5)
 
         ttk.Label(master, text="分類 (可選):" ).grid(row=2, columnspan=2, sticky=tk.W)
@@ -485,11 +836,11 @@ class AddStockDialog(simpledialog.Dialog):
         self.entry_category.grid(row=3, columnspan=2, sticky=tk.W+tk.E, pady=5)
 
         ttk.Label(master, text="條件:" ).grid(row=4, column=0, sticky=tk.W)
-        self.condition_var = tk.StringVar(value='>= (目標賣價)')
-        self.combo_condition = ttk.Combobox(master, textvariable=self.condition_var, values=['>= (目標賣價)', '<= (目標買價)'], state='readonly')
+        self.condition_var = tk.StringVar(value=CONDITION_CHOICES[0])
+        self.combo_condition = ttk.Combobox(master, textvariable=self.condition_var, values=CONDITION_CHOICES, state='readonly')
         self.combo_condition.grid(row=5, column=0, sticky=tk.W, padx=(0, 5))
 
-        ttk.Label(master, text="目標價:" ).grid(row=4, column=1, sticky=tk.W)
+        ttk.Label(master, text="目標價/數值:" ).grid(row=4, column=1, sticky=tk.W)
         self.entry_price = ttk.Entry(master, width=15)
         self.entry_price.grid(row=5, column=1, sticky=tk.W)
         
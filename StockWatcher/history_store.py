@@ -0,0 +1,242 @@
+import bisect
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+# --- 常數設定 ---
+# 股價歷史資料存放的資料夾
+HISTORY_DIR = 'price_history'
+# 每支股票每種資料最多佔用的磁碟空間 (位元組)，超過時捨棄最舊的一半
+HISTORY_MAX_BYTES = 4 * 1024 * 1024
+
+# 每筆資料的固定欄位格式，檔案內容就是這些紀錄依時間順序接在一起
+TICK_DTYPE = np.dtype([('ts', '<f8'), ('price', '<f8')])
+BAR_DTYPE = np.dtype([
+    ('ts', '<f8'), ('open', '<f8'), ('high', '<f8'),
+    ('low', '<f8'), ('close', '<f8'), ('volume', '<f8'),
+])
+KIND_DTYPES = {
+    'ticks': TICK_DTYPE,
+    'bars': BAR_DTYPE,
+}
+
+class PriceHistoryStore:
+    """
+    本地的股價時間序列資料庫
+    每支股票、每種資料 (ticks: 每次查到的報價, bars: 日 K 線) 各存成一個只會往後附加的
+    二進位檔，內容是固定長度的 NumPy 紀錄，讀取時可直接以欄位 (如 data['price']) 取出整欄。
+    - root: 存放資料的資料夾
+    - max_bytes: 每個檔案的大小上限，超過時捨棄最舊的一半資料
+    """
+    def __init__(self, root=HISTORY_DIR, max_bytes=HISTORY_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # 每個檔案最後一筆的時間，用來確保只附加較新的資料
+        self._last_ts = {}
+
+    def _path(self, symbol, kind):
+        safe_symbol = re.sub(r'[^0-9A-Za-z._-]', '_', symbol)
+        return os.path.join(self.root, f"{safe_symbol}.{kind}.bin")
+
+    def _read(self, symbol, kind):
+        path = self._path(symbol, kind)
+        dtype = KIND_DTYPES[kind]
+        try:
+            # 檔案結尾若有寫到一半的紀錄，只讀取完整的部分
+            count = os.path.getsize(path) // dtype.itemsize
+            return np.fromfile(path, dtype=dtype, count=count)
+        except FileNotFoundError:
+            return np.empty(0, dtype=dtype)
+
+    def _last_timestamp(self, symbol, kind):
+        key = (symbol, kind)
+        if key not in self._last_ts:
+            path = self._path(symbol, kind)
+            dtype = KIND_DTYPES[kind]
+            last = None
+            try:
+                size = os.path.getsize(path)
+                count = size // dtype.itemsize
+                if count:
+                    with open(path, 'rb') as f:
+                        f.seek((count - 1) * dtype.itemsize)
+                        last = float(np.frombuffer(f.read(dtype.itemsize), dtype=dtype)['ts'][0])
+            except FileNotFoundError:
+                pass
+            self._last_ts[key] = last
+        return self._last_ts[key]
+
+    def last_bar_time(self, symbol):
+        """回傳最後一根 K 線的時間戳記，沒有資料時回傳 None"""
+        with self._lock:
+            return self._last_timestamp(symbol, 'bars')
+
+    def _append(self, symbol, kind, records):
+        """附加資料 (需依時間排序)，只保留比檔案中最後一筆更新的紀錄"""
+        last = self._last_timestamp(symbol, kind)
+        if last is not None:
+            records = records[records['ts'] > last]
+        if not len(records):
+            return 0
+        os.makedirs(self.root, exist_ok=True)
+        path = self._path(symbol, kind)
+        with open(path, 'ab') as f:
+            # 若上次寫到一半中斷，先截掉不完整的紀錄再附加
+            extra = f.tell() % records.dtype.itemsize
+            if extra:
+                f.truncate(f.tell() - extra)
+                f.seek(0, os.SEEK_END)
+            f.write(records.tobytes())
+            size = f.tell()
+        self._last_ts[(symbol, kind)] = float(records['ts'][-1])
+        if size > self.max_bytes:
+            self._compact(symbol, kind)
+        return len(records)
+
+    def _compact(self, symbol, kind):
+        """捨棄最舊的一半資料，讓檔案維持在大小上限內"""
+        data = self._read(symbol, kind)
+        keep = data[len(data) // 2:]
+        path = self._path(symbol, kind)
+        tmp_path = path + '.tmp'
+        keep.tofile(tmp_path)
+        os.replace(tmp_path, path)
+
+    def append_quotes(self, prices, timestamp=None):
+        """
+        記錄一次查價的結果
+        - prices: {股票代號: 價格}，價格為 None 的股票會略過
+        - timestamp: 查價時間 (秒)，預設為現在
+        回傳實際寫入的筆數
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        written = 0
+        with self._lock:
+            for symbol, price in prices.items():
+                if price is None:
+                    continue
+                record = np.array([(timestamp, price)], dtype=TICK_DTYPE)
+                written += self._append(symbol, 'ticks', record)
+        return written
+
+    def append_bars(self, symbol, frame, until=None):
+        """
+        記錄 K 線資料
+        - frame: yfinance history() 回傳的 DataFrame (索引為日期，含 Open/High/Low/Close/Volume 欄位)
+        - until: 只寫入時間早於 until 的 K 線，用來排除尚未收盤、之後還會變動的當日 K 線
+        已存在的日期不會重複寫入 (也不會被更新)，回傳實際寫入的筆數
+        """
+        frame = frame.dropna(subset=['Close'])
+        if until is not None:
+            frame = frame[[stamp.timestamp() < until for stamp in frame.index]]
+        if frame.empty:
+            return 0
+        records = np.empty(len(frame), dtype=BAR_DTYPE)
+        records['ts'] = [stamp.timestamp() for stamp in frame.index]
+        records['open'] = frame['Open'].to_numpy(dtype=float)
+        records['high'] = frame['High'].to_numpy(dtype=float)
+        records['low'] = frame['Low'].to_numpy(dtype=float)
+        records['close'] = frame['Close'].to_numpy(dtype=float)
+        records['volume'] = frame['Volume'].to_numpy(dtype=float) if 'Volume' in frame else 0.0
+        records.sort(order='ts')
+        with self._lock:
+            return self._append(symbol, 'bars', records)
+
+    def _range(self, symbol, kind, start, end, last):
+        path = self._path(symbol, kind)
+        dtype = KIND_DTYPES[kind]
+        with self._lock:
+            try:
+                count = os.path.getsize(path) // dtype.itemsize
+            except FileNotFoundError:
+                count = 0
+            if not count:
+                return np.empty(0, dtype=dtype)
+            # 以記憶體映射逐筆二分搜尋，只讀取需要的那一段，不必載入整個檔案
+            # (np.searchsorted 會先把整欄複製成連續陣列)
+            data = np.memmap(path, dtype=dtype, mode='r', shape=(count,))
+            ts = data['ts']
+            low = 0 if start is None else bisect.bisect_left(ts, start)
+            high = count if end is None else bisect.bisect_right(ts, end)
+            if last is not None:
+                low = max(low, high - last)
+            records = np.array(data[low:high])
+            # 在鎖內釋放映射，_compact 才能取代檔案
+            del ts, data
+        return records
+
+    def ticks(self, symbol, start=None, end=None, last=None):
+        """
+        取得 start~end (時間戳記，含端點) 之間的報價紀錄，欄位為 ts、price
+        - last: 只取其中最後 last 筆
+        """
+        return self._range(symbol, 'ticks', start, end, last)
+
+    def bars(self, symbol, start=None, end=None, last=None):
+        """
+        取得 start~end (時間戳記，含端點) 之間的 K 線，欄位為 ts、open、high、low、close、volume
+        - last: 只取其中最後 last 根
+        """
+        return self._range(symbol, 'bars', start, end, last)
+
+    def symbols(self):
+        """回傳有歷史資料的股票代號"""
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return []
+        return sorted({name.rsplit('.', 2)[0] for name in names if name.endswith('.bin')})
+
+# --- 降低取樣 (繪圖用) ---
+def downsample_minmax(ts, values, buckets):
+    """
+    依時間將資料平均切成 buckets 段 (通常是圖表的像素寬度)，每段只保留最低與最高點
+    畫出來的折線與原始資料幾乎相同 (不會漏掉尖峰)，點數最多 2 * buckets。
+    回傳 (ts, values)，資料點不多時原樣回傳。
+    """
+    count = len(ts)
+    if buckets < 1 or count <= 2 * buckets:
+        return ts, values
+    # 每段的起點位置，空的段落會被合併掉
+    edges = np.searchsorted(ts, np.linspace(ts[0], ts[-1], buckets + 1)[1:-1])
+    starts = np.unique(np.concatenate(([0], edges)))
+    segment = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, count)))
+    # 依 (段落, 數值) 排序後，每段的第一個是最低點、最後一個是最高點
+    order = np.lexsort((values, segment))
+    bounds = np.append(starts, count)
+    lowest = order[bounds[:-1]]
+    highest = order[bounds[1:] - 1]
+    keep = np.unique(np.concatenate((lowest, highest)))
+    return ts[keep], values[keep]
+
+def downsample_lttb(ts, values, threshold):
+    """
+    以 Largest-Triangle-Three-Buckets 演算法挑出 threshold 個最能代表整體形狀的點
+    適合點數很少的迷你走勢圖。回傳 (ts, values)，資料點不多時原樣回傳。
+    """
+    count = len(ts)
+    if threshold < 3 or count <= threshold:
+        return ts, values
+    every = (count - 2) / (threshold - 2)
+    keep = [0]
+    previous = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        # 下一段的平均點 (最後一段以最後一個點為準)
+        next_end = min(int((i + 2) * every) + 1, count)
+        if i == threshold - 3:
+            avg_ts, avg_value = ts[-1], values[-1]
+        else:
+            avg_ts, avg_value = ts[end:next_end].mean(), values[end:next_end].mean()
+        # 選出與前一個選定點、下一段平均點組成最大三角形的點
+        area = np.abs((ts[previous] - avg_ts) * (values[start:end] - values[previous])
+                      - (ts[previous] - ts[start:end]) * (avg_value - values[previous]))
+        previous = start + int(np.argmax(area))
+        keep.append(previous)
+    keep.append(count - 1)
+    return ts[keep], values[keep]
@@ -0,0 +1,306 @@
+import json
+import random
+import threading
+import time
+
+# yfinance (連帶 pandas) 與 requests 匯入很慢，只在第一次實際查詢時才匯入
+
+# --- 常數設定 ---
+# 證交所「基本市況報導」(MIS) 的即時報價 API，一次請求可查詢多支股票
+TWSE_MIS_URL = "https://mis.twse.com.tw/stock/api/getStockInfo.jsp"
+# 每次向 MIS 請求的股票數量上限 (網址過長時會被拒絕)
+TWSE_MIS_BATCH_SIZE = 50
+# 錄製的報價檔案，供 ReplayProvider 離線重播
+REPLAY_FILE = 'recorded_quotes.json'
+
+class QuoteProvider:
+    """
+    報價來源的共同介面
+    - fetch_many(symbols, timeout): 回傳 {股票代號: 價格}，查詢失敗的股票價格為 None
+    - fetch_one(symbol, timeout): 回傳單一股票的價格，失敗時回傳 None
+    - metadata(symbol, timeout): 回傳股票的基本資料字典 (至少包含 'name')，失敗時回傳空字典
+    - fetch_bars(symbols, period, timeout): 回傳 {股票代號: 日 K 線 DataFrame}，只包含有資料的股票；
+      supports_bars 為 True 的來源才提供
+    子類別至少需實作 fetch_many；host 為請求的主機名稱，供呼叫端依主機分別做連線保護。
+    整批請求失敗 (例如連線錯誤或被限流) 時 fetch_many 應拋出例外，而不是回傳全部為 None。
+    """
+    name = 'base'
+    host = 'base'
+    supports_bars = False
+
+    def fetch_many(self, symbols, timeout=None):
+        raise NotImplementedError
+
+    def fetch_one(self, symbol, timeout=None):
+        return self.fetch_many([symbol], timeout).get(symbol)
+
+    def metadata(self, symbol, timeout=None):
+        return {}
+
+    def fetch_bars(self, symbols, period, timeout=None):
+        raise NotImplementedError
+
+class YFinanceProvider(QuoteProvider):
+    """
+    使用 yfinance (Yahoo Finance) 查詢報價
+    批次結果中缺少的股票會改用單一查詢；整批 (包含只有一支股票的批次) 都沒有取得報價，
+    或單一查詢發生連線錯誤時直接拋出例外，交由呼叫端的斷路器與重試處理。
+    """
+    name = 'yfinance'
+    host = 'finance.yahoo.com'
+    supports_bars = True
+
+    def fetch_one(self, symbol, timeout=None):
+        try:
+            return self._fetch_one(symbol, timeout)
+        except Exception as e:
+            print(f"錯誤：使用 yfinance 抓取 {symbol} 股價時發生錯誤: {e}")
+            return None
+
+    def _fetch_one(self, symbol, timeout):
+        """單一查詢；連線或回應錯誤直接拋出，只有正常回應但沒有價格時回傳 None"""
+        import yfinance as yf
+        print(f"正在查詢 {symbol} 的股價...")
+        ticker = yf.Ticker(symbol)
+
+        # yfinance 提供多種獲取價格的方式，我們嘗試幾種以增加成功率
+
+        # 方法一：獲取最近一天的歷史資料，取收盤價
+        hist = ticker.history(period="1d", timeout=timeout)
+        if not hist.empty:
+            latest_price = hist['Close'].iloc[-1]
+            return round(latest_price, 2)
+
+        # 方法二：如果 history 為空，嘗試從 info 字典中獲取 'regularMarketPrice'
+        info = ticker.info
+        if 'regularMarketPrice' in info and info['regularMarketPrice'] is not None:
+            return round(info['regularMarketPrice'], 2)
+
+        # 方法三：作為最終備案，嘗試 'preMarket' 或 'postMarket' 價格
+        if 'preMarket' in info and info['preMarket'] is not None:
+            return round(info['preMarket'], 2)
+
+        print(f"警告：無法為 {symbol} 找到任何有效的價格資料。")
+        return None
+
+    def fetch_many(self, symbols, timeout=None):
+        import yfinance as yf
+        print(f"正在批次查詢 {len(symbols)} 支股票的股價...")
+        data = yf.download(list(symbols), period="1d", group_by='ticker',
+                           progress=False, threads=True, timeout=timeout)
+        multi = getattr(data.columns, 'nlevels', 1) > 1
+        prices = {symbol: _extract_close(data, symbol, multi) for symbol in symbols}
+        if not any(price is not None for price in prices.values()):
+            # yf.download 遇到錯誤時不會拋出例外，只會回傳空的結果
+            raise RuntimeError("批次查詢沒有取得任何報價")
+
+        # 批次中沒有拿到價格的股票，退回單一查詢的方式；連線錯誤不吞掉，整批視為失敗
+        for symbol in symbols:
+            if prices.get(symbol) is None:
+                prices[symbol] = self._fetch_one(symbol, timeout)
+        return prices
+
+    def fetch_bars(self, symbols, period, timeout=None):
+        import yfinance as yf
+        print(f"正在下載 {len(symbols)} 支股票的日 K 線...")
+        data = yf.download(list(symbols), period=period, interval="1d", group_by='ticker',
+                           progress=False, threads=True, timeout=timeout)
+        multi = getattr(data.columns, 'nlevels', 1) > 1
+        bars = {}
+        for symbol in symbols:
+            try:
+                frame = (data[symbol] if multi else data).dropna(subset=['Close'])
+            except KeyError:
+                continue
+            if not frame.empty:
+                bars[symbol] = frame
+        if not bars:
+            # 與 fetch_many 相同，yf.download 失敗時只會回傳空的結果
+            raise RuntimeError("沒有取得任何日 K 線")
+        return bars
+
+    def metadata(self, symbol, timeout=None):
+        import yfinance as yf
+        try:
+            info = yf.Ticker(symbol).info
+        except Exception as e:
+            print(f"錯誤：查詢 {symbol} 的公司資訊時發生錯誤: {e}")
+            return {}
+        return {
+            'name': info.get('longName'),
+            'currency': info.get('currency'),
+            'exchange': info.get('exchange'),
+        }
+
+def _extract_close(data, symbol, multi):
+    """從 yf.download 的結果中取出指定股票最後一筆有效收盤價"""
+    try:
+        frame = data[symbol] if multi else data
+        closes = frame['Close'].dropna()
+    except KeyError:
+        return None
+    if closes.empty:
+        return None
+    return round(float(closes.iloc[-1]), 2)
+
+class TwseMisProvider(QuoteProvider):
+    """
+    使用證交所 MIS 即時報價 API 查詢台股 (上市 .TW、上櫃 .TWO)
+    盤中提供的是最新成交價，比 yfinance 的延遲報價即時；不支援其他市場的股票。
+    """
+    name = 'twse'
+    host = 'mis.twse.com.tw'
+
+    def __init__(self, batch_size=TWSE_MIS_BATCH_SIZE):
+        import requests
+        self.batch_size = batch_size
+        self._session = requests.Session()
+
+    @staticmethod
+    def _channel(symbol):
+        """將 '2330.TW' 轉換為 MIS 的查詢格式 'tse_2330.tw'，無法轉換時回傳 None"""
+        code, _, suffix = symbol.upper().partition('.')
+        if suffix == 'TW':
+            return f"tse_{code}.tw"
+        if suffix == 'TWO':
+            return f"otc_{code}.tw"
+        return None
+
+    def _query(self, symbols, timeout):
+        """查詢一批股票，回傳 {股票代號: MIS 的原始資料}"""
+        channels = {}
+        for symbol in symbols:
+            channel = self._channel(symbol)
+            if channel:
+                channels[channel] = symbol
+        if not channels:
+            return {}
+        response = self._session.get(
+            TWSE_MIS_URL,
+            params={'ex_ch': '|'.join(channels), 'json': 1, 'delay': 0},
+            timeout=timeout,
+        )
+        response.raise_for_status()
+        rows = {}
+        for item in response.json().get('msgArray', []):
+            channel = f"{item.get('ex')}_{item.get('c')}.tw"
+            if channel in channels:
+                rows[channels[channel]] = item
+        return rows
+
+    @staticmethod
+    def _price(item):
+        """取出最新成交價；這段期間沒有成交時 ('-') 改用最佳買價"""
+        for value in (item.get('z'), (item.get('b') or '').split('_')[0]):
+            try:
+                return round(float(value), 2)
+            except (TypeError, ValueError):
+                continue
+        return None
+
+    def fetch_many(self, symbols, timeout=None):
+        prices = {symbol: None for symbol in symbols}
+        for start in range(0, len(symbols), self.batch_size):
+            chunk = symbols[start:start + self.batch_size]
+            rows = self._query(chunk, timeout)
+            for symbol, item in rows.items():
+                prices[symbol] = self._price(item)
+        return prices
+
+    def metadata(self, symbol, timeout=None):
+        try:
+            item = self._query([symbol], timeout).get(symbol)
+        # requests 的例外都是 OSError 的子類別，不必為此先匯入 requests
+        except (OSError, ValueError) as e:
+            print(f"錯誤：向證交所查詢 {symbol} 的資料時發生錯誤: {e}")
+            return {}
+        if not item:
+            return {}
+        return {
+            'name': item.get('nf') or item.get('n'),
+            'short_name': item.get('n'),
+            'exchange': item.get('ex'),
+        }
+
+class ReplayProvider(QuoteProvider):
+    """
+    從錄製檔重播報價，不連網，供離線測試與效能量測使用
+    錄製檔格式: {"quotes": {"2330.TW": [580.0, 581.0, ...]}, "metadata": {"2330.TW": {"name": ...}}}
+    每次查詢同一支股票會依序回傳下一個價格，用完後從頭循環；錄製檔中沒有的股票價格為 None。
+    - latency: 每次請求的模擬延遲 (秒)
+    - jitter: 延遲額外加上的隨機變動範圍 (秒)
+    - failure_rate: 每支股票查詢失敗 (回傳 None) 的機率
+    - error_rate: 整批請求失敗 (拋出 ConnectionError) 的機率，模擬上游故障或限流
+    - seed: 亂數種子，相同的種子與查詢順序會得到相同的結果
+    """
+    name = 'replay'
+    host = 'replay'
+
+    def __init__(self, path=REPLAY_FILE, quotes=None, metadata=None,
+                 latency=0.0, jitter=0.0, failure_rate=0.0, error_rate=0.0, seed=0):
+        if quotes is None:
+            with open(path, 'r', encoding='utf-8') as f:
+                recorded = json.load(f)
+            quotes = recorded.get('quotes', {})
+            metadata = recorded.get('metadata', {}) if metadata is None else metadata
+        self.quotes = {symbol: series if isinstance(series, list) else [series]
+                       for symbol, series in quotes.items()}
+        self._metadata = metadata or {}
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._steps = {}
+        self._lock = threading.Lock()
+
+    def _wait(self):
+        with self._lock:
+            delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def fetch_many(self, symbols, timeout=None):
+        self._wait()
+        prices = {}
+        with self._lock:
+            if self.error_rate and self._random.random() < self.error_rate:
+                raise ConnectionError("模擬的上游錯誤")
+            for symbol in symbols:
+                series = self.quotes.get(symbol)
+                if not series or (self.failure_rate and self._random.random() < self.failure_rate):
+                    prices[symbol] = None
+                    continue
+                step = self._steps.get(symbol, 0)
+                prices[symbol] = series[step % len(series)]
+                self._steps[symbol] = step + 1
+        return prices
+
+    def metadata(self, symbol, timeout=None):
+        return dict(self._metadata.get(symbol, {}))
+
+def save_recording(path, quotes, metadata=None):
+    """
+    將報價寫成 ReplayProvider 可讀取的錄製檔
+    - quotes: {股票代號: 價格或價格序列}
+    """
+    recorded = {
+        'quotes': {symbol: series if isinstance(series, list) else [series]
+                   for symbol, series in quotes.items()},
+        'metadata': metadata or {},
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(recorded, f, ensure_ascii=False)
+
+PROVIDERS = {
+    YFinanceProvider.name: YFinanceProvider,
+    TwseMisProvider.name: TwseMisProvider,
+    ReplayProvider.name: ReplayProvider,
+}
+
+def make_provider(name, **options):
+    """依名稱建立報價來源 (yfinance / twse / replay)"""
+    try:
+        return PROVIDERS[name](**options)
+    except KeyError:
+        raise ValueError(f"未知的報價來源: {name}") from None
@@ -0,0 +1,313 @@
+import json
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+import core
+
+# --- 常數設定 ---
+# 只接受本機連線，避免監控清單被區網內的其他電腦修改
+SERVE_HOST = '127.0.0.1'
+SERVE_PORT = 8765
+# 只接受 Host/Origin 為本機的請求，避免其他網站透過瀏覽器 (或 DNS rebinding) 呼叫 API
+LOOPBACK_HOSTS = ('127.0.0.1', 'localhost', '::1')
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+def _validate_rule(rule):
+    """檢查 rules 中的一條規則，有問題時回傳錯誤訊息"""
+    if not isinstance(rule, dict):
+        return '每條規則 (rules) 必須是 JSON 物件'
+    condition = rule.get('condition')
+    if condition not in core.CONDITION_LABELS:
+        return f"規則中有不支援的條件 (condition)，可用的條件: {', '.join(core.CONDITION_LABELS)}"
+    if not _is_number(rule.get('value')):
+        return f"規則 {condition} 的數值 (value) 必須是數字"
+    if condition in ('above_ma', 'below_ma') and rule['value'] < 1:
+        return f"規則 {condition} 的均線天數 (value) 至少為 1"
+    if condition == 'band' and not _is_number(rule.get('high')):
+        return '規則 band 的區間上緣 (high) 必須是數字'
+    return None
+
+def _validate_lots(lots):
+    """檢查分批買進紀錄 lots，有問題時回傳錯誤訊息"""
+    if not isinstance(lots, list):
+        return '分批買進紀錄 (lots) 必須是陣列'
+    for lot in lots:
+        if not isinstance(lot, dict):
+            return '每筆買進紀錄 (lots) 必須是 JSON 物件'
+        if not _is_number(lot.get('shares')) or lot['shares'] < 0:
+            return '買進紀錄的股數 (shares) 必須是不小於 0 的數字'
+        if not _is_number(lot.get('price')) or lot['price'] < 0:
+            return '買進紀錄的成交價 (price) 必須是不小於 0 的數字'
+    return None
+
+def validate_stock_fields(fields, creating=False):
+    """
+    檢查要寫入監控清單的股票欄位，有問題時回傳錯誤訊息，沒問題時回傳 None
+    監控清單由 GUI、CLI 與背景服務共用，格式錯誤的資料會讓每一次檢查都失敗。
+    - creating: 新增股票時 symbol 與 target_price 為必填
+    修改時值為 None 的欄位表示移除該欄位 (見 Watchlist.update)，symbol 與 target_price 不能移除。
+    """
+    if creating or 'symbol' in fields:
+        symbol = fields.get('symbol')
+        if not isinstance(symbol, str) or not symbol.strip():
+            return '股票代號 (symbol) 必須是非空白的字串'
+    if 'condition' in fields and fields['condition'] not in core.CONDITION_LABELS:
+        return f"不支援的條件 (condition)，可用的條件: {', '.join(core.CONDITION_LABELS)}"
+    if (creating or 'target_price' in fields) and not _is_number(fields.get('target_price')):
+        return '目標價 (target_price) 必須是數字'
+    if fields.get('band_high') is not None and not _is_number(fields['band_high']):
+        return '區間上緣 (band_high) 必須是數字'
+    if fields.get('category') is not None and not isinstance(fields['category'], str):
+        return '分類 (category) 必須是字串'
+    for key, label in (('shares', '持股數'), ('cost_basis', '平均成本')):
+        if fields.get(key) is not None and (not _is_number(fields[key]) or fields[key] < 0):
+            return f'{label} ({key}) 必須是不小於 0 的數字'
+    if fields.get('lots') is not None:
+        error = _validate_lots(fields['lots'])
+        if error:
+            return error
+    if fields.get('rules') is not None:
+        if not isinstance(fields['rules'], list):
+            return '規則 (rules) 必須是陣列'
+        for rule in fields['rules']:
+            error = _validate_rule(rule)
+            if error:
+                return error
+    return None
+
+class StockWatcherService:
+    """
+    不需要 GUI 的背景服務：持有監控清單、定時排程、報價與警示通知
+    GUI 與 CLI 可以透過 HTTP API 共用同一份狀態，不必各自查價。
+    """
+    def __init__(self, watchlist=None):
+        self.watchlist = watchlist or core.Watchlist()
+        self.dispatcher = core.NotificationDispatcher(
+            core.default_sinks(lambda message, tag: print(message)))
+        self.scheduler = core.PriceCheckScheduler(self.run_price_check)
+        # 最近一次查到的報價 {股票代號: {'price': 價格, 'time': 查價時間}}
+        self._prices = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.dispatcher.start()
+        self.scheduler.start()
+
+    def stop(self):
+        self.scheduler.stop()
+        self.dispatcher.stop()
+        self.watchlist.flush()
+
+    def run_price_check(self):
+        # 其他程式 (例如 CLI 的 add 指令) 可能直接修改過 stocks.json
+        self.watchlist.reload_if_changed()
+        stocks = self.watchlist.stocks()
+        if not stocks:
+            return
+
+        def on_price(stock, price):
+            with self._lock:
+                self._prices[stock['symbol']] = {'price': price, 'time': time.time()}
+
+        core.run_alert_sweep(stocks, self.dispatcher, on_price)
+
+    def prices(self):
+        """回傳監控清單中每支股票最近一次的報價，尚未查到的股票價格為 None"""
+        with self._lock:
+            latest = dict(self._prices)
+        result = []
+        for stock in self.watchlist.stocks():
+            quote = latest.get(stock['symbol'], {})
+            result.append({
+                'symbol': stock['symbol'],
+                'name': stock.get('name', ''),
+                'price': quote.get('price'),
+                'time': quote.get('time'),
+            })
+        return result
+
+    def status(self):
+        return {
+            'stocks': len(self.watchlist),
+            'scheduler': self.scheduler.stats(),
+            'last_sweep': core.sweep_timer.last_summary,
+            'resilience': core.resilience_stats(),
+        }
+
+    def portfolio(self):
+        """以最近一次的報價計算持股損益 (見 core.summarize_portfolio)"""
+        with self._lock:
+            latest = {symbol: quote['price'] for symbol, quote in self._prices.items()}
+        stocks = self.watchlist.stocks()
+        held = [stock['symbol'] for stock in stocks if core.stock_position(stock)[0] > 0]
+        return core.summarize_portfolio(stocks, latest, core.get_previous_closes(held))
+
+    def alerts(self):
+        """回傳最近的警示通知 (新的在前)"""
+        return self.dispatcher.recent()
+
+class StockWatcherRequestHandler(BaseHTTPRequestHandler):
+    """
+    JSON API：
+    - GET    /status              服務與排程狀態
+    - GET    /prices              監控清單的最新報價
+    - GET    /watchlist           監控清單
+    - GET    /alerts              最近的警示通知
+    - GET    /portfolio           持股市值與損益
+    - POST   /watchlist           新增股票 (內容為股票資料，至少需有 symbol)
+    - PATCH  /watchlist/<代號>     修改股票欄位
+    - DELETE /watchlist/<代號>     刪除股票
+    - POST   /check               立即檢查一次
+    POST 與 PATCH 的 Content-Type 必須是 application/json：瀏覽器送出這種請求前一定會先做
+    CORS 預檢，而本服務不回應預檢，其他網頁因此無法偷偷修改監控清單。
+    """
+    service = None
+
+    def log_message(self, format, *args):
+        # 預設會把每個請求印到 stderr，背景服務不需要
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def _allowed_origin(self):
+        """Host 與 Origin (有的話) 都必須指向本機"""
+        host = urlsplit(f"//{self.headers.get('Host', '')}").hostname
+        if host not in LOOPBACK_HOSTS:
+            return False
+        origin = self.headers.get('Origin')
+        return origin is None or urlsplit(origin).hostname in LOOPBACK_HOSTS
+
+    def _check_request(self, require_json=False):
+        """檢查請求來源與內容格式，不符合時回應錯誤並回傳 False"""
+        if not self._allowed_origin():
+            self._send_json(403, {'error': '只接受來自本機的請求'})
+            return False
+        content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if require_json and content_type != 'application/json':
+            self._send_json(415, {'error': 'Content-Type 必須是 application/json'})
+            return False
+        return True
+
+    def _route(self):
+        """回傳 (資源名稱, 股票代號或 None)"""
+        parts = [unquote(part) for part in urlsplit(self.path).path.split('/') if part]
+        if not parts:
+            return None, None
+        return parts[0], (parts[1] if len(parts) > 1 else None)
+
+    def do_GET(self):
+        if not self._check_request():
+            return
+        resource, _symbol = self._route()
+        if resource == 'status':
+            self._send_json(200, self.service.status())
+        elif resource == 'prices':
+            self._send_json(200, self.service.prices())
+        elif resource == 'watchlist':
+            self._send_json(200, self.service.watchlist.stocks())
+        elif resource == 'alerts':
+            self._send_json(200, self.service.alerts())
+        elif resource == 'portfolio':
+            self._send_json(200, self.service.portfolio())
+        else:
+            self._send_json(404, {'error': '找不到此資源'})
+
+    def do_POST(self):
+        if not self._check_request(require_json=True):
+            return
+        resource, _symbol = self._route()
+        if resource == 'check':
+            started = self.service.scheduler.run_now()
+            self._send_json(202, {'started': started})
+            return
+        if resource != 'watchlist':
+            self._send_json(404, {'error': '找不到此資源'})
+            return
+        try:
+            stock = self._read_json()
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            self._send_json(400, {'error': '內容必須是 JSON'})
+            return
+        if not isinstance(stock, dict):
+            self._send_json(400, {'error': '內容必須是 JSON 物件'})
+            return
+        error = validate_stock_fields(stock, creating=True)
+        if error:
+            self._send_json(400, {'error': error})
+            return
+        if not self.service.watchlist.add(stock):
+            self._send_json(409, {'error': f"{stock['symbol']} 已經在追蹤清單中"})
+            return
+        self._send_json(201, self.service.watchlist.get(stock['symbol']))
+
+    def do_PATCH(self):
+        if not self._check_request(require_json=True):
+            return
+        resource, symbol = self._route()
+        if resource != 'watchlist' or not symbol:
+            self._send_json(404, {'error': '找不到此資源'})
+            return
+        try:
+            fields = self._read_json()
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            self._send_json(400, {'error': '內容必須是 JSON'})
+            return
+        if not isinstance(fields, dict):
+            self._send_json(400, {'error': '內容必須是 JSON 物件'})
+            return
+        error = validate_stock_fields(fields)
+        if error:
+            self._send_json(400, {'error': error})
+            return
+        if symbol not in self.service.watchlist:
+            self._send_json(404, {'error': f"{symbol} 不在追蹤清單中"})
+            return
+        if not self.service.watchlist.update(symbol, **fields):
+            self._send_json(409, {'error': f"{fields.get('symbol')} 已經在追蹤清單中"})
+            return
+        self._send_json(200, self.service.watchlist.get(fields.get('symbol', symbol)))
+
+    def do_DELETE(self):
+        if not self._check_request():
+            return
+        resource, symbol = self._route()
+        if resource != 'watchlist' or not symbol:
+            self._send_json(404, {'error': '找不到此資源'})
+            return
+        if not self.service.watchlist.remove([symbol]):
+            self._send_json(404, {'error': f"{symbol} 不在追蹤清單中"})
+            return
+        self._send_json(200, {'removed': symbol})
+
+def serve(port=SERVE_PORT, host=SERVE_HOST):
+    """啟動背景服務與 HTTP API，直到按下 Ctrl+C"""
+    service = StockWatcherService()
+    handler = type('Handler', (StockWatcherRequestHandler,), {'service': service})
+    httpd = ThreadingHTTPServer((host, port), handler)
+    service.start()
+    print(f"StockWatcher 服務已啟動：http://{host}:{port}/ (按 Ctrl+C 結束)")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        service.stop()
+        print("\n已停止服務。")
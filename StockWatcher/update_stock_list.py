@@ -1,65 +1,271 @@
 import requests
 import json
+import hashlib
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-# 台灣證券交易所 (TWSE) 的官方 API 端點
-API_URL = "https://www.twse.com.tw/exchangeReport/STOCK_DAY_ALL?response=json"
-# 輸出檔案名稱
-OUTPUT_FILE = "tw_stock_list.json"
+import core
 
-def fetch_and_save_stock_list():
+# 各交易所的官方 API 端點：
+# - 台灣證券交易所 (TWSE，上市)，yfinance 代號後綴為 '.TW'
+# - 證券櫃檯買賣中心 (TPEx，上櫃)，yfinance 代號後綴為 '.TWO'
+SOURCES = {
+    'TWSE': {
+        'url': "https://www.twse.com.tw/exchangeReport/STOCK_DAY_ALL?response=json",
+        'suffix': '.TW',
+    },
+    'TPEx': {
+        'url': "https://www.tpex.org.tw/openapi/v1/tpex_mainboard_daily_close_quotes",
+        'suffix': '.TWO',
+    },
+}
+# 要收錄的證券類型 (stock: 股票, etf: ETF, warrant: 權證, other: 特別股等其他證券)
+INCLUDE_TYPES = {'stock', 'etf', 'other'}
+# 輸出檔案名稱 (JSON 清單，以及 GUI 啟動時使用的預先建立索引的二進位檔)
+OUTPUT_FILE = core.STOCK_LIST_FILE
+INDEX_FILE = core.STOCK_INDEX_FILE
+# 記錄上次下載狀態 (ETag、Last-Modified 與內容雜湊) 的檔案，用於條件式更新
+STATE_FILE = "tw_stock_list.state.json"
+
+def load_update_state():
+    """載入上次更新時記錄的狀態，不存在時回傳空字典"""
+    try:
+        with open(STATE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def write_json_atomic(path, data, indent=2):
+    """先寫入暫存檔再取代原檔，避免中斷時留下寫到一半的檔案"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+    os.replace(tmp_path, path)
+
+def load_existing_stock_list():
+    """載入目前的台股清單，不存在或格式錯誤時回傳空清單"""
+    try:
+        with open(OUTPUT_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return []
+
+def classify_security(code):
+    """依代號判斷證券類型: stock / etf / warrant / other"""
+    if code.startswith('00'):
+        return 'etf'
+    if len(code) == 4 and code.isdigit():
+        return 'stock'
+    # 權證為 6 碼數字，上市為 03~08 開頭，上櫃為 7 開頭
+    if len(code) == 6 and code.isdigit() and (code[:2] in ('03', '04', '05', '06', '07', '08') or code[0] == '7'):
+        return 'warrant'
+    return 'other'
+
+def parse_twse_payload(payload):
+    """解析證交所 STOCK_DAY_ALL 的回應，回傳 [(代號, 名稱), ...]"""
+    if payload.get('stat') != 'OK':
+        raise ValueError(f"證交所 API 回應狀態不為 OK: {payload.get('stat')}")
+    # 'data' 欄位是一個包含 [["代號", "名稱", ...], ...] 的列表
+    return [(row[0], row[1]) for row in payload.get('data', []) if len(row) >= 2]
+
+def parse_tpex_payload(payload):
+    """解析櫃買中心 OpenAPI 的回應 ([{"SecuritiesCompanyCode", "CompanyName", ...}, ...])"""
+    rows = []
+    for item in payload:
+        code = item.get('SecuritiesCompanyCode') or item.get('Code')
+        name = item.get('CompanyName') or item.get('Name')
+        if code and name:
+            rows.append((code, name))
+    return rows
+
+PARSERS = {
+    'TWSE': parse_twse_payload,
+    'TPEx': parse_tpex_payload,
+}
+
+def build_stock_records(rows, market, suffix, include_types=INCLUDE_TYPES):
     """
-    從台灣證券交易所 (TWSE) 獲取台股清單，處理後儲存為 JSON 檔案。
+    將 [(代號, 名稱), ...] 轉換為統一格式的股票資料:
+    {"symbol": "2330.TW", "name": "台積電", "code": "2330", "market": "TWSE", "suffix": ".TW", "type": "stock"}
     """
-    print(f"正在從台灣證券交易所官方 API 下載最新的台股清單...\n{API_URL}")
-    
-    try:
-        # 偽裝成瀏覽器發送請求
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+    processed_stocks = []
+    for code, name in rows:
+        code = code.strip()
+        name = name.strip()
+        if not code or not name:
+            continue
+        security_type = classify_security(code)
+        if security_type not in include_types:
+            continue
+        processed_stocks.append({
+            # yfinance 需要在台股代號後加上市場後綴 ('.TW' 或 '.TWO')
+            "symbol": f"{code}{suffix}",
+            "name": name,
+            "code": code,
+            "market": market,
+            "suffix": suffix,
+            "type": security_type,
+        })
+    return processed_stocks
+
+def records_hash(stocks):
+    """計算股票清單內容的雜湊值 (只看代號與名稱，與排版無關)"""
+    canonical = json.dumps(sorted((s['symbol'], s['name']) for s in stocks), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def diff_stock_lists(old_stocks, new_stocks):
+    """
+    比較新舊清單，回傳變動內容:
+    {'listed': [新上市代號], 'delisted': [下市代號], 'renamed': [(代號, 舊名稱, 新名稱)]}
+    """
+    old_names = {s['symbol']: s['name'] for s in old_stocks}
+    new_names = {s['symbol']: s['name'] for s in new_stocks}
+    return {
+        'listed': sorted(set(new_names) - set(old_names)),
+        'delisted': sorted(set(old_names) - set(new_names)),
+        'renamed': sorted(
+            (symbol, old_names[symbol], name)
+            for symbol, name in new_names.items()
+            if symbol in old_names and old_names[symbol] != name
+        ),
+    }
+
+def print_diff(diff):
+    """印出清單的變動內容"""
+    print(f"新上市 {len(diff['listed'])} 筆、下市 {len(diff['delisted'])} 筆、更名 {len(diff['renamed'])} 筆。")
+    for symbol in diff['listed']:
+        print(f"  + {symbol}")
+    for symbol in diff['delisted']:
+        print(f"  - {symbol}")
+    for symbol, old_name, new_name in diff['renamed']:
+        print(f"  * {symbol}: {old_name} -> {new_name}")
+
+def fetch_source(market, source, state, fixtures_dir=None):
+    """
+    下載單一交易所的資料，回傳 (payload, 新狀態)
+    - state: 此來源上次的下載狀態，會帶入 ETag/Last-Modified 發送條件式請求
+    - fixtures_dir: 指定時改從該資料夾讀取 <市場>.json，不連網 (供離線測試)
+    資料未變更時 payload 為 None。
+    """
+    if fixtures_dir:
+        with open(os.path.join(fixtures_dir, f"{market}.json"), 'rb') as f:
+            content = f.read()
+        return json.loads(content), {'response_hash': hashlib.sha256(content).hexdigest()}
+
+    print(f"正在從 {market} 官方 API 下載最新的股票清單...\n{source['url']}")
+    # 偽裝成瀏覽器發送請求
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+    }
+    if state.get('etag'):
+        headers['If-None-Match'] = state['etag']
+    if state.get('last_modified'):
+        headers['If-Modified-Since'] = state['last_modified']
+    response = requests.get(source['url'], headers=headers, timeout=30)
+    if response.status_code == 304:
+        return None, state
+    response.raise_for_status()
+
+    new_state = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'response_hash': hashlib.sha256(response.content).hexdigest(),
+    }
+    if new_state['response_hash'] == state.get('response_hash'):
+        return None, new_state
+    return response.json(), new_state
+
+def fetch_and_save_stock_list(force=False, fixtures_dir=None, sources=SOURCES):
+    """
+    同時從各交易所 (上市、上櫃) 獲取台股清單，合併處理後儲存為 JSON 檔案。
+    - force: 為 True 時忽略上次的下載狀態，一律重新下載並寫入
+    - fixtures_dir: 指定時從本地檔案讀取各交易所的回應 (<市場>.json)，不連網
+    會帶上次的 ETag/Last-Modified 發送條件式請求，並比對內容雜湊；
+    只有清單真的有變動時才會寫檔。某個來源失敗時沿用該市場原有的資料。
+    原有清單不存在或是空的時，上次的下載狀態已不可信，一律重新下載 (等同 force)。
+    回傳變動內容 (見 diff_stock_lists)，沒有變動或發生錯誤時回傳 None。
+    """
+    existing_stocks = load_existing_stock_list()
+    if not existing_stocks:
+        force = True
+    state = {} if force else load_update_state()
+    source_states = state.get('sources', {})
+
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        futures = {
+            market: executor.submit(fetch_source, market, source, source_states.get(market, {}), fixtures_dir)
+            for market, source in sources.items()
         }
-        response = requests.get(API_URL, headers=headers, timeout=30)
-        response.raise_for_status()
-        
-        twse_data = response.json()
-        
-        if twse_data['stat'] != 'OK':
-            print(f"錯誤：證交所 API 回應狀態不為 OK: {twse_data.get('stat')}")
-            return
-
-        # 'data' 欄位是一個包含 [["代號", "名稱", ...], ...] 的列表
-        all_stocks_raw = twse_data.get('data', [])
-        print(f"成功下載 {len(all_stocks_raw)} 筆原始資料。")
-        
-        processed_stocks = []
-        print("正在處理資料，轉換為我們需要的格式...")
-        
-        for stock_info in all_stocks_raw:
-            # 確保資料格式正確 (至少有代號和名稱)
-            if len(stock_info) >= 2:
-                symbol_code = stock_info[0].strip()
-                name = stock_info[1].strip()
-                
-                # yfinance 需要在台股代號後加上 '.TW'
-                symbol_for_yfinance = f"{symbol_code}.TW"
-                
-                processed_stocks.append({
-                    "symbol": symbol_for_yfinance,
-                    "name": name
-                })
-        
-        print(f"處理完成，總共 {len(processed_stocks)} 筆有效股票資料。")
-        
-        with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-            json.dump(processed_stocks, f, ensure_ascii=False, indent=2)
-            
+
+    new_state = {
+        'sources': {},
+        'records_hash': state.get('records_hash'),
+        'checked_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    merged_stocks = []
+    changed = force or not existing_stocks
+    for market, future in futures.items():
+        source = sources[market]
+        try:
+            payload, new_state['sources'][market] = future.result()
+            if payload is not None:
+                rows = PARSERS[market](payload)
+                print(f"{market}: 成功下載 {len(rows)} 筆原始資料。")
+                merged_stocks.extend(build_stock_records(rows, market, source['suffix']))
+                changed = True
+                continue
+            print(f"{market}: 資料未變更。")
+        except requests.exceptions.RequestException as e:
+            print(f"錯誤：下載 {market} 股票清單時發生網路錯誤: {e}")
+            new_state['sources'][market] = source_states.get(market, {})
+        except (json.JSONDecodeError, KeyError, ValueError, OSError) as e:
+            print(f"錯誤：無法解析 {market} 的回應，格式可能已變更。錯誤: {e}")
+            new_state['sources'][market] = source_states.get(market, {})
+        # 沒有新資料的市場沿用原有清單；舊版清單沒有 market 欄位，一律視為上市
+        merged_stocks.extend(s for s in existing_stocks if s.get('market', 'TWSE') == market)
+
+    if not changed:
+        print("各交易所資料皆未變更，不需要更新。")
+        write_json_atomic(STATE_FILE, new_state)
+        return None
+
+    if not merged_stocks:
+        # 所有來源都失敗且沒有原有資料，不要寫出空的清單
+        print("錯誤：沒有取得任何股票資料，保留原有檔案。")
+        return None
+
+    print(f"處理完成，總共 {len(merged_stocks)} 筆有效股票資料。")
+    new_state['records_hash'] = records_hash(merged_stocks)
+    if not force and existing_stocks and new_state['records_hash'] == records_hash(existing_stocks):
+        # 每日資料含有股價，內容雖然不同，但股票清單本身沒有變
+        print("股票清單沒有變動，不需要更新。")
+        write_json_atomic(STATE_FILE, new_state)
+        return None
+
+    diff = diff_stock_lists(existing_stocks, merged_stocks)
+    print_diff(diff)
+
+    try:
+        write_json_atomic(OUTPUT_FILE, merged_stocks)
         print(f"成功！包含中文名稱的股票清單已儲存至 -> {OUTPUT_FILE}")
-        
-    except requests.exceptions.RequestException as e:
-        print(f"錯誤：下載股票清單時發生網路錯誤: {e}")
-    except (json.JSONDecodeError, KeyError) as e:
-        print(f"錯誤：無法解析從 API 收到的回應，格式可能已變更。錯誤: {e}")
-    except Exception as e:
-        print(f"處理過程中發生未知錯誤: {e}")
+
+        core.save_stock_index(core.StockIndex(merged_stocks), INDEX_FILE)
+        print(f"已建立查詢索引快取檔 -> {INDEX_FILE}")
+    except OSError as e:
+        print(f"錯誤：寫入股票清單時發生錯誤: {e}")
+        return None
+
+    # 下市或更名的股票，其快取的名稱與股價已不可信
+    stale_symbols = diff['delisted'] + [symbol for symbol, _old, _new in diff['renamed']]
+    if stale_symbols:
+        core.get_quote_cache().invalidate(stale_symbols)
+
+    write_json_atomic(STATE_FILE, new_state)
+    return diff
 
 if __name__ == '__main__':
-    fetch_and_save_stock_list()
\ No newline at end of file
+    args = sys.argv[1:]
+    fixtures = args[args.index('--fixtures') + 1] if '--fixtures' in args[:-1] else None
+    fetch_and_save_stock_list(force='--force' in args, fixtures_dir=fixtures)